@@ -0,0 +1,263 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from decimal import Decimal
+import hashlib
+import re
+from threading import Lock
+import time
+
+from aws_etl_tools.aws import AWS
+from aws_etl_tools import config
+from aws_etl_tools.exceptions import AthenaQueryError
+from aws_etl_tools.s3_file import lines, parse_s3_path
+
+
+# how the text in Athena's CSV results is read, by the column type Athena reports
+INTEGER_TYPES = {'tinyint', 'smallint', 'integer', 'bigint'}
+FLOAT_TYPES = {'float', 'real', 'double'}
+DECIMAL_TYPE = 'decimal'
+BOOLEAN_TYPE = 'boolean'
+STRING_TYPES = {'char', 'varchar', 'string'}
+
+# completed queries, by what they asked and how fresh their sources were, shared by
+# every AthenaDatabase in the process
+_RESULT_CACHE = OrderedDict()
+_RESULT_CACHE_LOCK = Lock()
+
+
+def clear_result_cache():
+    '''Forget every cached Athena result.'''
+    with _RESULT_CACHE_LOCK:
+        _RESULT_CACHE.clear()
+
+
+def normalize_query(query):
+    '''The query with whitespace outside of string literals collapsed and any trailing
+    semicolon dropped, so trivially reformatted queries share a cache entry.'''
+    pieces = re.split(r"('(?:[^']|'')*')", query.strip().rstrip(';'))
+    return ''.join(piece if index % 2 else re.sub(r'\s+', ' ', piece) for index, piece in enumerate(pieces)).strip()
+
+
+class AthenaQuery:
+    '''A query submitted to Athena. Nothing here blocks except `wait` and reading
+    the results: `is_done` checks on the query once and returns straight away.'''
+
+    SUCCEEDED = 'SUCCEEDED'
+    FAILED = 'FAILED'
+    CANCELLED = 'CANCELLED'
+    FINISHED_STATES = {SUCCEEDED, FAILED, CANCELLED}
+
+    def __init__(self, database, query_execution_id):
+        self.database = database
+        self.query_execution_id = query_execution_id
+        self.state = None
+        self.state_change_reason = None
+        self.output_location = None
+        self.data_scanned_bytes = None
+        self.execution_seconds = None
+        self._columns = None
+
+    def is_done(self):
+        '''Whether the query has finished, one way or another.'''
+        if self.state not in self.FINISHED_STATES:
+            execution = self.database.athena_connection().get_query_execution(
+                QueryExecutionId=self.query_execution_id)['QueryExecution']
+            status = execution['Status']
+            statistics = execution.get('Statistics', {})
+            self.state = status['State']
+            self.state_change_reason = status.get('StateChangeReason')
+            self.output_location = execution.get('ResultConfiguration', {}).get('OutputLocation')
+            self.data_scanned_bytes = statistics.get('DataScannedInBytes')
+            self.execution_seconds = statistics.get('EngineExecutionTimeInMillis', 0) / 1000.0
+        return self.state in self.FINISHED_STATES
+
+    def wait(self, timeout_seconds=None):
+        '''Polls until the query finishes, backing off exponentially from
+        config.ATHENA_POLL_INITIAL_SECONDS to config.ATHENA_POLL_MAX_SECONDS between
+        checks. Raises AthenaQueryError if it failed, was cancelled, or is still
+        running after `timeout_seconds`.'''
+        started_at = time.time()
+        poll_seconds = config.ATHENA_POLL_INITIAL_SECONDS
+        while not self.is_done():
+            if timeout_seconds is not None and time.time() - started_at + poll_seconds > timeout_seconds:
+                raise AthenaQueryError('Athena query {} is still running after {} seconds'.format(
+                    self.query_execution_id, timeout_seconds))
+            time.sleep(poll_seconds)
+            poll_seconds = min(poll_seconds * 2, config.ATHENA_POLL_MAX_SECONDS)
+        if self.state != self.SUCCEEDED:
+            raise AthenaQueryError('Athena query {id} {state}: {reason}'.format(
+                id=self.query_execution_id, state=self.state.lower(), reason=self.state_change_reason))
+        return self
+
+    @property
+    def columns(self):
+        '''(name, type) of each column of the result. Read from the first, one row
+        page of GetQueryResults; the rows themselves come from the output in S3.'''
+        if self._columns is None:
+            result_set = self.database.athena_connection().get_query_results(
+                QueryExecutionId=self.query_execution_id, MaxResults=1)['ResultSet']
+            self._columns = [(column['Name'], column['Type'].lower())
+                             for column in result_set['ResultSetMetadata']['ColumnInfo']]
+        return self._columns
+
+    def iter_rows(self):
+        '''Waits for the query, then yields its result rows as tuples of python values.
+        The CSV Athena wrote to S3 is read in ranges of config.ATHENA_RESULT_RANGE_BYTES,
+        config.ATHENA_RESULT_READ_CONCURRENCY at a time, and rows are yielded as soon
+        as the ranges before them are in.'''
+        self.wait()
+        converters = [_converter(column_type) for _, column_type in self.columns]
+        reader = csv.reader(lines(self.database.read_s3_ranges(self.output_location)))
+        next(reader, None)  # the header
+        for row in reader:
+            yield tuple(convert(value) for convert, value in zip(converters, row))
+
+
+class AthenaDatabase:
+    '''Runs queries on Athena against one of its databases (schemas).
+
+    `output_location` is the S3 path results are written to. Results are read straight
+    from the CSV Athena writes there, in parallel ranged reads, rather than paged
+    through GetQueryResults.
+
+    Results are cached for up to `cache_seconds` (default: config.ATHENA_CACHE_SECONDS,
+    0 turns caching off) by the query's normalized text. Give `source_paths`, the S3
+    prefixes of the tables a query reads, and the cache is also keyed on how fresh
+    those are, so a query is run again as soon as new data lands under any of them. A
+    cache hit reads the earlier result from S3 again and scans nothing.
+
+        >> athena = AthenaDatabase('data_lake', 's3://ye-bucket/athena-results/')
+        >> athena.fetch('select count(*) from events', source_paths=['s3://ye-bucket/lake/events/'])
+    '''
+
+    def __init__(self, database_name, output_location, cache_seconds=None):
+        self.database_name = database_name
+        self.output_location = output_location
+        self.cache_seconds = config.ATHENA_CACHE_SECONDS if cache_seconds is None else cache_seconds
+
+    def athena_connection(self):
+        return self._aws().athena_connection()
+
+    def s3_client(self):
+        return self._aws().s3_connection().meta.client
+
+    def submit(self, query, source_paths=None, use_cache=True):
+        '''Starts `query` and returns an AthenaQuery without waiting for it, or the
+        cached AthenaQuery of an earlier run whose result is still good.'''
+        cache_key = self._cache_key(query, source_paths) if use_cache and self.cache_seconds else None
+        cached_query = self._cached_query(cache_key)
+        if cached_query is not None:
+            return cached_query
+
+        execution_id = self.athena_connection().start_query_execution(
+            QueryString=query,
+            QueryExecutionContext={'Database': self.database_name},
+            ResultConfiguration={'OutputLocation': self.output_location}
+        )['QueryExecutionId']
+        athena_query = AthenaQuery(self, execution_id)
+        if cache_key is not None:
+            with _RESULT_CACHE_LOCK:
+                _RESULT_CACHE[cache_key] = (time.time(), athena_query)
+                while len(_RESULT_CACHE) > config.ATHENA_RESULT_CACHE_SIZE:
+                    _RESULT_CACHE.popitem(last=False)
+        return athena_query
+
+    def execute(self, query, timeout_seconds=None):
+        '''Runs a query, e.g. DDL, and waits for it to finish. Never cached.'''
+        return self.submit(query, use_cache=False).wait(timeout_seconds)
+
+    def iter_fetch(self, query, source_paths=None):
+        return self.submit(query, source_paths).iter_rows()
+
+    def fetch(self, query, source_paths=None):
+        return list(self.iter_fetch(query, source_paths))
+
+    def fetch_dataframe(self, query, source_paths=None):
+        import pandas as pd
+        athena_query = self.submit(query, source_paths)
+        rows = list(athena_query.iter_rows())
+        return pd.DataFrame.from_records(rows, columns=[name for name, _ in athena_query.columns])
+
+    def source_freshness(self, source_paths):
+        '''A fingerprint of every object under the given S3 prefixes, which changes
+        whenever one is added, removed or rewritten.'''
+        fingerprint = hashlib.sha256()
+        client = self.s3_client()
+        for source_path in sorted(source_paths):
+            bucket_name, prefix, _ = parse_s3_path(source_path)
+            for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+                for s3_object in page.get('Contents', []):
+                    fingerprint.update('{}\t{}\t{}\n'.format(
+                        s3_object['Key'], s3_object['ETag'], s3_object['LastModified'].isoformat()).encode('utf-8'))
+        return fingerprint.hexdigest()
+
+    def read_s3_ranges(self, s3_path):
+        '''Yields the bytes of an S3 object in order, reading ranges of it in parallel
+        while earlier ones are being consumed.'''
+        bucket_name, key_name, _ = parse_s3_path(s3_path)
+        client = self.s3_client()
+        size = client.head_object(Bucket=bucket_name, Key=key_name)['ContentLength']
+        range_bytes = config.ATHENA_RESULT_RANGE_BYTES
+
+        def read_range(start):
+            byte_range = 'bytes={}-{}'.format(start, min(start + range_bytes, size) - 1)
+            return client.get_object(Bucket=bucket_name, Key=key_name, Range=byte_range)['Body'].read()
+
+        starts = iter(range(0, size, range_bytes))
+        with ThreadPoolExecutor(config.ATHENA_RESULT_READ_CONCURRENCY) as executor:
+            # only a few ranges are read ahead, so big results never sit in memory whole
+            reads = deque(executor.submit(read_range, start)
+                          for _, start in zip(range(config.ATHENA_RESULT_READ_CONCURRENCY), starts))
+            while reads:
+                chunk = reads.popleft().result()
+                next_start = next(starts, None)
+                if next_start is not None:
+                    reads.append(executor.submit(read_range, next_start))
+                yield chunk
+
+    def _aws(self):
+        # polling makes many calls, so this database connects to AWS once rather than per call
+        if getattr(self, '_aws_connection', None) is None:
+            self._aws_connection = AWS()
+        return self._aws_connection
+
+    def _cache_key(self, query, source_paths):
+        freshness = self.source_freshness(source_paths) if source_paths else None
+        return (self.database_name, self.output_location, normalize_query(query), freshness)
+
+    def _cached_query(self, cache_key):
+        if cache_key is None:
+            return None
+        with _RESULT_CACHE_LOCK:
+            cached_at, athena_query = _RESULT_CACHE.get(cache_key, (None, None))
+            if athena_query is None:
+                return None
+            is_stale = time.time() - cached_at > self.cache_seconds
+            # a failed query is worth running again, and one still running is worth sharing
+            is_failed = athena_query.state in AthenaQuery.FINISHED_STATES and athena_query.state != AthenaQuery.SUCCEEDED
+            if is_stale or is_failed:
+                del _RESULT_CACHE[cache_key]
+                return None
+            _RESULT_CACHE.move_to_end(cache_key)
+            return athena_query
+
+
+def _converter(column_type):
+    '''How to read a value of the given Athena type from its CSV text. Athena writes
+    NULL as an empty field, so an empty field is None, except in string columns,
+    where it's read as an empty string.'''
+    base_type = column_type.split('(')[0]
+    if base_type in STRING_TYPES:
+        return str
+    if base_type in INTEGER_TYPES:
+        convert = int
+    elif base_type in FLOAT_TYPES:
+        convert = float
+    elif base_type == DECIMAL_TYPE:
+        convert = Decimal
+    elif base_type == BOOLEAN_TYPE:
+        convert = lambda value: value == 'true'
+    else:
+        convert = str
+    return lambda value: convert(value) if value != '' else None
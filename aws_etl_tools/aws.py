@@ -1,13 +1,49 @@
 import json
-from urllib.request import urlopen
-
-import boto3
-from botocore.exceptions import ClientError
-from botocore.utils import METADATA_SECURITY_CREDENTIALS_URL
+from threading import Lock, local
+import time
 
 from aws_etl_tools import config
 
 
+# building a boto3 client loads and parses the service's JSON models, so clients
+# are built once per service, region and set of credentials, then shared. clients
+# are thread safe; resources are not, so those are shared within a thread only.
+_SHARED_CLIENTS = {}
+_SHARED_CLIENTS_LOCK = Lock()
+_THREAD_LOCAL_RESOURCES = local()
+_pool_generation = 0
+
+# resolving credentials builds a boto3 session and probes S3, so what each way of
+# building `AWS()` resolved to is kept for config.AWS_CREDENTIALS_CACHE_SECONDS.
+_RESOLVED_CREDENTIALS = {}
+
+
+def clear_connection_pool():
+    '''Forget every pooled client and resource, in every thread, and every resolved credential.'''
+    global _pool_generation
+    with _SHARED_CLIENTS_LOCK:
+        _SHARED_CLIENTS.clear()
+        _RESOLVED_CREDENTIALS.clear()
+        _pool_generation += 1
+
+
+def _remember_credentials(resolution_key, credentials):
+    '''Caches freshly resolved credentials. If they replace different ones, those were
+    rotated, so the clients built for them are dropped and every thread's resources
+    are rebuilt.'''
+    global _pool_generation
+    with _SHARED_CLIENTS_LOCK:
+        previous = _RESOLVED_CREDENTIALS.get(resolution_key)
+        _RESOLVED_CREDENTIALS[resolution_key] = (credentials, time.time())
+        if previous is None or previous[0][:3] == credentials[:3]:
+            return
+        still_in_use = {resolved[:3] for resolved, _ in _RESOLVED_CREDENTIALS.values()}
+        if previous[0][:3] not in still_in_use:
+            for pool_key in [pool_key for pool_key in _SHARED_CLIENTS if pool_key[1:4] == previous[0][:3]]:
+                del _SHARED_CLIENTS[pool_key]
+        _pool_generation += 1
+
+
 class AWS:
     '''this class is wrapping the boto3 connection object with
         some extra attempts to make connecting as easy as possible.
@@ -24,6 +60,14 @@ class AWS:
     PUBLICLY_LISTABLE_S3_BUCKET = 'example-publicly-accessible'
 
     def __init__(self, **kwargs):
+        # boto3 and botocore are slow to import, so they're imported at first use
+        from botocore.exceptions import ClientError
+        resolution_key = self._resolution_key(**kwargs)
+        with _SHARED_CLIENTS_LOCK:
+            cached = _RESOLVED_CREDENTIALS.get(resolution_key)
+        if cached and time.time() - cached[1] < config.AWS_CREDENTIALS_CACHE_SECONDS:
+            self.key, self.secret, self.token, self.region_name = cached[0]
+            return
         try:
             self._connect_with_permanent_credentials(**kwargs)
             if config.S3_BASE_PATH:
@@ -33,6 +77,7 @@ class AWS:
             self.s3_connection().meta.client.head_bucket(Bucket=testable_bucket_name)
         except ClientError:
             self._connect_with_temporary_credentials()
+        _remember_credentials(resolution_key, (self.key, self.secret, self.token, self.region_name))
 
     def connection_string(self):
         aws_credential_string = 'aws_access_key_id=%s;aws_secret_access_key=%s' % (
@@ -42,27 +87,59 @@ class AWS:
         return aws_credential_string
 
     def s3_connection(self):
-        return boto3.resource('s3', aws_access_key_id=self.key,
-                                    aws_secret_access_key=self.secret,
-                                    aws_session_token=self.token)
+        return self._pooled_resource('s3')
 
     def comprehend_connection(self):
-        return boto3.client('comprehend', aws_access_key_id=self.key,
-                                    aws_secret_access_key=self.secret,
-                                    aws_session_token=self.token,
-                                    region_name=self.region_name)
+        return self._pooled_client('comprehend', region_name=self.region_name)
 
     def athena_connection(self):
-        return boto3.client('athena', aws_access_key_id=self.key,
-                                    aws_secret_access_key=self.secret,
-                                    aws_session_token=self.token,
-                                    region_name=self.region_name)
+        return self._pooled_client('athena', region_name=self.region_name)
+
+    def _resolution_key(self, **kwargs):
+        return (tuple(sorted(kwargs.items())), config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY,
+                config.AWS_SESSION_TOKEN, config.AWS_DEFAULT_REGION, config.S3_BASE_PATH)
+
+    def _pool_key(self, service_name, **kwargs):
+        return (service_name, self.key, self.secret, self.token) + tuple(sorted(kwargs.items()))
+
+    def _connection_arguments(self, **kwargs):
+        from botocore.config import Config
+        arguments = {
+            'aws_access_key_id': self.key,
+            'aws_secret_access_key': self.secret,
+            'aws_session_token': self.token,
+            'config': Config(max_pool_connections=config.AWS_MAX_POOL_CONNECTIONS)
+        }
+        arguments.update(kwargs)
+        return arguments
+
+    def _pooled_client(self, service_name, **kwargs):
+        import boto3
+        pool_key = self._pool_key(service_name, **kwargs)
+        # boto3's default session isn't thread safe, so build clients under the lock too
+        with _SHARED_CLIENTS_LOCK:
+            if pool_key not in _SHARED_CLIENTS:
+                _SHARED_CLIENTS[pool_key] = boto3.client(service_name, **self._connection_arguments(**kwargs))
+            return _SHARED_CLIENTS[pool_key]
+
+    def _pooled_resource(self, service_name, **kwargs):
+        import boto3
+        pool_key = self._pool_key(service_name, **kwargs)
+        if getattr(_THREAD_LOCAL_RESOURCES, 'generation', None) != _pool_generation:
+            _THREAD_LOCAL_RESOURCES.resources = {}
+            _THREAD_LOCAL_RESOURCES.generation = _pool_generation
+        resources = _THREAD_LOCAL_RESOURCES.resources
+        if pool_key not in resources:
+            with _SHARED_CLIENTS_LOCK:
+                resources[pool_key] = boto3.resource(service_name, **self._connection_arguments(**kwargs))
+        return resources[pool_key]
 
     def _connect_with_permanent_credentials(self, **kwargs):
         '''creates an aws session through boto using a set key and secret
             that is either passed in explicitly, set through environment
             variables in config, or set in a boto configuration file in the
             default location'''
+        import boto3
         possibly_valid_key = kwargs.get('aws_access_key_id', config.AWS_ACCESS_KEY_ID)
         possibly_valid_secret = kwargs.get('aws_secret_access_key', config.AWS_SECRET_ACCESS_KEY)
         possibly_valid_token = kwargs.get('aws_session_token', config.AWS_SESSION_TOKEN)
@@ -86,6 +163,8 @@ class AWS:
         self.region_name = config.AWS_DEFAULT_REGION
 
     def _request_temporary_credentials(self):
+        from urllib.request import urlopen
+        from botocore.utils import METADATA_SECURITY_CREDENTIALS_URL
         aws_iam_base_url = METADATA_SECURITY_CREDENTIALS_URL
         iam_role_name = urlopen(aws_iam_base_url).read().decode()
         aws_iam_creds_url = aws_iam_base_url + iam_role_name
@@ -0,0 +1,323 @@
+'''The `aws-etl-tools` command. `aws-etl-tools run jobs.json` runs every job in a spec
+in this one process, so they share database connection pools, AWS credentials and
+boto3 clients instead of each paying for its own imports and connections.
+
+A spec is JSON, or YAML if PyYAML is installed, like:
+
+    {
+        "s3_base_path": "s3://ye-bucket/etl",
+        "workers": 8,
+        "limits": {"warehouse": 2},
+        "databases": {
+            "warehouse": {
+                "class": "aws_etl_tools.redshift_database.RedshiftDatabase",
+                "credentials": {"database_name": "dw", "username": "etl", "password": "${DW_PASSWORD}",
+                                "host": "dw.example.com", "port": 5439}
+            },
+            "app": {"class": "my_project.databases.AppDatabase"}
+        },
+        "jobs": [
+            {"name": "users", "source": {"postgres_query": "SELECT * FROM users", "database": "app"},
+             "destination": {"database": "warehouse", "table": "public.users", "upsert_key": ["id"]}},
+            {"name": "events", "source": {"s3_path": "s3://ye-bucket/events/today.csv.gz"},
+             "destination": {"database": "warehouse", "table": "public.events", "upsert_key": ["event_id"]},
+             "options": {"gzip": true}, "depends_on": ["users"], "limits": ["warehouse"]}
+        ]
+    }
+
+Databases are built from an importable `class`, with `credentials` if given, where
+${VARIABLES} are read from the environment. A Redshift database can also have a `wlm`
+of keyword arguments for a WlmConcurrencyController, e.g. {"service_class": 6,
+"max_concurrency": 8}, which then paces the loads into it, and the UNLOADs of copies
+out of it, by how busy that WLM queue is. A copy holds a slot only while it UNLOADs
+or loads, never while waiting for another. A job's source is one of `s3_path`,
+`manifest`, `local_file`, `postgres_query` (with the `database` to run it on) or
+`copy` (a table or query on the RedshiftDatabase `database`, copied with `copy_to`,
+optionally with `key_column` and `key_ranges`). `options` go to the ingestion class.
+
+Jobs start once everything they `depends_on` has succeeded, and are skipped if any of
+it failed. At most `workers` (default: config.JOB_RUNNER_WORKERS) run at once, at most
+`limits[name]` of those that name a limit, and only one at a time loads any one table.
+'''
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from importlib import import_module
+import json
+import os
+import sys
+from threading import Lock
+import time
+import traceback
+
+from aws_etl_tools import config
+from aws_etl_tools.exceptions import JobSpecError
+
+
+SOURCE_TYPES = ('s3_path', 'manifest', 'local_file', 'postgres_query', 'copy')
+DEFAULT_DATABASE_CLASS = 'aws_etl_tools.redshift_database.RedshiftDatabase'
+
+
+class JobResult:
+
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, name):
+        self.name = name
+        self.status = None
+        self.error = None
+        self.started_at = None
+        self.elapsed_seconds = None
+
+    @property
+    def succeeded(self):
+        return self.status == self.SUCCEEDED
+
+    def __repr__(self):
+        return '<JobResult {name} {status} elapsed_seconds={elapsed}>'.format(
+            name=self.name, status=self.status, elapsed=self.elapsed_seconds)
+
+
+class JobRunner:
+    '''Runs the jobs of a spec, a dict shaped like the one described in this module,
+    on a pool of threads. `run` returns a JobResult for every job, in spec order.'''
+
+    def __init__(self, spec, workers=None):
+        self.spec = spec
+        self.workers = workers or spec.get('workers') or config.JOB_RUNNER_WORKERS
+        self.limits = dict(spec.get('limits', {}))
+        self.jobs = list(spec.get('jobs', []))
+        self.controllers = {}
+        self._databases = {}
+        self._lock = Lock()
+        self._validate()
+
+    def run(self):
+        if self.spec.get('s3_base_path'):
+            config.S3_BASE_PATH = self.spec['s3_base_path']
+        results = {job['name']: JobResult(job['name']) for job in self.jobs}
+        pending = list(self.jobs)
+        running = {}
+        in_use = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                pending_count = len(pending)
+                for job in list(pending):
+                    dependency_statuses = {results[name].status for name in job.get('depends_on', [])}
+                    if dependency_statuses & {JobResult.FAILED, JobResult.SKIPPED}:
+                        results[job['name']].status = JobResult.SKIPPED
+                        pending.remove(job)
+                    elif (dependency_statuses <= {JobResult.SUCCEEDED} and len(running) < self.workers and
+                          self._has_room(job, in_use)):
+                        for limit in self._job_limits(job):
+                            in_use[limit] = in_use.get(limit, 0) + 1
+                        running[executor.submit(self._run_job, job, results[job['name']])] = job
+                        pending.remove(job)
+                if not running and len(pending) == pending_count:
+                    # nothing is left to finish and free up room, so jobs ready to start
+                    # would wait forever, and the ones after them with them
+                    for job in list(pending):
+                        if all(results[name].succeeded for name in job.get('depends_on', [])):
+                            results[job['name']].status = JobResult.FAILED
+                            results[job['name']].error = JobSpecError(
+                                'job {!r} could never be scheduled'.format(job['name']))
+                            pending.remove(job)
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    for limit in self._job_limits(running.pop(future)):
+                        in_use[limit] -= 1
+        return [results[job['name']] for job in self.jobs]
+
+    def database(self, name):
+        '''The database named in the spec. Every job that names it shares the one
+        instance, and with it, its connection pool.'''
+        with self._lock:
+            return self._database(name)
+
+    def controller(self, name):
+        '''The WlmConcurrencyController for the database named in the spec, if it has a
+        `wlm`, shared by every job that names the database.'''
+        with self._lock:
+            wlm_spec = self.spec.get('databases', {}).get(name, {}).get('wlm')
+            if wlm_spec is None:
+                return None
+            if name not in self.controllers:
+                from aws_etl_tools.wlm import WlmConcurrencyController
+                self.controllers[name] = WlmConcurrencyController(self._database(name), **wlm_spec)
+            return self.controllers[name]
+
+    def _database(self, name):
+        if name not in self._databases:
+            database_spec = self.spec.get('databases', {}).get(name)
+            if database_spec is None:
+                raise JobSpecError('there is no database named {!r} in the spec'.format(name))
+            module_name, _, class_name = database_spec.get('class', DEFAULT_DATABASE_CLASS).rpartition('.')
+            database_class = getattr(import_module(module_name), class_name)
+            credentials = database_spec.get('credentials')
+            if credentials is None:
+                self._databases[name] = database_class()
+            else:
+                self._databases[name] = database_class({key: os.path.expandvars(value) if isinstance(value, str)
+                                                        else value for key, value in credentials.items()})
+        return self._databases[name]
+
+    def _run_job(self, job, result):
+        result.started_at = time.time()
+        try:
+            # copies take their slots in `copy_to`, one for each UNLOAD and load; one held here
+            # too could leave copies both ways between two databases waiting on each other
+            controller = None if 'copy' in job['source'] else self.controller(job['destination']['database'])
+            if controller is None:
+                self._load(job)
+            else:
+                with controller.slot():
+                    self._load(job)
+        except Exception as error:
+            result.status, result.error = JobResult.FAILED, error
+        else:
+            result.status = JobResult.SUCCEEDED
+        result.elapsed_seconds = time.time() - result.started_at
+        return result
+
+    def _load(self, job):
+        from aws_etl_tools.redshift_ingest import RedshiftTable, from_local_file, from_manifest, \
+            from_postgres_query, from_s3_path
+        destination_spec = job['destination']
+        destination = RedshiftTable(self.database(destination_spec['database']), destination_spec['table'],
+                                    tuple(destination_spec['upsert_key']))
+        source, options = job['source'], job.get('options', {})
+        if 's3_path' in source:
+            from_s3_path(source['s3_path'], destination, **options)
+        elif 'manifest' in source:
+            from_manifest(source['manifest'], destination, **options)
+        elif 'local_file' in source:
+            from_local_file(source['local_file'], destination, **options)
+        elif 'postgres_query' in source:
+            from_postgres_query(self.database(source['database']), source['postgres_query'], destination, **options)
+        else:
+            copy_results = self.database(source['database']).copy_to(
+                source['copy'], destination, key_column=source.get('key_column'),
+                key_ranges=[tuple(key_range) for key_range in source.get('key_ranges', [])],
+                concurrency=self.controller(source['database']),
+                load_concurrency=self.controller(destination_spec['database']), **options)
+            for copy_result in copy_results:
+                if not copy_result.succeeded:
+                    raise copy_result.error
+
+    def _job_limits(self, job):
+        destination = job['destination']
+        # loads into one table wait for each other rather than abort each other's transactions
+        table_limit = ('table', destination['database'], destination['table'])
+        return [table_limit] + [limit for limit in job.get('limits', []) if limit in self.limits]
+
+    def _has_room(self, job, in_use):
+        return all(in_use.get(limit, 0) < self.limits.get(limit, 1) for limit in self._job_limits(job))
+
+    def _validate(self):
+        names = [job.get('name') for job in self.jobs]
+        if None in names or len(set(names)) != len(names):
+            raise JobSpecError('every job needs a name of its own')
+        for limit, count in self.limits.items():
+            if not isinstance(count, int) or count < 1:
+                raise JobSpecError('limit {!r} needs to let at least 1 job run, not {!r}'.format(limit, count))
+        for job in self.jobs:
+            source_types = [source_type for source_type in SOURCE_TYPES if source_type in job.get('source', {})]
+            if len(source_types) != 1:
+                raise JobSpecError('job {!r} needs exactly one source, one of: {}'.format(
+                    job['name'], ', '.join(SOURCE_TYPES)))
+            missing = {'database', 'table', 'upsert_key'} - set(job.get('destination', {}))
+            if missing:
+                raise JobSpecError('the destination of job {!r} needs a {}'.format(
+                    job['name'], ', '.join(sorted(missing))))
+            unknown = set(job.get('depends_on', [])) - set(names)
+            if unknown:
+                raise JobSpecError('job {!r} depends on jobs that aren\'t in the spec: {}'.format(
+                    job['name'], ', '.join(sorted(unknown))))
+        self._check_for_cycles()
+
+    def _check_for_cycles(self):
+        dependencies = {job['name']: job.get('depends_on', []) for job in self.jobs}
+        finished = set()
+        for name in dependencies:
+            path, stack = [], [(name, iter(dependencies[name]))]
+            visiting = {name}
+            while stack:
+                current, remaining = stack[-1]
+                dependency = next(remaining, None)
+                if dependency is None:
+                    stack.pop()
+                    visiting.discard(current)
+                    finished.add(current)
+                elif dependency in visiting:
+                    path = [entry[0] for entry in stack] + [dependency]
+                    raise JobSpecError('jobs depend on each other in a cycle: {}'.format(' -> '.join(path)))
+                elif dependency not in finished:
+                    visiting.add(dependency)
+                    stack.append((dependency, iter(dependencies[dependency])))
+
+
+def load_spec(path):
+    '''Reads a spec from a JSON file, or from a YAML one if PyYAML is installed.'''
+    with open(path) as spec_file:
+        if not path.endswith(('.yaml', '.yml')):
+            return json.load(spec_file)
+        try:
+            import yaml
+        except ImportError:
+            raise JobSpecError('reading {} needs PyYAML, which is not installed; use JSON instead'.format(path))
+        return yaml.safe_load(spec_file)
+
+
+def summarize(results, elapsed_seconds, controllers=None):
+    '''A table of how every job went, then the totals, and where the WLM limit of each
+    database in `controllers`, a dict of them by name, ended up.'''
+    name_width = max([len('job')] + [len(result.name) for result in results])
+    lines = ['{:<{width}}  {:<9}  {:>8}'.format('job', 'status', 'seconds', width=name_width)]
+    for result in results:
+        seconds = '-' if result.elapsed_seconds is None else '{:.2f}'.format(result.elapsed_seconds)
+        lines.append('{:<{width}}  {:<9}  {:>8}'.format(result.name, result.status, seconds, width=name_width))
+    counts = ', '.join('{} {}'.format(sum(result.status == status for result in results), status)
+                       for status in (JobResult.SUCCEEDED, JobResult.FAILED, JobResult.SKIPPED))
+    lines.append('{counts} in {elapsed:.2f} seconds ({work:.2f} seconds of work)'.format(
+        counts=counts, elapsed=elapsed_seconds,
+        work=sum(result.elapsed_seconds or 0 for result in results)))
+    for name, controller in sorted((controllers or {}).items()):
+        stats = controller.stats()
+        lines.append('{name}: WLM limit {limit} after {increases} increases and {decreases} decreases, '
+                     '{wait:.2f} seconds waiting for a slot'.format(
+                         name=name, limit=stats['limit'], increases=stats['increases'],
+                         decreases=stats['decreases'], wait=stats['slot_wait_seconds']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='aws-etl-tools', description='Loads data into Redshift.')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='run every job in a JSON or YAML spec')
+    run_parser.add_argument('spec', help='the path of the spec')
+    run_parser.add_argument('--workers', type=int, help='how many jobs to run at once')
+    arguments = parser.parse_args(argv)
+    if arguments.command != 'run':
+        parser.print_help()
+        return 2
+
+    try:
+        runner = JobRunner(load_spec(arguments.spec), workers=arguments.workers)
+    except JobSpecError as error:
+        print('aws-etl-tools: {}'.format(error), file=sys.stderr)
+        return 2
+    start = time.time()
+    results = runner.run()
+    for result in results:
+        if result.error is not None:
+            print('job {} failed:'.format(result.name), file=sys.stderr)
+            traceback.print_exception(type(result.error), result.error, result.error.__traceback__)
+    print(summarize(results, time.time() - start, runner.controllers))
+    return 0 if all(result.succeeded for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from itertools import islice
+import json
+import random
+from threading import Lock
+import time
+
+from aws_etl_tools.aws import AWS
+from aws_etl_tools import config
+
+
+# errors Comprehend answers with when it's being called too often; worth waiting out
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'Throttling'}
+
+
+class Detection:
+    '''One kind of Comprehend analysis: the batch API that does it and how its
+    result for one document is flattened into columns.'''
+
+    def __init__(self, name, operation, result_key, column_names, to_columns, takes_language=True):
+        self.name = name
+        self.operation = operation
+        self.result_key = result_key
+        self.column_names = column_names
+        self.to_columns = to_columns
+        self.takes_language = takes_language
+
+
+def _sentiment_columns(result):
+    scores = result['SentimentScore']
+    return (result['Sentiment'], scores['Positive'], scores['Negative'], scores['Neutral'], scores['Mixed'])
+
+
+def _entity_columns(result):
+    return (json.dumps([{'text': entity['Text'], 'type': entity['Type'], 'score': entity['Score']}
+                        for entity in result['Entities']]),)
+
+
+def _key_phrase_columns(result):
+    return (json.dumps([{'text': key_phrase['Text'], 'score': key_phrase['Score']}
+                        for key_phrase in result['KeyPhrases']]),)
+
+
+def _dominant_language_columns(result):
+    language = max(result['Languages'], key=lambda language: language['Score'], default=None)
+    return (language['LanguageCode'], language['Score']) if language else (None, None)
+
+
+DETECTIONS = {detection.name: detection for detection in [
+    Detection('sentiment', 'batch_detect_sentiment', 'ResultList',
+              ('sentiment', 'sentiment_positive', 'sentiment_negative', 'sentiment_neutral', 'sentiment_mixed'),
+              _sentiment_columns),
+    Detection('entities', 'batch_detect_entities', 'ResultList', ('entities',), _entity_columns),
+    Detection('key_phrases', 'batch_detect_key_phrases', 'ResultList', ('key_phrases',), _key_phrase_columns),
+    Detection('dominant_language', 'batch_detect_dominant_language', 'ResultList',
+              ('dominant_language', 'dominant_language_score'), _dominant_language_columns, takes_language=False)
+]}
+
+
+def truncate_document(text, max_bytes=None):
+    '''The longest prefix of `text` that's at most `max_bytes` (default:
+    config.COMPREHEND_MAX_DOCUMENT_BYTES) when UTF-8 encoded, cut between characters.'''
+    max_bytes = max_bytes or config.COMPREHEND_MAX_DOCUMENT_BYTES
+    return text.encode('utf-8')[:max_bytes].decode('utf-8', 'ignore')
+
+
+class RateLimiter:
+    '''Spaces out calls shared by many threads to at most `calls_per_second`.'''
+
+    def __init__(self, calls_per_second):
+        self.interval_seconds = 1.0 / calls_per_second if calls_per_second else 0
+        self._lock = Lock()
+        self._next_call_at = 0
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            call_at = max(now, self._next_call_at)
+            self._next_call_at = call_at + self.interval_seconds
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+class ComprehendEnricher:
+    '''Runs Comprehend detections over a stream of documents, in batch calls.
+
+    Documents are truncated to config.COMPREHEND_MAX_DOCUMENT_BYTES and sent
+    config.COMPREHEND_BATCH_SIZE at a time to the BatchDetect* API of each of
+    `detections` (any of: sentiment, entities, key_phrases, dominant_language). Up to
+    `max_concurrency` (default: config.COMPREHEND_MAX_CONCURRENCY) batches are in flight
+    at once, spaced out to at most `calls_per_second` (default:
+    config.COMPREHEND_CALLS_PER_SECOND) calls between them. Throttled calls are retried
+    with jittered backoff up to config.COMPREHEND_MAX_RETRIES times.
+
+    Results are cached by a hash of the document, so repeated documents are only ever
+    sent once. `cache` can be any mapping, e.g. a `shelve`, to keep results between
+    runs; by default it's an in-memory cache of config.COMPREHEND_CACHE_SIZE documents.
+
+    Results line up with the input: a row goes in, the same row comes out with
+    `column_names` appended, so enriched rows can go straight to `from_in_memory`, and
+    enriched DataFrames to `from_dataframe`. Empty documents, and documents Comprehend
+    couldn't analyze, get None in every column; the latter are counted in
+    `failed_documents`.
+
+        enricher = ComprehendEnricher(detections=('sentiment', 'entities'))
+        from_in_memory(enricher.enrich_rows(reviews, text_column=2), destination)
+    '''
+
+    def __init__(self, detections=('sentiment',), language_code='en', max_concurrency=None,
+                 calls_per_second=None, cache=None):
+        unknown_detections = set(detections) - set(DETECTIONS)
+        if unknown_detections:
+            raise ValueError('unknown Comprehend detections: {}'.format(', '.join(sorted(unknown_detections))))
+        self.detections = [DETECTIONS[name] for name in detections]
+        self.language_code = language_code
+        self.max_concurrency = max_concurrency or config.COMPREHEND_MAX_CONCURRENCY
+        self.rate_limiter = RateLimiter(calls_per_second or config.COMPREHEND_CALLS_PER_SECOND)
+        self.cache = _LruCache(config.COMPREHEND_CACHE_SIZE) if cache is None else cache
+        self.calls_made = 0
+        self.failed_documents = 0
+        self._stats_lock = Lock()
+        self._comprehend = None
+
+    @property
+    def column_names(self):
+        return tuple(column_name for detection in self.detections for column_name in detection.column_names)
+
+    def enrich(self, documents):
+        '''Yields a tuple of `column_names` values for each document, in order.'''
+        documents = iter(documents)
+        # enough documents at a time to keep every worker busy with full batches
+        window_size = config.COMPREHEND_BATCH_SIZE * self.max_concurrency
+        with ThreadPoolExecutor(self.max_concurrency) as executor:
+            while True:
+                # anything but a non-empty string, like None or a DataFrame's NaN, isn't analyzed
+                window = [truncate_document(document) if isinstance(document, str) and document else None
+                          for document in islice(documents, window_size)]
+                if not window:
+                    return
+                for columns in self._enrich_window(window, executor):
+                    yield columns
+
+    def enrich_rows(self, rows, text_column):
+        '''Yields each row with `column_names` appended, analyzing the text at index
+        (or, for dict rows, key) `text_column`. Dict rows come back as dicts.'''
+        pending_rows = deque()
+
+        def documents():
+            for row in rows:
+                pending_rows.append(row)
+                yield row[text_column]
+
+        for columns in self.enrich(documents()):
+            row = pending_rows.popleft()
+            if isinstance(row, dict):
+                yield dict(row, **dict(zip(self.column_names, columns)))
+            else:
+                yield tuple(row) + columns
+
+    def enrich_dataframe(self, dataframe, text_column):
+        '''A copy of `dataframe` with a column added for each of `column_names`.'''
+        import pandas as pd
+        enrichments = list(self.enrich(dataframe[text_column].tolist()))
+        enriched_dataframe = dataframe.copy()
+        for index, column_name in enumerate(self.column_names):
+            # as objects, so missing enrichments stay None rather than becoming NaN
+            enriched_dataframe[column_name] = pd.Series([columns[index] for columns in enrichments],
+                                                        index=dataframe.index, dtype=object)
+        return enriched_dataframe
+
+    def _enrich_window(self, window, executor):
+        keys = [self._cache_key(document) if document else None for document in window]
+        results = {}
+        uncached_documents = OrderedDict()
+        for key, document in zip(keys, window):
+            if key is None or key in results or key in uncached_documents:
+                continue
+            cached_columns = self.cache.get(key)
+            if cached_columns is not None:
+                results[key] = tuple(cached_columns)
+            else:
+                uncached_documents[key] = document
+
+        uncached_keys = list(uncached_documents)
+        batches = [uncached_keys[start:start + config.COMPREHEND_BATCH_SIZE]
+                   for start in range(0, len(uncached_keys), config.COMPREHEND_BATCH_SIZE)]
+        calls = [(detection, batch) for batch in batches for detection in self.detections]
+        detected = {}
+        for (detection, batch), columns_by_key in zip(calls, executor.map(
+                lambda call: self._detect(call[0], [uncached_documents[key] for key in call[1]], call[1]), calls)):
+            for key, columns in columns_by_key.items():
+                detected.setdefault(key, {})[detection.name] = columns
+
+        empty_columns = tuple(None for _ in self.column_names)
+        for key in uncached_keys:
+            columns_by_detection = detected.get(key, {})
+            if len(columns_by_detection) == len(self.detections):
+                results[key] = tuple(column for detection in self.detections
+                                     for column in columns_by_detection[detection.name])
+                self.cache[key] = results[key]
+            else:
+                results[key] = empty_columns
+                with self._stats_lock:
+                    self.failed_documents += 1
+        return [results[key] if key is not None else empty_columns for key in keys]
+
+    def _detect(self, detection, documents, keys):
+        '''Columns for each document Comprehend could analyze, by cache key.'''
+        arguments = {'TextList': documents}
+        if detection.takes_language:
+            arguments['LanguageCode'] = self.language_code
+        response = self._call(detection.operation, arguments)
+        return {keys[result['Index']]: detection.to_columns(result) for result in response[detection.result_key]}
+
+    def _call(self, operation, arguments):
+        from botocore.exceptions import ClientError
+        comprehend = self._comprehend_connection()
+        attempt = 0
+        while True:
+            self.rate_limiter.wait()
+            with self._stats_lock:
+                self.calls_made += 1
+            try:
+                return getattr(comprehend, operation)(**arguments)
+            except ClientError as error:
+                is_throttled = error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+                if not is_throttled or attempt >= config.COMPREHEND_MAX_RETRIES:
+                    raise
+            attempt += 1
+            time.sleep(random.uniform(0, config.COMPREHEND_RETRY_BASE_SECONDS * 2 ** attempt))
+
+    def _comprehend_connection(self):
+        with self._stats_lock:
+            if self._comprehend is None:
+                self._comprehend = AWS().comprehend_connection()
+            return self._comprehend
+
+    def _cache_key(self, document):
+        detections = ','.join(detection.name for detection in self.detections)
+        key_text = '\t'.join([detections, self.language_code, document])
+        return hashlib.sha256(key_text.encode('utf-8')).hexdigest()
+
+
+class _LruCache:
+    '''A mapping that forgets its least recently used entries past `max_size`.'''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
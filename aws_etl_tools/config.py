@@ -13,6 +13,27 @@ S3_BASE_PATH = os.getenv(S3_BASE_PATH_ENV_VAR_KEY)
 REDSHIFT_INGEST_AUDIT_TABLE = os.getenv('AWS_ETL_TOOLS_REDSHIFT_INGEST_AUDIT_TABLE', 'public.v1_ingest_audit')
 LOCAL_TEMP_DIRECTORY = os.path.join(os.path.dirname(__file__), 'tmp')
 
+# how long an introspected target table schema is trusted before it's fetched again.
+TABLE_SCHEMA_CACHE_SECONDS = int(os.getenv('AWS_ETL_TOOLS_TABLE_SCHEMA_CACHE_SECONDS', 3600))
+
+# how many rows at a time are validated against the target schema before upload.
+VALIDATION_CHUNK_SIZE = int(os.getenv('AWS_ETL_TOOLS_VALIDATION_CHUNK_SIZE', 100000))
+
+# in-memory sources with at most this many rows skip S3 and COPY, and INSERT their rows
+# into the staging table this many at a time instead. set the threshold to 0 to always COPY.
+SMALL_PAYLOAD_ROW_THRESHOLD = int(os.getenv('AWS_ETL_TOOLS_SMALL_PAYLOAD_ROW_THRESHOLD', 1000))
+SMALL_PAYLOAD_INSERT_BATCH_SIZE = int(os.getenv('AWS_ETL_TOOLS_SMALL_PAYLOAD_INSERT_BATCH_SIZE', 500))
+
+# when an IngestBuffer flushes its rows as one upsert: at this many rows, this many
+# uncompressed bytes, or when its oldest row is this old. rows are spooled to gzipped
+# parts of up to INGEST_BUFFER_PART_BYTES uncompressed, and up to this many flushes
+# wait to be loaded before adding rows blocks.
+INGEST_BUFFER_MAX_ROWS = int(os.getenv('AWS_ETL_TOOLS_INGEST_BUFFER_MAX_ROWS', 1000000))
+INGEST_BUFFER_MAX_BYTES = int(os.getenv('AWS_ETL_TOOLS_INGEST_BUFFER_MAX_BYTES', 256 * 1024 * 1024))
+INGEST_BUFFER_MAX_AGE_SECONDS = int(os.getenv('AWS_ETL_TOOLS_INGEST_BUFFER_MAX_AGE_SECONDS', 300))
+INGEST_BUFFER_PART_BYTES = int(os.getenv('AWS_ETL_TOOLS_INGEST_BUFFER_PART_BYTES', 64 * 1024 * 1024))
+INGEST_BUFFER_MAX_PENDING_FLUSHES = int(os.getenv('AWS_ETL_TOOLS_INGEST_BUFFER_MAX_PENDING_FLUSHES', 2))
+
 
 # These default to None so the aws connection hierarchy will attempt
 # to look for a boto configuration file if they're not set.
@@ -23,7 +44,110 @@ AWS_SECRET_ACCESS_KEY = os.getenv('AWS_ETL_TOOLS_AWS_SECRET_ACCESS_KEY')
 AWS_SESSION_TOKEN = os.getenv('AWS_ETL_TOOLS_AWS_SESSION_TOKEN')
 AWS_DEFAULT_REGION = os.getenv('AWS_ETL_TOOLS_AWS_DEFAULT_REGION') or 'us-east-1'
 
-try:
-    from local_config import *
-except ImportError:
-    pass
+# how long credentials resolved by `AWS()`, and the S3 probe that picks between them
+# and the instance's IAM role, are reused before they're resolved again.
+AWS_CREDENTIALS_CACHE_SECONDS = int(os.getenv('AWS_ETL_TOOLS_AWS_CREDENTIALS_CACHE_SECONDS', 300))
+
+# the size of each pooled boto3 connection pool, which is also how many threads
+# a single S3 upload or download will use.
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_ETL_TOOLS_AWS_MAX_POOL_CONNECTIONS', 10))
+
+# the most connections a database will hold open in its pool, and the default
+# number of UNLOADs that `RedshiftDatabase.unload_many` runs at once.
+DATABASE_POOL_SIZE = int(os.getenv('AWS_ETL_TOOLS_DATABASE_POOL_SIZE', 10))
+UNLOAD_MAX_CONCURRENCY = int(os.getenv('AWS_ETL_TOOLS_UNLOAD_MAX_CONCURRENCY', 4))
+# an UNLOAD that's retried waits a random time of up to this many seconds, doubled
+# for each attempt so far, so retries don't all hit the cluster again at once.
+UNLOAD_RETRY_BASE_SECONDS = float(os.getenv('AWS_ETL_TOOLS_UNLOAD_RETRY_BASE_SECONDS', 1))
+
+# the MAXERROR of COPYs given a `load_class`, unless they set `max_errors` themselves.
+COPY_MAX_ERRORS_BY_LOAD_CLASS = {
+    'strict': 0,
+    'tolerant': 100,
+    'best_effort': 100000
+}
+
+# after an audited upsert, tables at least this percent unsorted are rebuilt with a deep
+# copy rather than VACUUMed. 0 always VACUUMs.
+TABLE_REBUILD_UNSORTED_PERCENT = int(os.getenv('AWS_ETL_TOOLS_TABLE_REBUILD_UNSORTED_PERCENT', 0))
+
+# how many tables an IngestCoordinator loads into at once. loads into the same table
+# are always run one after another.
+INGEST_COORDINATOR_MAX_WORKERS = int(os.getenv('AWS_ETL_TOOLS_INGEST_COORDINATOR_MAX_WORKERS', 4))
+
+# a WlmConcurrencyController samples its WLM queue (by default, the first user queue)
+# every this many seconds. it backs off once a query has waited in the queue longer than
+# this, and only lets more work in while this many of the queue's slots are still free.
+WLM_SERVICE_CLASS = int(os.getenv('AWS_ETL_TOOLS_WLM_SERVICE_CLASS', 6))
+WLM_SAMPLE_SECONDS = float(os.getenv('AWS_ETL_TOOLS_WLM_SAMPLE_SECONDS', 5))
+WLM_MAX_QUEUE_SECONDS = float(os.getenv('AWS_ETL_TOOLS_WLM_MAX_QUEUE_SECONDS', 1))
+WLM_RESERVED_SLOTS = int(os.getenv('AWS_ETL_TOOLS_WLM_RESERVED_SLOTS', 1))
+
+# rows are written out as CSV this many at a time. in-memory sequences of at least
+# CSV_ENCODING_SHARD_MIN_ROWS rows are split between this many processes, each writing
+# its own part; 1 always writes in this process.
+CSV_ENCODING_BATCH_ROWS = int(os.getenv('AWS_ETL_TOOLS_CSV_ENCODING_BATCH_ROWS', 10000))
+CSV_ENCODING_SHARD_MIN_ROWS = int(os.getenv('AWS_ETL_TOOLS_CSV_ENCODING_SHARD_MIN_ROWS', 1000000))
+CSV_ENCODING_PROCESSES = int(os.getenv('AWS_ETL_TOOLS_CSV_ENCODING_PROCESSES', os.cpu_count() or 1))
+
+# how many rows at a time are read from a server-side cursor when streaming results.
+FETCH_BATCH_SIZE = int(os.getenv('AWS_ETL_TOOLS_FETCH_BATCH_SIZE', 10000))
+
+# results of `fetch_dataframe` bigger than this are spooled to disk before they're parsed.
+FETCH_DATAFRAME_SPOOL_BYTES = int(os.getenv('AWS_ETL_TOOLS_FETCH_DATAFRAME_SPOOL_BYTES', 100 * 1024 * 1024))
+
+# Athena queries are polled every ATHENA_POLL_INITIAL_SECONDS at first, backing off to
+# every ATHENA_POLL_MAX_SECONDS. their results are read from S3 in ranges of this many
+# bytes, this many ranges at a time.
+ATHENA_POLL_INITIAL_SECONDS = float(os.getenv('AWS_ETL_TOOLS_ATHENA_POLL_INITIAL_SECONDS', 0.2))
+ATHENA_POLL_MAX_SECONDS = float(os.getenv('AWS_ETL_TOOLS_ATHENA_POLL_MAX_SECONDS', 5))
+ATHENA_RESULT_RANGE_BYTES = int(os.getenv('AWS_ETL_TOOLS_ATHENA_RESULT_RANGE_BYTES', 8 * 1024 * 1024))
+ATHENA_RESULT_READ_CONCURRENCY = int(os.getenv('AWS_ETL_TOOLS_ATHENA_RESULT_READ_CONCURRENCY', 8))
+
+# how long, and for up to how many distinct queries, Athena results are reused. 0 seconds
+# turns the cache off.
+ATHENA_CACHE_SECONDS = int(os.getenv('AWS_ETL_TOOLS_ATHENA_CACHE_SECONDS', 900))
+ATHENA_RESULT_CACHE_SIZE = int(os.getenv('AWS_ETL_TOOLS_ATHENA_RESULT_CACHE_SIZE', 256))
+
+# Comprehend batch calls take up to COMPREHEND_BATCH_SIZE documents of up to
+# COMPREHEND_MAX_DOCUMENT_BYTES each; longer documents are truncated. a ComprehendEnricher
+# makes up to this many calls at once and this many per second, retries throttled calls
+# this many times, and by default remembers the results of this many documents.
+COMPREHEND_BATCH_SIZE = int(os.getenv('AWS_ETL_TOOLS_COMPREHEND_BATCH_SIZE', 25))
+COMPREHEND_MAX_DOCUMENT_BYTES = int(os.getenv('AWS_ETL_TOOLS_COMPREHEND_MAX_DOCUMENT_BYTES', 5000))
+COMPREHEND_MAX_CONCURRENCY = int(os.getenv('AWS_ETL_TOOLS_COMPREHEND_MAX_CONCURRENCY', 4))
+COMPREHEND_CALLS_PER_SECOND = float(os.getenv('AWS_ETL_TOOLS_COMPREHEND_CALLS_PER_SECOND', 10))
+COMPREHEND_MAX_RETRIES = int(os.getenv('AWS_ETL_TOOLS_COMPREHEND_MAX_RETRIES', 5))
+COMPREHEND_RETRY_BASE_SECONDS = float(os.getenv('AWS_ETL_TOOLS_COMPREHEND_RETRY_BASE_SECONDS', 0.5))
+COMPREHEND_CACHE_SIZE = int(os.getenv('AWS_ETL_TOOLS_COMPREHEND_CACHE_SIZE', 100000))
+
+# how many items can wait between two stages of a Pipeline, and how many workers a
+# Pipeline.to_redshift uses to write CSV parts and to upload them.
+PIPELINE_QUEUE_SIZE = int(os.getenv('AWS_ETL_TOOLS_PIPELINE_QUEUE_SIZE', 4))
+PIPELINE_SERIALIZER_WORKERS = int(os.getenv('AWS_ETL_TOOLS_PIPELINE_SERIALIZER_WORKERS', 2))
+PIPELINE_UPLOAD_WORKERS = int(os.getenv('AWS_ETL_TOOLS_PIPELINE_UPLOAD_WORKERS', 4))
+
+# where `from_snapshot` keeps its index of the rows already loaded into each table, and
+# how many rows of a snapshot are looked up in it at a time.
+CHANGE_INDEX_DIRECTORY = os.getenv('AWS_ETL_TOOLS_CHANGE_INDEX_DIRECTORY',
+                                   os.path.join(LOCAL_TEMP_DIRECTORY, 'change_indexes'))
+CHANGE_INDEX_BATCH_SIZE = int(os.getenv('AWS_ETL_TOOLS_CHANGE_INDEX_BATCH_SIZE', 10000))
+
+# where resumable loads keep the checkpoint of their progress, and the parts their
+# local files are split into for a multipart upload. S3 needs parts of at least 5 MB.
+CHECKPOINT_DIRECTORY = os.getenv('AWS_ETL_TOOLS_CHECKPOINT_DIRECTORY',
+                                 os.path.join(LOCAL_TEMP_DIRECTORY, 'checkpoints'))
+RESUMABLE_UPLOAD_PART_BYTES = int(os.getenv('AWS_ETL_TOOLS_RESUMABLE_UPLOAD_PART_BYTES', 64 * 1024 * 1024))
+
+# how many jobs `aws-etl-tools run` runs at once when its spec doesn't say
+JOB_RUNNER_WORKERS = int(os.getenv('AWS_ETL_TOOLS_JOB_RUNNER_WORKERS', 4))
+
+# short-lived processes that are configured entirely through the environment can set
+# AWS_ETL_TOOLS_FAST_START to skip searching the python path for a local_config module.
+FAST_START = os.getenv('AWS_ETL_TOOLS_FAST_START', '').lower() in ('1', 'true', 'yes')
+
+if not FAST_START:
+    try:
+        from local_config import *
+    except ImportError:
+        pass
@@ -0,0 +1,109 @@
+import csv
+from collections.abc import Sequence
+from itertools import chain, islice
+import json
+import multiprocessing
+import os
+import shutil
+from threading import Lock
+
+from aws_etl_tools import config
+
+
+# values whose str() isn't what COPY expects, and how to write them instead
+FORMATTERS = {
+    bool: lambda value: 'true' if value else 'false',
+    dict: json.dumps,
+    list: json.dumps
+}
+
+# the rows being split across a forked process pool, which the workers inherit
+# rather than having each shard pickled over to them
+_SHARDED_ROWS = None
+_SHARDING_LOCK = Lock()
+
+
+def format_row(row):
+    return [FORMATTERS[type(value)](value) if type(value) in FORMATTERS else value for value in row]
+
+
+def write_rows(csv_file, rows):
+    '''Writes an iterable of iterables to an open text file as CSV, and returns how
+    many rows were written. Rows go to `writerows` config.CSV_ENCODING_BATCH_ROWS at a
+    time, so the csv module turns values into text in C: None as an empty field, which
+    COPY loads as NULL, and anything else as its str(), which is already what COPY
+    expects for numbers, Decimals, and dates and datetimes (ISO 8601). Only batches
+    holding values whose str() isn't, like booleans and dicts, are run through
+    FORMATTERS in python first.'''
+    writer = csv.writer(csv_file)
+    rows = iter(rows)
+    row_count = 0
+    while True:
+        batch = list(islice(rows, config.CSV_ENCODING_BATCH_ROWS))
+        if not batch:
+            return row_count
+        if not FORMATTERS.keys().isdisjoint(map(type, chain.from_iterable(batch))):
+            batch = [format_row(row) for row in batch]
+        writer.writerows(batch)
+        row_count += len(batch)
+
+
+def write_csv(rows, local_path, processes=None):
+    '''Writes `rows` to a CSV at `local_path`, in parallel parts that are then joined
+    together if `rows` is a sequence big enough to be worth sharding.'''
+    if not _is_worth_sharding(rows, processes):
+        _write_part(local_path, rows)
+        return
+    part_paths = write_csv_parts(rows, local_path, processes)
+    with open(local_path, 'wb') as csv_file:
+        for part_path in part_paths:
+            with open(part_path, 'rb') as part:
+                shutil.copyfileobj(part, csv_file)
+            os.remove(part_path)
+
+
+def write_csv_parts(rows, local_path_prefix, processes=None):
+    '''Writes `rows` to one or more CSV files starting with `local_path_prefix`, and
+    returns their paths in order. A sequence of at least
+    config.CSV_ENCODING_SHARD_MIN_ROWS rows is split into one part for each of up to
+    `processes` (default: config.CSV_ENCODING_PROCESSES) worker processes, which write
+    them all at once. Anything else is written to a single part.'''
+    if not _is_worth_sharding(rows, processes):
+        part_path = local_path_prefix + '_0.csv'
+        _write_part(part_path, rows)
+        return [part_path]
+
+    processes = processes or config.CSV_ENCODING_PROCESSES
+    shard_size = -(-len(rows) // processes)
+    shards = [(start, min(start + shard_size, len(rows))) for start in range(0, len(rows), shard_size)]
+    part_paths = ['{prefix}_{part}.csv'.format(prefix=local_path_prefix, part=part) for part in range(len(shards))]
+    global _SHARDED_ROWS
+    if 'fork' in multiprocessing.get_all_start_methods():
+        with _SHARDING_LOCK:
+            _SHARDED_ROWS = rows
+            try:
+                with multiprocessing.get_context('fork').Pool(len(shards)) as pool:
+                    pool.starmap(_write_inherited_shard, [(part_path, start, end)
+                                                          for part_path, (start, end) in zip(part_paths, shards)])
+            finally:
+                _SHARDED_ROWS = None
+    else:
+        with multiprocessing.Pool(len(shards)) as pool:
+            pool.starmap(_write_part, [(part_path, rows[start:end])
+                                       for part_path, (start, end) in zip(part_paths, shards)])
+    return part_paths
+
+
+def _is_worth_sharding(rows, processes):
+    processes = processes or config.CSV_ENCODING_PROCESSES
+    return (processes > 1 and isinstance(rows, Sequence) and
+            len(rows) >= max(config.CSV_ENCODING_SHARD_MIN_ROWS, processes))
+
+
+def _write_part(part_path, rows):
+    with open(part_path, 'w', encoding='utf-8', newline='') as part:
+        write_rows(part, rows)
+
+
+def _write_inherited_shard(part_path, start, end):
+    _write_part(part_path, _SHARDED_ROWS[start:end])
@@ -11,3 +11,29 @@ class NoDataFoundError(BaseAwsEtlToolsError):
 class NoS3BasePathError(BaseAwsEtlToolsError):
     def __init__(self, message):
         super().__init__(message)
+
+
+class SchemaMismatchError(BaseAwsEtlToolsError):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class DataValidationError(BaseAwsEtlToolsError):
+    def __init__(self, message, report):
+        super().__init__(message)
+        self.report = report
+
+
+class AthenaQueryError(BaseAwsEtlToolsError):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class PipelineCancelledError(BaseAwsEtlToolsError):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class JobSpecError(BaseAwsEtlToolsError):
+    def __init__(self, message):
+        super().__init__(message)
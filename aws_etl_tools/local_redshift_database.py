@@ -0,0 +1,281 @@
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from datetime import datetime
+import gzip
+import json
+import os
+import re
+from threading import Lock
+import time
+from uuid import uuid4 as uuid
+
+from aws_etl_tools.aws import AWS
+from aws_etl_tools import config
+from aws_etl_tools.redshift_database import RedshiftDatabase
+from aws_etl_tools.redshift_ingest.ingestors import AuditedUpsert
+from aws_etl_tools.s3_file import download_from_s3_to_local_file, parse_s3_path
+
+
+# just enough of Redshift's system tables for audits and load profiles to work
+SYSTEM_TABLES = {
+    'stl_load_commits': """
+        query integer, slice integer, name varchar(256), filename varchar(256), byte_offset integer,
+        lines_scanned integer, errors integer, curtime timestamp, status integer""",
+    'stl_load_errors': """
+        query integer, slice integer, filename varchar(256), line_number bigint, colname varchar(127),
+        type varchar(10), col_length varchar(10), position integer, raw_line varchar(1024),
+        raw_field_value varchar(1024), err_code integer, err_reason varchar(100)""",
+    'stl_file_scan': """
+        query integer, slice integer, name varchar(256), lines bigint, bytes bigint, loadtime bigint,
+        curtime timestamp""",
+    'stl_wlm_query': """
+        query integer, service_class integer, total_queue_time bigint, total_exec_time bigint""",
+    'stl_query': """
+        query integer, xid bigint, querytxt varchar(4000), starttime timestamp, endtime timestamp"""
+}
+QUERY_ID_SEQUENCE = 'local_redshift_query_ids'
+# the service class of a default WLM queue
+DEFAULT_SERVICE_CLASS = 6
+_SYSTEM_TABLES_LOCK = Lock()
+_JSON_PATH_ELEMENT = re.compile(r"""\.([^.\[]+)|\[\s*'([^']*)'\s*\]|\[\s*"([^"]*)"\s*\]|\[\s*(\d+)\s*\]""")
+
+
+class AuditedUpsertToLocalRedshift(AuditedUpsert):
+    '''Does what Redshift's COPY from S3 would: finds the files named by the s3 path
+    (every key with that prefix) or by the manifest, fetches them in parallel, unzips or
+    flattens JSON as the COPY options say, and loads them all into the staging table
+    within the upsert transaction. Then it records the COPY in the STL stand-ins.'''
+
+    def ingest(self):
+        if self.rows is not None:
+            return super().ingest()
+        self._upsert_query_id = self._copy_from_s3()
+        self.load_profile = self._profile_load()
+        self.ingest_results = self._fetch_ingest_results()
+
+    def _copy_from_s3(self):
+        cursor = self.database.make_new_cursor()
+        try:
+            self._create_system_tables(cursor)
+            query_id = self._next_query_id(cursor)
+            loaded_files = self._fetch_files()
+            try:
+                steps = self._run_transaction(cursor, loaded_files)
+                self._record_load(cursor, query_id, loaded_files, steps)
+            finally:
+                for loaded_file in loaded_files:
+                    os.remove(loaded_file['local_path'])
+        finally:
+            cursor.connection.close()
+        return query_id
+
+    def _run_transaction(self, cursor, loaded_files):
+        '''Returns the (statement, started_at, ended_at) of the COPY, DELETE and INSERT.'''
+        copy_statement = 'COPY {staging_table}{column_list} FROM STDIN CSV'.format(
+            staging_table=self.staging_table,
+            column_list=' (%s)' % self._column_list() if self.column_names else ''
+        )
+        cursor.execute('BEGIN TRANSACTION;\n' + self._create_staging_statement())
+        cursor.execute('SELECT txid_current()')
+        self._transaction_id = cursor.fetchone()[0]
+
+        copy_started_at = datetime.utcnow()
+        for loaded_file in loaded_files:
+            start = time.time()
+            with open(loaded_file['local_path'], 'rb') as local_file:
+                cursor.copy_expert(copy_statement, local_file)
+            loaded_file['load_seconds'] += time.time() - start
+        copy_text = "COPY {staging_table} FROM '{s3_path}'".format(staging_table=self.staging_table,
+                                                                     s3_path=self.file_path)
+        steps = [(copy_text, copy_started_at, datetime.utcnow())]
+
+        range_statement = self._staged_range_statement(cursor)
+        prune_unchanged_statement = self._prune_unchanged_statement(range_statement)
+        if prune_unchanged_statement:
+            cursor.execute(prune_unchanged_statement)
+
+        delete_started_at = datetime.utcnow()
+        cursor.execute(self._delete_statement(range_statement))
+        steps.append(('DELETE FROM ' + self.target_table, delete_started_at, datetime.utcnow()))
+
+        insert_started_at = datetime.utcnow()
+        cursor.execute(self._insert_statement())
+        steps.append(('INSERT INTO ' + self.target_table, insert_started_at, datetime.utcnow()))
+
+        cursor.execute('DROP TABLE {staging_table};\nEND TRANSACTION;'.format(staging_table=self.staging_table))
+        return steps
+
+    def _fetch_files(self):
+        '''Downloads and decodes every file of the COPY, in parallel, into local CSVs.'''
+        entries = self._manifest_entries() if self.with_manifest else self._prefix_entries()
+        jsonpaths = self._jsonpaths()
+        with ThreadPoolExecutor(max_workers=config.AWS_MAX_POOL_CONNECTIONS) as executor:
+            fetched_files = list(executor.map(lambda entry: self._fetch_file(entry, jsonpaths), entries))
+        return [fetched_file for fetched_file in fetched_files if fetched_file is not None]
+
+    def _fetch_file(self, entry, jsonpaths):
+        from botocore.exceptions import ClientError
+        start = time.time()
+        download_path = os.path.join(config.LOCAL_TEMP_DIRECTORY, 'local_redshift_{}'.format(uuid().hex))
+        try:
+            download_from_s3_to_local_file(entry['url'], download_path)
+        except ClientError:
+            if entry.get('mandatory', False):
+                raise
+            return None
+        try:
+            with self._open_download(download_path) as downloaded_file:
+                raw_bytes = downloaded_file.read()
+        finally:
+            os.remove(download_path)
+
+        local_path = download_path + '.csv'
+        with open(local_path, 'w', newline='') as local_file:
+            if jsonpaths is None:
+                local_file.write(raw_bytes.decode('utf-8'))
+                lines = raw_bytes.count(b'\n') + (0 if raw_bytes.endswith(b'\n') or not raw_bytes else 1)
+            else:
+                writer = csv.writer(local_file)
+                lines = 0
+                for record in _json_records(raw_bytes.decode('utf-8')):
+                    writer.writerow(self._json_row(record, jsonpaths))
+                    lines += 1
+        return {
+            'url': entry['url'],
+            'local_path': local_path,
+            'bytes': len(raw_bytes),
+            'lines': lines,
+            'load_seconds': time.time() - start
+        }
+
+    def _open_download(self, download_path):
+        return gzip.open(download_path, 'rb') if self.gzip else open(download_path, 'rb')
+
+    def _manifest_entries(self):
+        bucket_name, key_name, _ = parse_s3_path(self.file_path)
+        manifest = AWS().s3_connection().Object(bucket_name, key_name).get()['Body'].read()
+        return json.loads(manifest.decode('utf-8'))['entries']
+
+    def _prefix_entries(self):
+        '''Like Redshift, a COPY from an s3 path loads every key that starts with it.'''
+        bucket_name, prefix, _ = parse_s3_path(self.file_path)
+        bucket = AWS().s3_connection().Bucket(bucket_name)
+        return [{'url': 's3://{}/{}'.format(bucket_name, s3_object.key), 'mandatory': True}
+                for s3_object in sorted(bucket.objects.filter(Prefix=prefix), key=lambda s3_object: s3_object.key)
+                if not s3_object.key.endswith('/')]
+
+    def _jsonpaths(self):
+        '''None for CSV loads, 'auto' to match JSON keys to column names, or else the
+        list of JSONPath expressions in the jsonpaths file, one per column.'''
+        if not self.jsonpaths:
+            return None
+        if self.jsonpaths == 'auto':
+            return 'auto'
+        bucket_name, key_name, _ = parse_s3_path(self.jsonpaths)
+        jsonpaths_file = AWS().s3_connection().Object(bucket_name, key_name).get()['Body'].read()
+        return json.loads(jsonpaths_file.decode('utf-8'))['jsonpaths']
+
+    def _json_row(self, record, jsonpaths):
+        if jsonpaths == 'auto':
+            record = {str(key).lower(): value for key, value in record.items()}
+            return [_csv_value(record.get(column_name.lower())) for column_name in self.column_names]
+        return [_csv_value(_json_path_value(record, jsonpath)) for jsonpath in jsonpaths]
+
+    @staticmethod
+    def _create_system_tables(cursor):
+        # IF NOT EXISTS can still collide with the same CREATE running concurrently
+        with _SYSTEM_TABLES_LOCK:
+            for table_name, columns in sorted(SYSTEM_TABLES.items()):
+                cursor.execute('CREATE TABLE IF NOT EXISTS {table_name} ({columns})'.format(
+                    table_name=table_name, columns=columns))
+            cursor.execute('CREATE SEQUENCE IF NOT EXISTS {}'.format(QUERY_ID_SEQUENCE))
+
+    @staticmethod
+    def _next_query_id(cursor):
+        cursor.execute("SELECT nextval('{}')".format(QUERY_ID_SEQUENCE))
+        return cursor.fetchone()[0]
+
+    def _record_load(self, cursor, query_id, loaded_files, steps):
+        loaded_at = datetime.utcnow()
+        for slice_number, loaded_file in enumerate(loaded_files):
+            cursor.execute("""
+                INSERT INTO stl_load_commits (query, slice, name, filename, byte_offset, lines_scanned, errors,
+                                              curtime, status)
+                VALUES (%(query)s, %(slice)s, %(url)s, %(url)s, 0, %(lines)s, 0, %(loaded_at)s, 1);
+                INSERT INTO stl_file_scan (query, slice, name, lines, bytes, loadtime, curtime)
+                VALUES (%(query)s, %(slice)s, %(url)s, %(lines)s, %(bytes)s, %(load_microseconds)s, %(loaded_at)s);
+                """, {
+                    'query': query_id,
+                    'slice': slice_number,
+                    'url': loaded_file['url'],
+                    'lines': loaded_file['lines'],
+                    'bytes': loaded_file['bytes'],
+                    'load_microseconds': int(loaded_file['load_seconds'] * 1000000),
+                    'loaded_at': loaded_at
+                })
+
+        copy_text, copy_started_at, copy_ended_at = steps[0]
+        cursor.execute("""
+            INSERT INTO stl_wlm_query (query, service_class, total_queue_time, total_exec_time)
+            VALUES (%(query)s, %(service_class)s, 0, %(execution_microseconds)s)
+            """, {
+                'query': query_id,
+                'service_class': DEFAULT_SERVICE_CLASS,
+                'execution_microseconds': int((copy_ended_at - copy_started_at).total_seconds() * 1000000)
+            })
+        for step_number, (query_text, started_at, ended_at) in enumerate(steps):
+            cursor.execute("""
+                INSERT INTO stl_query (query, xid, querytxt, starttime, endtime)
+                VALUES (%(query)s, %(xid)s, %(query_text)s, %(started_at)s, %(ended_at)s)
+                """, {
+                    # the COPY is the load's query; the other steps get ids of their own
+                    'query': query_id if step_number == 0 else self._next_query_id(cursor),
+                    'xid': self._transaction_id,
+                    'query_text': query_text[:4000],
+                    'started_at': started_at,
+                    'ended_at': ended_at
+                })
+
+
+class LocalRedshiftDatabase(RedshiftDatabase):
+    '''A Postgres database that passes for Redshift well enough to test and benchmark
+    loads without a cluster. Its ingestion class, AuditedUpsertToLocalRedshift, reads
+    COPYs from S3 (usually moto's) with manifests, gzip and JSON, and fills in stand-ins
+    for the STL tables that auditing and load profiles read.
+
+    Subclass it with credentials, as with RedshiftDatabase, or set
+    `ingestion_class = AuditedUpsertToLocalRedshift` on a database class of your own.'''
+
+    ingestion_class = AuditedUpsertToLocalRedshift
+
+
+def _json_records(text):
+    '''The JSON objects of a COPY file, which may be separated by any whitespace.'''
+    decoder = json.JSONDecoder()
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position == len(text):
+            return
+        record, position = decoder.raw_decode(text, position)
+        yield record
+
+
+def _json_path_value(record, jsonpath):
+    '''Supports the JSONPath that Redshift does: `$` followed by .names, ['names'] and [indexes].'''
+    value = record
+    for name, single_quoted, double_quoted, index in _JSON_PATH_ELEMENT.findall(jsonpath.strip()[1:]):
+        try:
+            value = value[int(index)] if index else value[name or single_quoted or double_quoted]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return value
+
+
+def _csv_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
@@ -0,0 +1,370 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import gzip
+import os
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+import time
+from uuid import uuid4 as uuid
+import zlib
+
+from aws_etl_tools.aws import AWS
+from aws_etl_tools import config
+from aws_etl_tools.csv_encoding import write_rows
+from aws_etl_tools.exceptions import PipelineCancelledError
+from aws_etl_tools.redshift_ingest.sources import from_manifest
+from aws_etl_tools.redshift_ingest.transient_paths import transient_s3_path
+from aws_etl_tools.s3_file import S3File, lines, parse_s3_path
+
+
+_DONE = object()
+# how often a worker blocked on a queue checks whether the pipeline has been cancelled
+_QUEUE_POLL_SECONDS = 0.1
+_S3_READ_BYTES = 1024 * 1024
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class StageStats:
+    '''How much went through a stage, and where its time went. Time spent waiting on
+    input means the stages upstream are the bottleneck; time spent waiting for room in
+    the output queue means the stages downstream are.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_seconds = 0.0
+        self.input_wait_seconds = 0.0
+        self.output_wait_seconds = 0.0
+        self.started_at = None
+        self.finished_at = None
+        self._lock = Lock()
+
+    @property
+    def elapsed_seconds(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def items_per_second(self):
+        return self.items_out / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+    def add(self, **increments):
+        with self._lock:
+            for name, increment in increments.items():
+                setattr(self, name, getattr(self, name) + increment)
+
+    def __repr__(self):
+        return '<StageStats {name} in={items_in} out={items_out} busy={busy:.2f}s input_wait={input_wait:.2f}s ' \
+               'output_wait={output_wait:.2f}s>'.format(
+                   name=self.name, items_in=self.items_in, items_out=self.items_out, busy=self.busy_seconds,
+                   input_wait=self.input_wait_seconds, output_wait=self.output_wait_seconds)
+
+
+class Stage:
+    '''One step of a Pipeline. `function` is called with each item that comes out of the
+    step before and returns an iterable, often by being a generator, of the items to
+    pass on to the next; it can pass on none, one or many. If it has a `finish` method,
+    that's called once all its input has been handled, and what it returns is passed on
+    too, which is how a stage that accumulates items hands over the remainder.
+
+    The stage runs on `workers` threads, or with `processes`, on a pool of that many
+    processes, for CPU-bound work like compression. A process stage's function and its
+    items must be picklable, and the function can't `finish`.'''
+
+    def __init__(self, function, workers=1, processes=False, name=None):
+        self.function = function
+        self.workers = workers
+        self.processes = processes
+        self.name = name or getattr(function, '__name__', type(function).__name__)
+
+
+class Pipeline:
+    '''Runs a `source` and a chain of stages at the same time, each handing items to
+    the next through a queue of at most `queue_size` (default: config.PIPELINE_QUEUE_SIZE)
+    items. When a stage falls behind, the queue in front of it fills up and everything
+    upstream waits, so memory stays bounded however big the job.
+
+    The source is an iterable, e.g. `database.fetch_batches(query)` or `s3_csv_batches`.
+    Stages are Stages or plain functions, which run as single threaded Stages.
+
+    `run` blocks until everything has gone through, and returns whatever came out of
+    the last stage. If any stage raises, the rest are cancelled and the error is raised
+    from `run`. Calling `cancel` from another thread stops every stage at the next item
+    and makes `run` raise PipelineCancelledError. Either way, `stats` has a StageStats
+    for the source and each stage.
+
+        >> Pipeline.to_redshift(source_db.fetch_batches('select * from events'), destination,
+        ..                      transforms=[drop_test_events]).run()
+    '''
+
+    def __init__(self, source, *stages, queue_size=None):
+        self.source = source
+        self.stages = [stage if isinstance(stage, Stage) else Stage(stage) for stage in stages]
+        self.queue_size = queue_size or config.PIPELINE_QUEUE_SIZE
+        self.stats = [StageStats('source')] + [StageStats(stage.name) for stage in self.stages]
+        self._cancelled = Event()
+        self._error = None
+        self._lock = Lock()
+
+    @classmethod
+    def to_redshift(cls, source, destination, transforms=(), serializer_workers=None, serializer_processes=False,
+                    upload_workers=None, parts_per_load=None, queue_size=None, **ingestion_args):
+        '''A pipeline that upserts batches of rows from `source` into `destination`.
+        Each batch goes through the `transforms`, functions of a batch that return or
+        yield batches, then is written to a gzipped CSV part, uploaded to S3, and COPYed
+        in with the other parts, `parts_per_load` at a time or all at once at the end.'''
+        stages = [Stage(transform) for transform in transforms]
+        stages.extend([
+            Stage(CsvPartWriter(), serializer_workers or config.PIPELINE_SERIALIZER_WORKERS,
+                  processes=serializer_processes),
+            Stage(S3PartUploader(transient_s3_path(destination)), upload_workers or config.PIPELINE_UPLOAD_WORKERS),
+            Stage(RedshiftCommitter(destination, parts_per_load, **ingestion_args))
+        ])
+        return cls(source, *stages, queue_size=queue_size)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def run(self):
+        queues = [Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [Thread(target=self._run_source, args=(queues[0], self._consumer_count(0)), daemon=True)]
+        for index, stage in enumerate(self.stages):
+            stage_stats = self.stats[index + 1]
+            workers = 1 if stage.processes else stage.workers
+            finished_workers = [0]
+            for _ in range(workers):
+                threads.append(Thread(target=self._run_stage, daemon=True, args=(
+                    stage, stage_stats, queues[index], queues[index + 1], workers, finished_workers,
+                    self._consumer_count(index + 1))))
+        for thread in threads:
+            thread.start()
+
+        results = []
+        try:
+            for item in self._items(queues[-1]):
+                results.append(item)
+        except _Cancelled:
+            pass
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+        if self._cancelled.is_set():
+            raise PipelineCancelledError('the pipeline was cancelled')
+        return results
+
+    def _consumer_count(self, queue_index):
+        '''How many workers read from a queue, each of which needs to be told it's done.'''
+        if queue_index == len(self.stages):
+            return 1
+        stage = self.stages[queue_index]
+        return 1 if stage.processes else stage.workers
+
+    def _run_source(self, output_queue, consumer_count):
+        stats = self.stats[0]
+        stats.started_at = time.time()
+        try:
+            items = iter(self.source)
+            while True:
+                started_at = time.time()
+                item = next(items, _DONE)
+                stats.add(busy_seconds=time.time() - started_at)
+                if item is _DONE:
+                    break
+                self._put(output_queue, item, stats)
+                stats.add(items_out=1)
+            for _ in range(consumer_count):
+                self._put(output_queue, _DONE, stats)
+        except _Cancelled:
+            pass
+        except Exception as error:
+            self._fail(error)
+        finally:
+            stats.finished_at = time.time()
+
+    def _run_stage(self, stage, stats, input_queue, output_queue, workers, finished_workers, consumer_count):
+        if stats.started_at is None:
+            stats.started_at = time.time()
+        try:
+            if stage.processes:
+                self._run_in_processes(stage, stats, input_queue, output_queue)
+            else:
+                for item in self._items(input_queue, stats):
+                    self._pass_on(lambda: stage.function(item), stats, output_queue)
+            with self._lock:
+                finished_workers[0] += 1
+                is_last_worker = finished_workers[0] == workers
+            if is_last_worker:
+                finish = getattr(stage.function, 'finish', None)
+                if finish is not None and not stage.processes:
+                    self._pass_on(finish, stats, output_queue)
+                for _ in range(consumer_count):
+                    self._put(output_queue, _DONE)
+                stats.finished_at = time.time()
+        except _Cancelled:
+            pass
+        except Exception as error:
+            self._fail(error)
+
+    def _run_in_processes(self, stage, stats, input_queue, output_queue):
+        # items go out to the pool a few ahead, and come back in the order they went in
+        with ProcessPoolExecutor(stage.workers) as pool:
+            in_flight = deque()
+            for item in self._items(input_queue, stats):
+                in_flight.append(pool.submit(_call_stage_function, stage.function, item))
+                if len(in_flight) >= stage.workers * 2:
+                    self._pass_on_from_process(in_flight.popleft(), stats, output_queue)
+            while in_flight:
+                self._pass_on_from_process(in_flight.popleft(), stats, output_queue)
+
+    def _pass_on(self, function, stats, output_queue):
+        started_at = time.time()
+        results = list(function() or ())
+        stats.add(busy_seconds=time.time() - started_at)
+        for result in results:
+            self._put(output_queue, result, stats)
+            stats.add(items_out=1)
+
+    def _pass_on_from_process(self, future, stats, output_queue):
+        results, busy_seconds = future.result()
+        stats.add(busy_seconds=busy_seconds)
+        for result in results:
+            self._put(output_queue, result, stats)
+            stats.add(items_out=1)
+
+    def _items(self, input_queue, stats=None):
+        while True:
+            started_at = time.time()
+            item = self._get(input_queue)
+            if stats is not None:
+                stats.add(input_wait_seconds=time.time() - started_at)
+            if item is _DONE:
+                return
+            if stats is not None:
+                stats.add(items_in=1)
+            yield item
+
+    def _get(self, input_queue):
+        while True:
+            if self._cancelled.is_set():
+                raise _Cancelled()
+            try:
+                return input_queue.get(timeout=_QUEUE_POLL_SECONDS)
+            except Empty:
+                pass
+
+    def _put(self, output_queue, item, stats=None):
+        started_at = time.time()
+        while True:
+            if self._cancelled.is_set():
+                raise _Cancelled()
+            try:
+                output_queue.put(item, timeout=_QUEUE_POLL_SECONDS)
+                break
+            except Full:
+                pass
+        if stats is not None:
+            stats.add(output_wait_seconds=time.time() - started_at)
+
+    def _fail(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._cancelled.set()
+
+
+def _call_stage_function(function, item):
+    '''Runs in a worker process: generators can't be sent back, so results are listed.'''
+    started_at = time.time()
+    results = list(function(item) or ())
+    return results, time.time() - started_at
+
+
+def s3_csv_batches(s3_path_prefix, batch_size=None):
+    '''A pipeline source: the rows of every CSV under an S3 prefix, gzipped or not, in
+    lists of up to `batch_size` (default: config.FETCH_BATCH_SIZE) rows.'''
+    batch_size = batch_size or config.FETCH_BATCH_SIZE
+    bucket_name, prefix, _ = parse_s3_path(s3_path_prefix)
+    bucket = AWS().s3_connection().Bucket(bucket_name)
+    batch = []
+    for s3_object in bucket.objects.filter(Prefix=prefix):
+        body = s3_object.get()['Body']
+        chunks = iter(lambda: body.read(_S3_READ_BYTES), b'')
+        if s3_object.key.endswith('.gz'):
+            chunks = _gunzipped(chunks)
+        for row in csv.reader(lines(chunks)):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _gunzipped(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+class CsvPartWriter:
+    '''A pipeline stage: writes each batch of rows to its own gzipped CSV file under
+    `local_directory` (default: config.LOCAL_TEMP_DIRECTORY), and passes on its path.
+    Picklable, so it can run in a process Stage.'''
+
+    def __init__(self, local_directory=None):
+        self.local_directory = local_directory or config.LOCAL_TEMP_DIRECTORY
+
+    def __call__(self, rows):
+        part_path = os.path.join(self.local_directory, 'pipeline_part_{}.csv.gz'.format(uuid().hex))
+        with gzip.open(part_path, 'wt', encoding='utf-8', newline='') as part:
+            write_rows(part, rows)
+        yield part_path
+
+
+class S3PartUploader:
+    '''A pipeline stage: uploads each local file next to `s3_path_prefix`, removes the
+    local copy, and passes on the S3 path.'''
+
+    def __init__(self, s3_path_prefix):
+        self.s3_path_prefix = s3_path_prefix
+
+    def __call__(self, local_path):
+        s3_path = '{prefix}_{file_name}'.format(prefix=self.s3_path_prefix, file_name=os.path.basename(local_path))
+        S3File.from_local_file(local_path, s3_path)
+        os.remove(local_path)
+        yield s3_path
+
+
+class RedshiftCommitter:
+    '''A pipeline stage: upserts gzipped CSV parts in S3 into `destination` with manifest
+    COPYs of `parts_per_load` parts, or of every part once they've all arrived. Passes
+    on the number of parts in each load. Runs on one worker.'''
+
+    def __init__(self, destination, parts_per_load=None, **ingestion_args):
+        self.destination = destination
+        self.parts_per_load = parts_per_load
+        self.ingestion_args = dict({'gzip': True}, **ingestion_args)
+        self._s3_paths = []
+
+    def __call__(self, s3_path):
+        self._s3_paths.append(s3_path)
+        if self.parts_per_load and len(self._s3_paths) >= self.parts_per_load:
+            yield self._load()
+
+    def finish(self):
+        if self._s3_paths:
+            yield self._load()
+
+    def _load(self):
+        entries = [{'url': s3_path, 'mandatory': True} for s3_path in self._s3_paths]
+        from_manifest({'entries': entries}, self.destination, **self.ingestion_args)
+        self._s3_paths = []
+        return len(entries)
@@ -1,24 +1,78 @@
-import os
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
+from threading import BoundedSemaphore, Lock
+from uuid import uuid4 as uuid
 
-import psycopg2 as ps
-from sqlalchemy import create_engine
+from aws_etl_tools import config
+from aws_etl_tools.redshift_ingest.ingestors import UpsertToPostgres
+
+
+# postgres type OIDs, as found in cursor.description, mapped to how `fetch_dataframe` reads them
+TEXT_TYPE_OIDS = {18, 19, 25, 1042, 1043}
+FLOAT_TYPE_OIDS = {700, 701, 1700}
+DATETIME_TYPE_OIDS = {1082, 1114, 1184}
+BOOLEAN_TYPE_OID = 16
 
 
 class PostgresDatabase:
+    # how `redshift_ingest` sources, and `RedshiftDatabase.copy_to`, upsert into this database
+    ingestion_class = UpsertToPostgres
+
+    # subclasses often set credentials without calling this __init__, so the
+    # connection pool is created lazily, under a lock shared by all instances.
+    _connection_pool_lock = Lock()
 
     def __init__(self, credentials):
         '''Takes `credentials`: a dict with database_name, username, password, host, and port.'''
         self.credentials = credentials
 
+    def connection_arguments(self):
+        return {
+            'database': self.credentials["database_name"],
+            'user': self.credentials["username"],
+            'password': self.credentials["password"],
+            'host': self.credentials["host"],
+            'port': self.credentials["port"]
+        }
+
     def make_new_cursor(self):
-        db_connection = ps.connect(database=self.credentials["database_name"],
-                                   user=self.credentials["username"],
-                                   password=self.credentials["password"],
-                                   host=self.credentials["host"],
-                                   port=self.credentials["port"])
+        # imported here rather than at the top so the package imports quickly
+        import psycopg2 as ps
+        db_connection = ps.connect(**self.connection_arguments())
         db_connection.autocommit = True
         return db_connection.cursor()
 
+    @contextmanager
+    def pooled_cursor(self):
+        '''Yields a cursor on an autocommitting connection borrowed from this database's
+        connection pool of up to config.DATABASE_POOL_SIZE connections. When every
+        connection is in use, this waits for one to be returned.'''
+        idle_connections, pool_slots = self._connection_pool()
+        with pool_slots:
+            with self._connection_pool_lock:
+                connection = idle_connections.pop() if idle_connections else None
+            if connection is None:
+                connection = self.make_new_cursor().connection
+            try:
+                with connection.cursor() as cursor:
+                    yield cursor
+            finally:
+                if not connection.closed:
+                    with self._connection_pool_lock:
+                        idle_connections.append(connection)
+
+    def close_connection_pool(self):
+        with self._connection_pool_lock:
+            idle_connections, _ = self.__dict__.pop('_pool', ([], None))
+        for connection in idle_connections:
+            connection.close()
+
+    def _connection_pool(self):
+        with self._connection_pool_lock:
+            if '_pool' not in self.__dict__:
+                self._pool = ([], BoundedSemaphore(config.DATABASE_POOL_SIZE))
+            return self._pool
+
     def execute(self, query, params=None):
         cursor = self.make_new_cursor()
         cursor.execute(query, params)
@@ -31,8 +85,103 @@ class PostgresDatabase:
 
     def fetch(self, query, params=None):
         cursor = self.make_new_cursor()
-        cursor.execute(query, params)
-        return cursor.fetchall()
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        finally:
+            cursor.connection.close()
+
+    def iter_fetch(self, query, params=None, itersize=None):
+        '''Yields the rows of `query` one at a time. They're read from a server-side
+        cursor `itersize` (default: config.FETCH_BATCH_SIZE) rows at a time, so the
+        whole result never has to fit in memory. The connection is closed when the
+        rows run out or the iterator is closed.'''
+        with self._server_side_cursor(query, params, itersize) as cursor:
+            for row in cursor:
+                yield row
+
+    def fetch_batches(self, query, params=None, batch_size=None, as_arrays=False):
+        '''Like `iter_fetch`, but yields lists of up to `batch_size` rows. With
+        `as_arrays`, each batch is instead a dict of column name to a numpy array
+        of that column's values.'''
+        batch_size = batch_size or config.FETCH_BATCH_SIZE
+        with self._server_side_cursor(query, params, batch_size) as cursor:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield self._column_arrays(cursor.description, rows) if as_arrays else rows
+
+    def fetch_dataframe(self, query, params=None, chunksize=None):
+        '''Returns the result of `query` as a pandas DataFrame, or with `chunksize`, an
+        iterator of DataFrames of that many rows. The result is streamed out with
+        `COPY (query) TO STDOUT` and parsed by pandas' CSV reader, which is much faster
+        than `pandas.read_sql` for anything sizeable. Column types come from the
+        query's result description. COPY TO STDOUT is postgres only; to get data out
+        of Redshift, `unload` it.'''
+        import pandas as pd
+        from psycopg2.extensions import encodings
+        columns, dtypes, date_columns, boolean_columns = self._dataframe_types(query, params)
+        buffer = SpooledTemporaryFile(max_size=config.FETCH_DATAFRAME_SPOOL_BYTES)
+        # written by COPY in place of NULL so that NULLs and empty strings stay distinct,
+        # and unique so that no real value is mistaken for one
+        null_marker = uuid().hex
+        cursor = self.make_new_cursor()
+        try:
+            copy_statement = "COPY ({query}) TO STDOUT WITH CSV NULL '{null}'".format(
+                query=cursor.mogrify(query, params).decode(encodings[cursor.connection.encoding]),
+                null=null_marker
+            )
+            cursor.copy_expert(copy_statement, buffer)
+        finally:
+            cursor.connection.close()
+        buffer.seek(0)
+
+        dataframes = pd.read_csv(buffer, header=None, names=columns, dtype=dtypes, parse_dates=date_columns,
+                                 na_values=[null_marker], keep_default_na=False, chunksize=chunksize)
+        if chunksize is None:
+            return self._with_booleans(dataframes, boolean_columns)
+        return (self._with_booleans(dataframe, boolean_columns) for dataframe in dataframes)
+
+    def _dataframe_types(self, query, params):
+        cursor = self.make_new_cursor()
+        try:
+            cursor.execute('SELECT * FROM ({}) AS typed_query LIMIT 0'.format(query), params)
+            description = cursor.description
+        finally:
+            cursor.connection.close()
+        columns = [column.name for column in description]
+        dtypes = {column.name: object for column in description if column.type_code in TEXT_TYPE_OIDS}
+        dtypes.update({column.name: 'float64' for column in description if column.type_code in FLOAT_TYPE_OIDS})
+        date_columns = [column.name for column in description if column.type_code in DATETIME_TYPE_OIDS]
+        boolean_columns = [column.name for column in description if column.type_code == BOOLEAN_TYPE_OID]
+        return columns, dtypes, date_columns, boolean_columns
+
+    @staticmethod
+    def _with_booleans(dataframe, boolean_columns):
+        # COPY writes booleans as t and f, which the CSV reader leaves as strings
+        for column in boolean_columns:
+            dataframe[column] = dataframe[column].map({'t': True, 'f': False})
+        return dataframe
+
+    @contextmanager
+    def _server_side_cursor(self, query, params, itersize):
+        import psycopg2 as ps
+        connection = ps.connect(**self.connection_arguments())
+        try:
+            # named cursors only live as long as a transaction, so no autocommit here
+            cursor = connection.cursor(name='aws_etl_tools_%s' % uuid().hex)
+            cursor.itersize = itersize or config.FETCH_BATCH_SIZE
+            cursor.execute(query, params)
+            yield cursor
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _column_arrays(description, rows):
+        import numpy as np
+        columns = zip(*rows)
+        return {column_description[0]: np.array(values) for column_description, values in zip(description, columns)}
 
     def table_count(self, table_name):
         return int(self.fetch("""SELECT COUNT(1) FROM %s""" % table_name)[0][0])
@@ -44,5 +193,5 @@ class PostgresDatabase:
         return self.fetch("""SELECT min(%s) FROM %s""" % (column, table))[0][0]
 
     def create_database_engine(self):
+        from sqlalchemy import create_engine
         return create_engine('postgres://%(username)s:%(password)s@%(host)s:%(port)s/%(database_name)s' % self.credentials)
-
@@ -1,13 +1,96 @@
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import random
+import time
+from uuid import uuid4 as uuid
+import zlib
+
 from aws_etl_tools.aws import AWS
+from aws_etl_tools import config
+from aws_etl_tools.guard import requires_s3_base_path
 from aws_etl_tools.postgres_database import PostgresDatabase
 from aws_etl_tools.redshift_ingest.ingestors import BasicUpsert
+from aws_etl_tools.redshift_ingest.redshift_table import RedshiftTable
+
+
+UnloadJob = namedtuple('UnloadJob', ['query', 's3_path', 'options'])
+
+# how `copy_to` unloads: gzipped CSV parts, listed in a manifest, that COPY reads as is
+COPY_TO_UNLOAD_OPTIONS = {
+    'is_parallel_unload': True,
+    'allow_overwrite': True,
+    'as_csv': True,
+    'delimiter': ',',
+    'compression_type': 'GZIP'
+}
+_S3_READ_BYTES = 1024 * 1024
+
+# the privileges of an ACL item that Redshift and Postgres both have, by their letter
+_ACL_PRIVILEGES = OrderedDict([
+    ('r', 'SELECT'),
+    ('a', 'INSERT'),
+    ('w', 'UPDATE'),
+    ('d', 'DELETE'),
+    ('x', 'REFERENCES')
+])
+
+
+class UnloadJobResult:
+    '''How one job of `RedshiftDatabase.unload_many` went. `job` can be handed
+    straight back to `unload_many` to retry it.'''
+
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    def __init__(self, job):
+        self.job = job
+        self.status = None
+        self.attempts = 0
+        self.started_at = None
+        self.elapsed_seconds = None
+        self.error = None
+
+    @property
+    def succeeded(self):
+        return self.status == self.SUCCEEDED
+
+    def __repr__(self):
+        return '<UnloadJobResult {status} {s3_path} attempts={attempts} elapsed_seconds={elapsed}>'.format(
+            status=self.status, s3_path=self.job.s3_path, attempts=self.attempts, elapsed=self.elapsed_seconds)
+
+
+class TableCopyResult:
+    '''How one key range of `RedshiftDatabase.copy_to` went. Hand the `key_range` of
+    any that failed back to `copy_to` to copy just those again.'''
+
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    def __init__(self, key_range, s3_path):
+        self.key_range = key_range
+        self.s3_path = s3_path
+        self.status = None
+        self.error = None
+        self.unload_seconds = None
+        self.load_seconds = None
+
+    @property
+    def succeeded(self):
+        return self.status == self.SUCCEEDED
+
+    def __repr__(self):
+        return '<TableCopyResult {status} {key_range} unload_seconds={unload} load_seconds={load}>'.format(
+            status=self.status, key_range=self.key_range, unload=self.unload_seconds, load=self.load_seconds)
 
 
 class RedshiftDatabase(PostgresDatabase):
     ingestion_class = BasicUpsert
 
     def unload(self, query, s3_path, delimiter='|', is_parallel_unload=False, allow_overwrite=False,
-        add_quotes=False, escape=False, header=False, compression_type=None, max_file_size=None):
+        add_quotes=False, escape=False, header=False, compression_type=None, max_file_size=None, as_csv=False):
         '''Unloads a query on this database to an s3_path.
             `is_parallel_unload` is good for unloading to multiple files with a
             manifest when you know you will be loading this data back into redshift
@@ -20,7 +103,351 @@ class RedshiftDatabase(PostgresDatabase):
             >> destination_s3_path = 's3://ye-bucket/data_dumps/2013-events'
             >> RedshiftDatabase(credentials_dict).unload(query, destination_s3_path)'''
 
-        options = {
+        options = self._unload_options(
+            delimiter=delimiter,
+            is_parallel_unload=is_parallel_unload,
+            allow_overwrite=allow_overwrite,
+            add_quotes=add_quotes,
+            escape=escape,
+            header=header,
+            compression_type=compression_type,
+            max_file_size=max_file_size,
+            as_csv=as_csv
+        )
+
+        unload_query = self._compose_unload_query(query, s3_path, options)
+        self.execute(unload_query)
+
+    def unload_many(self, jobs, max_concurrency=None, wlm_service_class=None, retries=0, concurrency=None):
+        '''Runs many UNLOADs at once over pooled connections and returns an
+            UnloadJobResult for each job, in the same order. Each job is a tuple of
+            (query, s3_path) or (query, s3_path, options), where options are keyword
+            arguments to `unload`. A failed job is retried up to `retries` times, after
+            a jittered, exponentially growing wait (see config.UNLOAD_RETRY_BASE_SECONDS),
+            before it's reported as failed; failures never stop the other jobs.
+
+            At most `max_concurrency` (default: config.UNLOAD_MAX_CONCURRENCY) run at
+            once. If a `wlm_service_class` is given, that's further capped by the number
+            of slots in that WLM queue, so the unloads don't just sit queued. With a
+            WlmConcurrencyController as `concurrency`, each UNLOAD also holds one of its
+            slots, so how many run at once follows how busy the WLM queue is, and
+            `max_concurrency` defaults to the controller's.
+
+            example usage:
+            >> jobs = [('select * from events_%s' % month, 's3://ye-bucket/archive/%s/' % month,
+            ..          {'is_parallel_unload': True}) for month in months]
+            >> db = RedshiftDatabase(credentials_dict)
+            >> results = db.unload_many(jobs, wlm_service_class=6)
+            >> retry_results = db.unload_many([result.job for result in results if not result.succeeded])'''
+        _raise_unless_at_least_one(max_concurrency)
+        jobs = [UnloadJob(job[0], job[1], job[2] if len(job) > 2 else {}) for job in jobs]
+        if max_concurrency is None:
+            max_concurrency = concurrency.max_concurrency if concurrency else config.UNLOAD_MAX_CONCURRENCY
+        worker_count = max_concurrency
+        if wlm_service_class is not None:
+            worker_count = min(worker_count, self.wlm_slot_count(wlm_service_class))
+        aws_connection_string = AWS().connection_string()
+
+        def run(job):
+            return self._run_unload_job(job, aws_connection_string, retries, concurrency)
+
+        with ThreadPoolExecutor(max_workers=max(worker_count, 1)) as executor:
+            return list(executor.map(run, jobs))
+
+    def copy_to(self, source, destination, key_column=None, key_ranges=None, s3_path=None, max_concurrency=None,
+                concurrency=None, load_concurrency=None, **ingestion_args):
+        '''Copies `source`, a table or a query on this database, into `destination`, a
+            RedshiftTable on another RedshiftDatabase or on a PostgresDatabase, and returns a
+            TableCopyResult for each key range. Unlike with `unload`, quotes in the query
+            need no escaping.
+
+            The source is UNLOADed in parallel to gzipped CSV parts and a manifest under
+            `s3_path` (default: a new path under config.S3_BASE_PATH). A destination whose
+            ingestion class takes manifests, like Redshift, upserts them with a single
+            manifest COPY. Otherwise, as with Postgres, each part is streamed from S3
+            straight into a COPY FROM STDIN upsert of its own, up to `max_concurrency`
+            (default: config.UNLOAD_MAX_CONCURRENCY) at once, without touching local disk.
+            `ingestion_args` go to the destination's ingestion class. A WlmConcurrencyController
+            as `concurrency` paces the UNLOADs, as it does for `unload_many`, and one for the
+            destination's database as `load_concurrency` paces the loads, each holding one of
+            its slots. No slot is held while waiting for another, so copies both ways between
+            two paced databases can't wait on each other.
+
+            With a `key_column` and `key_ranges`, a list of (low, high) pairs where either
+            may be None, each range of low <= key < high is unloaded and loaded on its own,
+            and a failure in one doesn't stop the others. Upserts can be rerun safely, so a
+            copy is restarted by copying just the ranges that failed.
+
+            example usage:
+            >> staging = RedshiftTable(StagingRedshift(), 'public.events', ('event_id',))
+            >> results = RedshiftDatabase(credentials_dict).copy_to(
+            ..     'public.events', staging, key_column='occurred_on', key_ranges=weekly_ranges)
+            >> failed_ranges = [result.key_range for result in results if not result.succeeded]'''
+        _raise_unless_at_least_one(max_concurrency)
+        query = source if len(source.split()) > 1 else 'SELECT * FROM {}'.format(source)
+        s3_path = (s3_path or _default_copy_s3_path(destination)).rstrip('/') + '/'
+        key_ranges = list(key_ranges) if key_ranges else [None]
+        results = [TableCopyResult(key_range, '{s3_path}{number}/'.format(s3_path=s3_path, number=number))
+                   for number, key_range in enumerate(key_ranges)]
+        jobs = [(self._escape_unload_query(self._key_range_query(query, key_column, result.key_range)),
+                 result.s3_path, COPY_TO_UNLOAD_OPTIONS) for result in results]
+
+        for result, unload_result in zip(results, self.unload_many(jobs, max_concurrency,
+                                                                   concurrency=concurrency)):
+            result.unload_seconds = unload_result.elapsed_seconds
+            if not unload_result.succeeded:
+                result.status, result.error = TableCopyResult.FAILED, unload_result.error
+                continue
+            start = time.time()
+            try:
+                self._load_unloaded_parts(result.s3_path, destination, max_concurrency, ingestion_args,
+                                          load_concurrency)
+            except Exception as error:
+                result.status, result.error = TableCopyResult.FAILED, error
+            else:
+                result.status = TableCopyResult.SUCCEEDED
+            result.load_seconds = time.time() - start
+        return results
+
+    def wlm_slot_count(self, service_class):
+        '''The number of queries the given WLM queue can run at once.'''
+        return int(self.fetch("""
+            SELECT num_query_tasks
+            FROM STV_WLM_SERVICE_CLASS_CONFIG
+            WHERE service_class = %(service_class)s
+            """, {'service_class': service_class})[0][0])
+
+    def rebuild_table(self, table, dist_style=None, dist_key=None, sort_keys=None, interleaved=False,
+                      column_encodings=None):
+        '''Rebuilds `table` with a deep copy: its rows are inserted, in sort key order, into a
+            new table shaped like it, which then takes its place. On a mostly unsorted table
+            this is much faster than a VACUUM, though it needs room for a second copy of the
+            table. The copy and the swap happen in one transaction, and writers wait on a
+            lock for it, so nothing is lost and readers never see a half-built table.
+
+            The new table keeps the old one's distribution, sort keys and column encodings
+            unless `dist_style`, `dist_key`, `sort_keys` (INTERLEAVED if `interleaved`) or
+            `column_encodings`, a dict of column name to encoding, say otherwise. It also
+            keeps the old one's owner and the privileges granted on it. Views that aren't
+            late-binding need to be dropped first, as they would for any DROP.
+
+            Tables with IDENTITY columns can't be rebuilt this way, as Redshift won't take
+            their values in an INSERT, only in a COPY with EXPLICIT_IDS, so they raise a
+            ValueError before anything is done. Columns GENERATED BY DEFAULT AS IDENTITY
+            take them, and are fine.
+
+            example usage:
+            >> RedshiftDatabase(credentials_dict).rebuild_table('public.events', sort_keys=('occurred_at',))'''
+        identity_columns = self.identity_columns(table)
+        if identity_columns:
+            raise ValueError('{table} can\'t be rebuilt without renumbering its IDENTITY columns, {columns}. '
+                             'VACUUM it instead.'.format(table=table, columns=', '.join(identity_columns)))
+        destination = RedshiftTable(self, table, ())
+        insert_order = tuple(sort_keys) if sort_keys else destination.schema.sort_keys
+        shadow_table = '{table}_rebuild_{suffix}'.format(table=table, suffix=uuid().hex[:8])
+        old_table_name = '{table_name}_old_{suffix}'.format(table_name=destination.table_name, suffix=uuid().hex[:8])
+
+        privilege_statements = self._table_privilege_statements(table, shadow_table)
+        self.execute(self._create_shadow_table_statement(table, shadow_table, dist_style, dist_key, sort_keys,
+                                                         interleaved))
+        try:
+            for column_name, encoding in sorted((column_encodings or {}).items()):
+                self.execute('ALTER TABLE {shadow_table} ALTER COLUMN "{column_name}" ENCODE {encoding};'.format(
+                    shadow_table=shadow_table, column_name=column_name, encoding=encoding))
+            self.execute("""
+                BEGIN TRANSACTION;
+
+                LOCK {table};
+                INSERT INTO {shadow_table} SELECT * FROM {table}{order_by};
+                {privilege_statements}
+                ALTER TABLE {table} RENAME TO {old_table_name};
+                ALTER TABLE {shadow_table} RENAME TO {table_name};
+                DROP TABLE {schema_name}.{old_table_name};
+
+                END TRANSACTION;
+                """.format(
+                    table=table,
+                    shadow_table=shadow_table,
+                    order_by=' ORDER BY ' + ', '.join('"%s"' % key for key in insert_order) if insert_order else '',
+                    privilege_statements='\n'.join(privilege_statements),
+                    old_table_name=old_table_name,
+                    table_name=destination.table_name,
+                    schema_name=destination.table_schema
+                ))
+        except Exception:
+            self.execute('DROP TABLE IF EXISTS {shadow_table};'.format(shadow_table=shadow_table))
+            raise
+        finally:
+            destination.invalidate_schema()
+
+    def identity_columns(self, table):
+        '''The columns of `table` that are IDENTITY columns, which only take values from
+            a COPY with EXPLICIT_IDS. Not those GENERATED BY DEFAULT AS IDENTITY.'''
+        table_schema, table_name = table.split('.')
+        return [row[0] for row in self.fetch("""
+            SELECT column_name
+            FROM information_schema.columns
+            WHERE table_schema = %(table_schema)s
+            AND table_name = %(table_name)s
+            AND column_default LIKE '"identity"(%%'
+            ORDER BY ordinal_position
+            """, {'table_schema': table_schema, 'table_name': table_name})]
+
+    def table_unsorted_percent(self, table):
+        '''How much of `table` is unsorted, according to SVV_TABLE_INFO. None for tables
+            without a sort key or without any rows.'''
+        table_schema, table_name = table.split('.')
+        rows = self.fetch("""
+            SELECT unsorted
+            FROM SVV_TABLE_INFO
+            WHERE "schema" = %(table_schema)s
+            AND "table" = %(table_name)s
+            """, {'table_schema': table_schema, 'table_name': table_name})
+        return float(rows[0][0]) if rows and rows[0][0] is not None else None
+
+    def maintain_table(self, table):
+        '''VACUUMs `table`, unless it's at least config.TABLE_REBUILD_UNSORTED_PERCENT
+            unsorted, in which case it's rebuilt with `rebuild_table` instead. Tables with
+            IDENTITY columns are always VACUUMed.'''
+        from psycopg2 import DatabaseError
+        threshold = config.TABLE_REBUILD_UNSORTED_PERCENT
+        if threshold:
+            try:
+                unsorted_percent = self.table_unsorted_percent(table)
+            except DatabaseError:
+                # SVV_TABLE_INFO is redshift only
+                unsorted_percent = None
+            if (unsorted_percent is not None and unsorted_percent >= threshold and
+                    not self.identity_columns(table)):
+                self.rebuild_table(table)
+                return
+        self.execute("""VACUUM {table};""".format(table=table))
+
+    def _table_privilege_statements(self, table, shadow_table):
+        '''GRANTs on `shadow_table` of what's granted on `table`, and handing it to the
+            same owner, from the table's ACL. Privileges only Redshift or only Postgres
+            has, like RULE or TRUNCATE, aren't carried over.'''
+        table_schema, table_name = table.split('.')
+        rows = self.fetch("""
+            SELECT pg_get_userbyid(class.relowner), array_to_string(class.relacl, '|')
+            FROM pg_class class
+            JOIN pg_namespace namespace ON namespace.oid = class.relnamespace
+            WHERE namespace.nspname = %(table_schema)s
+            AND class.relname = %(table_name)s
+            """, {'table_schema': table_schema, 'table_name': table_name})
+        if not rows:
+            return []
+        owner, acl = rows[0]
+        statements = []
+        # each ACL item looks like `grantee=privileges/grantor`, where a * after a
+        # privilege means it was granted WITH GRANT OPTION
+        for acl_item in (acl or '').split('|'):
+            grantee, _, privileges = acl_item.rpartition('/')[0].rpartition('=')
+            grantee = grantee.replace('"', '')
+            if not privileges or grantee == owner:
+                continue
+            if grantee.startswith('group '):
+                grantee = 'GROUP "{}"'.format(grantee[len('group '):])
+            else:
+                grantee = '"{}"'.format(grantee) if grantee else 'PUBLIC'
+            for with_grant_option in (False, True):
+                granted = [_ACL_PRIVILEGES[letter] for letter, star in zip(privileges, privileges[1:] + ' ')
+                           if letter in _ACL_PRIVILEGES and (star == '*') == with_grant_option]
+                if granted:
+                    statements.append('GRANT {privileges} ON {shadow_table} TO {grantee}{grant_option};'.format(
+                        privileges=', '.join(granted), shadow_table=shadow_table, grantee=grantee,
+                        grant_option=' WITH GRANT OPTION' if with_grant_option else ''))
+        statements.append('ALTER TABLE {shadow_table} OWNER TO "{owner}";'.format(
+            shadow_table=shadow_table, owner=owner))
+        return statements
+
+    @staticmethod
+    def _create_shadow_table_statement(table, shadow_table, dist_style, dist_key, sort_keys, interleaved):
+        table_attributes = []
+        if dist_key:
+            table_attributes.append('DISTSTYLE KEY DISTKEY("{}")'.format(dist_key))
+        elif dist_style:
+            table_attributes.append('DISTSTYLE {}'.format(dist_style))
+        if sort_keys:
+            table_attributes.append('{interleaved}SORTKEY({sort_keys})'.format(
+                interleaved='INTERLEAVED ' if interleaved else '',
+                sort_keys=', '.join('"%s"' % key for key in sort_keys)))
+        # with LIKE, anything left unsaid is copied from the original table
+        return 'CREATE TABLE {shadow_table} (LIKE {table} INCLUDING DEFAULTS){table_attributes};'.format(
+            shadow_table=shadow_table,
+            table=table,
+            table_attributes=''.join(' ' + attribute for attribute in table_attributes)
+        )
+
+    @staticmethod
+    def _key_range_query(query, key_column, key_range):
+        from psycopg2.extensions import adapt
+        if key_range is None:
+            return query
+        bounds = ['"{key_column}" {operator} {value}'.format(
+            key_column=key_column, operator=operator, value=adapt(value).getquoted().decode('utf-8'))
+            for operator, value in zip(('>=', '<'), key_range) if value is not None]
+        return 'SELECT * FROM ({query}) AS key_range WHERE {bounds}'.format(
+            query=query, bounds=' AND '.join(bounds) or 'TRUE')
+
+    @staticmethod
+    def _escape_unload_query(query):
+        # UNLOAD takes its query as a quoted string
+        return query.replace('\\', '\\\\').replace("'", "\\'")
+
+    @staticmethod
+    def _load_unloaded_parts(s3_path, destination, max_concurrency, ingestion_args, load_concurrency=None):
+        from aws_etl_tools.redshift_ingest.sources import s3_to_redshift
+        from aws_etl_tools.s3_file import S3File, parse_s3_path
+        manifest_path = s3_path + 'manifest'
+        ingestion_class = destination.database.ingestion_class
+        if getattr(ingestion_class, 'supports_manifests', True):
+            with _slot_of(load_concurrency):
+                s3_to_redshift(S3File(manifest_path), destination, with_manifest=True, gzip=True, **ingestion_args)
+            return
+
+        s3 = AWS().s3_connection()
+        bucket_name, key_name, _ = parse_s3_path(manifest_path)
+        manifest = json.loads(s3.Object(bucket_name, key_name).get()['Body'].read().decode('utf-8'))
+
+        def load(entry):
+            bucket_name, key_name, _ = parse_s3_path(entry['url'])
+            # clients, unlike resources, can be shared between threads
+            body = s3.meta.client.get_object(Bucket=bucket_name, Key=key_name)['Body']
+            part = _GunzippedReader(iter(lambda: body.read(_S3_READ_BYTES), b''))
+            with _slot_of(load_concurrency):
+                ingestion_class(None, destination, stream=part, **ingestion_args)()
+
+        with ThreadPoolExecutor(max_workers=max_concurrency or config.UNLOAD_MAX_CONCURRENCY) as executor:
+            list(executor.map(load, manifest['entries']))
+
+    def _run_unload_job(self, job, aws_connection_string, retries, concurrency=None):
+        result = UnloadJobResult(job)
+        options = self._unload_options(**job.options)
+        unload_query = self._compose_unload_query(job.query, job.s3_path, options, aws_connection_string)
+        result.started_at = datetime.utcnow()
+        start = time.time()
+        while True:
+            result.attempts += 1
+            try:
+                # the slot is only held while the UNLOAD runs, not while waiting to retry it
+                with _slot_of(concurrency), self.pooled_cursor() as cursor:
+                    cursor.execute(unload_query)
+            except Exception as error:
+                result.status, result.error = UnloadJobResult.FAILED, error
+            else:
+                result.status, result.error = UnloadJobResult.SUCCEEDED, None
+                break
+            if result.attempts > retries:
+                break
+            time.sleep(random.uniform(0, config.UNLOAD_RETRY_BASE_SECONDS * 2 ** result.attempts))
+        result.elapsed_seconds = time.time() - start
+        return result
+
+    @staticmethod
+    def _unload_options(delimiter='|', is_parallel_unload=False, allow_overwrite=False, add_quotes=False,
+                        escape=False, header=False, compression_type=None, max_file_size=None, as_csv=False):
+        return {
             'is_parallel_unload': is_parallel_unload,
             'allow_overwrite': allow_overwrite,
             'delimiter': delimiter,
@@ -28,15 +455,14 @@ class RedshiftDatabase(PostgresDatabase):
             'escape': escape,
             'header': header,
             'compression_type': compression_type,
-            'max_file_size': max_file_size
+            'max_file_size': max_file_size,
+            'as_csv': as_csv
         }
 
-        unload_query = self._compose_unload_query(query, s3_path, options)
-        self.execute(unload_query)
-
-    def _compose_unload_query(self, query, s3_path, options):
+    def _compose_unload_query(self, query, s3_path, options, aws_connection_string=None):
         query_commands = ['MANIFEST'] if options.get('is_parallel_unload', False) else ['PARALLEL OFF']
         query_commands.append('ALLOWOVERWRITE') if options.get('allow_overwrite', False) else None
+        query_commands.append('FORMAT AS CSV') if options.get('as_csv', False) else None
         query_commands.append('DELIMITER \'%s\'' % options.get('delimiter'))
         query_commands.append('ADDQUOTES') if options.get('add_quotes', False) else None
         query_commands.append('ESCAPE') if options.get('escape', False) else None
@@ -49,8 +475,63 @@ class RedshiftDatabase(PostgresDatabase):
         unload_query = """UNLOAD ('{query}') TO '{s3_path}'
                           CREDENTIALS '{aws_connection_string}'
                           {unload_query_options};""".format(s3_path=s3_path,
-                                                   aws_connection_string=AWS().connection_string(),
+                                                   aws_connection_string=aws_connection_string or AWS().connection_string(),
                                                    query=query,
                                                    unload_query_options=unload_query_options)
         unload_query = unload_query.replace("\n", "").replace("                          ", " ")
         return unload_query
+
+
+@requires_s3_base_path
+def _default_copy_s3_path(destination):
+    from aws_etl_tools.redshift_ingest.transient_paths import transient_s3_path
+    return transient_s3_path(destination) + '_copy/'
+
+
+def _raise_unless_at_least_one(max_concurrency):
+    if max_concurrency is not None and max_concurrency < 1:
+        raise ValueError('max_concurrency must be at least 1, not {!r}'.format(max_concurrency))
+
+
+@contextmanager
+def _slot_of(concurrency):
+    '''Holds a slot of `concurrency`, a WlmConcurrencyController, if there is one.'''
+    if concurrency is None:
+        yield
+        return
+    with concurrency.slot():
+        yield
+
+
+class _GunzippedReader:
+    '''A file-like view, for COPY FROM STDIN, of gzipped bytes arriving in chunks.'''
+
+    def __init__(self, chunks):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._chunks = chunks
+        self._buffer = b''
+        self._offset = 0
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self._offset >= len(self._buffer):
+                if not self._fill():
+                    break
+                continue
+            end = len(self._buffer) if size < 0 else min(len(self._buffer), self._offset + size)
+            pieces.append(self._buffer[self._offset:end])
+            size -= 0 if size < 0 else end - self._offset
+            self._offset = end
+        return b''.join(pieces)
+
+    def _fill(self):
+        if self._decompressor is None:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._buffer, self._decompressor = self._decompressor.flush(), None
+        else:
+            self._buffer = self._decompressor.decompress(chunk)
+        self._offset = 0
+        return True
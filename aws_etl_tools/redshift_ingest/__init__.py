@@ -1,16 +1,28 @@
 from .redshift_table import RedshiftTable
+from .copy_options import CopyPolicy
+from .coordinator import IngestCoordinator
+from .buffer import IngestBuffer
+from .change_detection import ChangeDetector
+from .checkpoint import IngestCheckpoint
 from .sources import from_s3_file, from_s3_path, \
-    from_local_file, from_in_memory, from_dataframe, from_postgres_query, from_manifest, \
-    s3_to_redshift
+    from_local_file, from_in_memory, from_dataframe, from_postgres_query, from_manifest, from_snapshot, \
+    s3_to_redshift, rows_to_redshift
 
 __all__ = [
     'RedshiftTable',
+    'CopyPolicy',
+    'IngestCoordinator',
+    'IngestBuffer',
+    'ChangeDetector',
+    'IngestCheckpoint',
     's3_to_redshift',
+    'rows_to_redshift',
     'from_s3_file',
     'from_manifest',
     'from_s3_path',
     'from_local_file',
     'from_in_memory',
+    'from_snapshot',
     'from_dataframe',
     'from_postgres_query'
 ]
@@ -0,0 +1,266 @@
+from collections.abc import Mapping
+import csv
+import gzip
+import io
+import os
+from queue import Queue
+from threading import Event, RLock, Thread
+import time
+from uuid import uuid4 as uuid
+
+from aws_etl_tools import config
+from aws_etl_tools.csv_encoding import format_row, write_rows
+from aws_etl_tools.exceptions import SchemaMismatchError
+from aws_etl_tools.redshift_ingest.sources import from_manifest
+from aws_etl_tools.redshift_ingest.transient_paths import transient_local_path, transient_s3_path
+from aws_etl_tools.s3_file import S3File
+
+
+_STOP = object()
+
+
+class IngestBuffer:
+    '''Collects rows bound for one RedshiftTable and loads them in large batches, so a
+    stream of small writes turns into a few big COPYs rather than many tiny ones.
+
+    Rows, or dicts keyed by column name, are spooled to gzipped CSV parts on local disk.
+    As when the rows are written one by one, the last row added for an upsert key wins:
+    the keys of a flush are kept in memory, and parts holding rows that a later row
+    replaced are rewritten without them before they're uploaded.
+    Once `max_rows` rows or `max_bytes` uncompressed bytes have been buffered, or the
+    oldest buffered row is `max_age_seconds` old, the parts are flushed: a background
+    thread uploads them and upserts them all with one manifest COPY. If loading falls
+    `max_pending_flushes` flushes behind, adding rows blocks until it catches up.
+    Defaults for all of these are in config. Any other keyword arguments are passed on
+    to the ingestor, as they are by `from_manifest`.
+
+    If a flush fails, its parts are left on disk, and the error is raised from the next
+    call to `add`, `flush` or `close`. Closing flushes what's left and waits for every
+    flush to be loaded.
+
+        with IngestBuffer(destination) as buffer:
+            for message in consumer:
+                buffer.add(message.rows)
+    '''
+
+    def __init__(self, destination, max_rows=None, max_bytes=None, max_age_seconds=None,
+                 max_pending_flushes=None, **ingestion_args):
+        self.destination = destination
+        self.max_rows = max_rows or config.INGEST_BUFFER_MAX_ROWS
+        self.max_bytes = max_bytes or config.INGEST_BUFFER_MAX_BYTES
+        self.max_age_seconds = max_age_seconds or config.INGEST_BUFFER_MAX_AGE_SECONDS
+        self.ingestion_args = ingestion_args
+        self.rows_loaded = 0
+        self.flushes_loaded = 0
+
+        self._lock = RLock()
+        self._parts = []
+        self._key_positions = None
+        self._record_columns = None
+        self._row_numbers_by_key = {}
+        self._replaced_row_numbers = set()
+        self._part = None
+        self._part_bytes = 0
+        self._buffered_rows = 0
+        self._buffered_bytes = 0
+        self._oldest_row_added_at = None
+        self._error = None
+        self._is_closed = False
+        self._pending_flushes = Queue(max_pending_flushes or config.INGEST_BUFFER_MAX_PENDING_FLUSHES)
+        self._stopped = Event()
+        self._loader = Thread(target=self._load_flushes, daemon=True)
+        self._loader.start()
+        self._age_checker = Thread(target=self._flush_when_too_old, daemon=True)
+        self._age_checker.start()
+
+    def add(self, rows):
+        '''Buffers an iterable of rows, or of dicts keyed by column name.'''
+        with self._lock:
+            self._raise_if_unusable()
+            encoded_rows, row_count = self._encode(rows)
+            if not row_count:
+                return
+            self._write(encoded_rows)
+            self._buffered_rows += row_count
+            if self._buffered_rows >= self.max_rows or self._buffered_bytes >= self.max_bytes:
+                self.flush()
+
+    def flush(self):
+        '''Hands everything buffered so far to the background loader.'''
+        with self._lock:
+            self._raise_if_unusable()
+            if not self._buffered_rows:
+                return
+            self._close_part()
+            flush = (self._parts, self._buffered_rows, self._replaced_row_numbers)
+            self._parts = []
+            self._row_numbers_by_key = {}
+            self._replaced_row_numbers = set()
+            self._buffered_rows = 0
+            self._buffered_bytes = 0
+            self._oldest_row_added_at = None
+            # blocks while the loader is max_pending_flushes behind, holding up `add` too
+            self._pending_flushes.put(flush)
+
+    def close(self):
+        with self._lock:
+            if self._is_closed:
+                return
+            try:
+                if self._error is None:
+                    self.flush()
+            finally:
+                self._is_closed = True
+                self._stopped.set()
+                self._pending_flushes.put(_STOP)
+        self._loader.join()
+        self._age_checker.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        self.close()
+
+    def _raise_if_unusable(self):
+        if self._error is not None:
+            raise self._error
+        if self._is_closed:
+            raise RuntimeError('cannot add rows to a closed IngestBuffer')
+
+    def _encode(self, rows):
+        '''The rows as UTF-8 CSV lines, written in one go by `write_rows`. Rows
+        whose upsert key was already buffered this flush mark the earlier row replaced.
+        Dicts must all have the same keys as the first one added, as they're loaded
+        into just those columns.'''
+        record_columns = self._record_columns
+        lined_up_rows = []
+        keys = []
+        for row in rows:
+            if isinstance(row, Mapping):
+                record_columns = record_columns or self._columns_of_first_record(row)
+                if row.keys() != set(record_columns):
+                    raise SchemaMismatchError(
+                        'every row added to the buffer for {table} needs the same keys as the first, {columns}; '
+                        'one has {keys}'.format(table=self.destination.target_table,
+                                                columns=', '.join(record_columns),
+                                                keys=', '.join(sorted(map(str, row)))))
+                key_values = [row.get(key) for key in self.destination.upsert_uniqueness_key]
+                row = [row[column_name] for column_name in record_columns]
+            else:
+                key_values = [row[position] for position in self._upsert_key_positions()]
+            lined_up_rows.append(row)
+            # keyed by the values as they're written to the CSV, which is how they're loaded
+            keys.append(tuple('' if value is None else str(value) for value in format_row(key_values)))
+        text = io.StringIO()
+        write_rows(text, lined_up_rows)
+        self._record_columns = record_columns
+        for row_number, key in enumerate(keys, self._buffered_rows):
+            replaced_row_number = self._row_numbers_by_key.get(key)
+            if replaced_row_number is not None:
+                self._replaced_row_numbers.add(replaced_row_number)
+            self._row_numbers_by_key[key] = row_number
+        return text.getvalue().encode('utf-8'), len(keys)
+
+    def _upsert_key_positions(self):
+        if self._key_positions is None:
+            column_names = list(self.ingestion_args.get('columns') or self.destination.column_names)
+            if not column_names:
+                raise SchemaMismatchError('{table} could not be introspected, so pass `columns` to say where '
+                                          'its upsert key is in the rows'.format(table=self.destination.target_table))
+            missing_columns = [key for key in self.destination.upsert_uniqueness_key if key not in column_names]
+            if missing_columns:
+                raise SchemaMismatchError('the rows for {table} have no upsert key columns named {columns}'.format(
+                    table=self.destination.target_table, columns=', '.join(missing_columns)))
+            self._key_positions = [column_names.index(key) for key in self.destination.upsert_uniqueness_key]
+        return self._key_positions
+
+    def _columns_of_first_record(self, record):
+        column_names = self.destination.column_names
+        if not column_names:
+            raise SchemaMismatchError('{table} could not be introspected, so rows must be given as sequences'.format(
+                table=self.destination.target_table))
+        unknown_columns = set(record) - set(column_names)
+        if unknown_columns:
+            raise SchemaMismatchError('{table} has no columns named {columns}'.format(
+                table=self.destination.target_table, columns=', '.join(sorted(map(str, unknown_columns)))))
+        return [column_name for column_name in column_names if column_name in record]
+
+    def _write(self, encoded_rows):
+        if self._oldest_row_added_at is None:
+            self._oldest_row_added_at = time.time()
+        if self._part is None:
+            # unique, so other buffers loading the same table don't overwrite this one's parts
+            part_path = '{base}_{part_id}.csv.gz'.format(
+                base=transient_local_path(self.destination), part_id=uuid().hex)
+            self._parts.append(part_path)
+            self._part = gzip.open(part_path, 'wb')
+            self._part_bytes = 0
+        self._part.write(encoded_rows)
+        self._part_bytes += len(encoded_rows)
+        self._buffered_bytes += len(encoded_rows)
+        if self._part_bytes >= config.INGEST_BUFFER_PART_BYTES:
+            self._close_part()
+
+    def _close_part(self):
+        if self._part is not None:
+            self._part.close()
+            self._part = None
+
+    def _flush_when_too_old(self):
+        while not self._stopped.wait(min(self.max_age_seconds, 1)):
+            with self._lock:
+                is_too_old = (self._oldest_row_added_at is not None and
+                              time.time() - self._oldest_row_added_at >= self.max_age_seconds)
+                if is_too_old and self._error is None and not self._is_closed:
+                    self.flush()
+
+    def _load_flushes(self):
+        while True:
+            flush = self._pending_flushes.get()
+            if flush is _STOP:
+                return
+            if self._error is not None:
+                # later flushes aren't loaded ahead of a failed one; their parts stay on disk
+                continue
+            try:
+                self._load(*flush)
+            except Exception as error:
+                self._error = error
+
+    def _load(self, part_paths, row_count, replaced_row_numbers):
+        if replaced_row_numbers:
+            self._drop_replaced_rows(part_paths, replaced_row_numbers)
+        entries = []
+        s3_directory = os.path.dirname(transient_s3_path(self.destination))
+        for part_path in part_paths:
+            s3_path = os.path.join(s3_directory, os.path.basename(part_path))
+            S3File.from_local_file(part_path, s3_path)
+            entries.append({'url': s3_path, 'mandatory': True})
+        ingestion_args = dict(self.ingestion_args)
+        if self._record_columns:
+            ingestion_args.setdefault('columns', self._record_columns)
+        from_manifest({'entries': entries}, self.destination, gzip=True, **ingestion_args)
+        for part_path in part_paths:
+            os.remove(part_path)
+        self.rows_loaded += row_count - len(replaced_row_numbers)
+        self.flushes_loaded += 1
+
+    @staticmethod
+    def _drop_replaced_rows(part_paths, replaced_row_numbers):
+        '''Rewrites the parts holding rows that a later row with the same key replaced.'''
+        row_number = 0
+        for part_path in part_paths:
+            with gzip.open(part_path, 'rt', encoding='utf-8', newline='') as part:
+                rows = list(csv.reader(part))
+            part_row_numbers = range(row_number, row_number + len(rows))
+            row_number += len(rows)
+            if replaced_row_numbers.isdisjoint(part_row_numbers):
+                continue
+            rewritten_path = part_path + '.rewritten'
+            with gzip.open(rewritten_path, 'wt', encoding='utf-8', newline='') as rewritten_part:
+                csv.writer(rewritten_part).writerows(
+                    row for number, row in zip(part_row_numbers, rows) if number not in replaced_row_numbers)
+            os.replace(rewritten_path, part_path)
@@ -0,0 +1,150 @@
+import hashlib
+from itertools import islice
+import json
+import os
+
+from aws_etl_tools import config
+from aws_etl_tools.exceptions import SchemaMismatchError
+
+
+class ChangeDetector:
+    '''Tells which rows of a snapshot of a table are new or have changed since the
+    last snapshot of it that was loaded, using a local SQLite index of an MD5 hash of
+    every row, by its `upsert_uniqueness_key`.
+
+    `columns` are the target columns the rows line up with, by default all of them.
+    The index lives at `index_path`, by default a file per target table under
+    config.CHANGE_INDEX_DIRECTORY. Hashes of new and changed rows are only written to
+    it on `commit`, once they've been loaded, so a failed load is simply retried
+    whole next time. The index only knows what was loaded through it: if the target
+    table is changed some other way, e.g. truncated, `reset` the index.
+
+    With `report_deletions`, every key in the snapshot is noted as well, and
+    `deleted_keys` lists the keys of rows loaded before that aren't in the snapshot.
+    Upserts never delete, so those rows are still in the table; what to do about
+    them is up to the caller, who should `forget` any they delete.
+    '''
+
+    def __init__(self, destination, columns=None, index_path=None, report_deletions=False):
+        import sqlite3
+        column_names = columns or destination.column_names
+        if not column_names:
+            raise SchemaMismatchError('{table} could not be introspected, so changes to it cannot be detected'.format(
+                table=destination.target_table))
+        missing_key_columns = set(destination.upsert_uniqueness_key) - set(column_names)
+        if missing_key_columns:
+            raise SchemaMismatchError('the rows have no {columns} to detect changes by'.format(
+                columns=', '.join(sorted(missing_key_columns))))
+        self.destination = destination
+        self.key_positions = [list(column_names).index(key) for key in destination.upsert_uniqueness_key]
+        self.index_path = index_path or self.default_index_path(destination)
+        self.report_deletions = report_deletions
+        self.inserted = 0
+        self.changed = 0
+        self.unchanged = 0
+        self._deleted_keys = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        self._connection = sqlite3.connect(self.index_path)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS row_hashes (key TEXT PRIMARY KEY, hash BLOB)')
+        self._connection.execute('CREATE TEMP TABLE pending_hashes (key TEXT PRIMARY KEY, hash BLOB)')
+        self._connection.execute('CREATE TEMP TABLE snapshot_keys (key TEXT PRIMARY KEY)')
+
+    @staticmethod
+    def default_index_path(destination):
+        credentials = getattr(destination.database, 'credentials', None) or {}
+        file_name = '{host}_{database}_{table}.sqlite'.format(
+            host=credentials.get('host', 'local'),
+            database=credentials.get('database_name', destination.database.__class__.__name__.lower()),
+            table=destination.target_table)
+        return os.path.join(config.CHANGE_INDEX_DIRECTORY, file_name)
+
+    def changed_rows(self, rows):
+        '''Yields the rows that are new or changed, config.CHANGE_INDEX_BATCH_SIZE rows
+        being looked up in the index at a time.'''
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, config.CHANGE_INDEX_BATCH_SIZE))
+            if not batch:
+                return
+            for row in self._changed_rows_in_batch(batch):
+                yield row
+
+    @property
+    def deleted_keys(self):
+        '''Keys, as tuples, of rows that were loaded before but aren't in this snapshot.'''
+        if not self.report_deletions:
+            raise RuntimeError('deletions are only reported by a ChangeDetector made with report_deletions')
+        if self._deleted_keys is None:
+            self._deleted_keys = [tuple(json.loads(key)) for key, in self._connection.execute(
+                'SELECT key FROM row_hashes WHERE key NOT IN (SELECT key FROM snapshot_keys) ORDER BY key')]
+        return self._deleted_keys
+
+    def commit(self):
+        '''Records the new and changed rows in the index, once they've been loaded.'''
+        if self.report_deletions:
+            self.deleted_keys
+        with self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO row_hashes SELECT key, hash FROM pending_hashes')
+            self._connection.execute('DELETE FROM pending_hashes')
+
+    def rollback(self):
+        with self._connection:
+            self._connection.execute('DELETE FROM pending_hashes')
+
+    def forget(self, keys):
+        '''Drops rows from the index, e.g. once they've been deleted from the table.'''
+        with self._connection:
+            self._connection.executemany('DELETE FROM row_hashes WHERE key = ?',
+                                         [(self._encode_key(key),) for key in keys])
+
+    def reset(self):
+        '''Forgets everything, so the next snapshot is loaded in full.'''
+        with self._connection:
+            self._connection.execute('DELETE FROM row_hashes')
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, *exception_info):
+        if exception_type is not None:
+            self.rollback()
+        self.close()
+
+    def _changed_rows_in_batch(self, batch):
+        keyed_rows = [(self._encode_key([row[position] for position in self.key_positions]), row) for row in batch]
+        keys = [key for key, _ in keyed_rows]
+        if self.report_deletions:
+            self._connection.executemany('INSERT OR IGNORE INTO snapshot_keys VALUES (?)', [(key,) for key in keys])
+        known_hashes = self._known_hashes(keys)
+        pending_hashes = []
+        for key, row in keyed_rows:
+            row_hash = hashlib.md5(repr(tuple(row)).encode('utf-8')).digest()
+            known_hash = known_hashes.get(key)
+            if known_hash == row_hash:
+                self.unchanged += 1
+                continue
+            if known_hash is None:
+                self.inserted += 1
+            else:
+                self.changed += 1
+            known_hashes[key] = row_hash
+            pending_hashes.append((key, row_hash))
+            yield row
+        self._connection.executemany('INSERT OR REPLACE INTO pending_hashes VALUES (?, ?)', pending_hashes)
+
+    def _known_hashes(self, keys):
+        known_hashes = {}
+        # well within SQLite's default limit of 999 parameters a statement
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            known_hashes.update(self._connection.execute(
+                'SELECT key, hash FROM row_hashes WHERE key IN ({})'.format(', '.join('?' * len(chunk))), chunk))
+        return {key: bytes(row_hash) for key, row_hash in known_hashes.items()}
+
+    @staticmethod
+    def _encode_key(key_values):
+        return json.dumps(list(key_values), default=str)
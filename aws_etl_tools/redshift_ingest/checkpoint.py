@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+from threading import Lock
+
+from aws_etl_tools import config
+
+
+class IngestCheckpoint:
+    '''The progress of one resumable load into `destination`, kept in a local JSON file
+    named for the load's identity, `load_id`, under config.CHECKPOINT_DIRECTORY. It
+    notes the CSV parts written for the load, the multipart upload of each of them to
+    S3, and whether the COPY of them has been committed, so an attempt that picks up
+    after a failed one skips every step that was already done.
+
+    A COPY that commits just before the process dies can't be noted, in which case the
+    next attempt loads the same rows again; the upsert makes that harmless.
+    '''
+
+    def __init__(self, destination, load_id, path=None):
+        self.destination = destination
+        self.load_id = load_id
+        self.path = path or self.default_path(destination, load_id)
+        self._lock = Lock()
+        self.state = self._read() or {'load_id': load_id, 'parts': None, 'uploads': {}, 'committed': False}
+
+    @staticmethod
+    def default_path(destination, load_id):
+        credentials = getattr(destination.database, 'credentials', None) or {}
+        file_name = '{host}_{database}_{table}_{load}.json'.format(
+            host=credentials.get('host', 'local'),
+            database=credentials.get('database_name', destination.database.__class__.__name__.lower()),
+            table=destination.target_table,
+            load=hashlib.md5(str(load_id).encode('utf-8')).hexdigest()[:16])
+        return os.path.join(config.CHECKPOINT_DIRECTORY, file_name)
+
+    @property
+    def part_path_prefix(self):
+        '''Where the parts of the load are written, so a later attempt finds them.'''
+        return os.path.splitext(self.path)[0]
+
+    @property
+    def parts(self):
+        '''The local paths of the parts of the load, if they were all written and are
+        still there as they were; None otherwise.'''
+        parts = self.state['parts']
+        if parts is None or not all(os.path.isfile(part['path']) and os.path.getsize(part['path']) == part['size']
+                                    for part in parts):
+            return None
+        return [part['path'] for part in parts]
+
+    def record_parts(self, part_paths):
+        self.state['parts'] = [{'path': part_path, 'size': os.path.getsize(part_path)} for part_path in part_paths]
+        # uploads of parts that were written before are of no use anymore
+        self.state['uploads'] = {}
+        self.save()
+
+    def upload_state(self, part_path, s3_path):
+        '''The dict noting the progress of the upload of a part, which is uploaded to
+        `s3_path` unless an earlier attempt started uploading it somewhere else.'''
+        return self.state['uploads'].setdefault(part_path, {'s3_path': s3_path})
+
+    @property
+    def committed(self):
+        return self.state['committed']
+
+    def record_committed(self):
+        self.state['committed'] = True
+        self.save()
+
+    def save(self):
+        '''Replaces the checkpoint file whole, so it's never left half written.'''
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            temporary_path = self.path + '.tmp'
+            with open(temporary_path, 'w') as checkpoint_file:
+                json.dump(self.state, checkpoint_file)
+            os.replace(temporary_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as checkpoint_file:
+            state = json.load(checkpoint_file)
+        # a different load that happens to hash the same starts over
+        return state if state.get('load_id') == self.load_id else None
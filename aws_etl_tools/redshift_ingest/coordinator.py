@@ -0,0 +1,145 @@
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+
+from aws_etl_tools import config
+from aws_etl_tools.redshift_ingest.sources import from_manifest, from_s3_path
+
+
+_QueuedLoad = namedtuple('_QueuedLoad', ['s3_path', 'destination', 'ingestion_args', 'future'])
+
+
+class IngestCoordinator:
+    '''Runs upserts from S3 for many callers without letting them trip over each other.
+    Loads into the same table run one at a time, so their transactions can't abort each
+    other with serializable isolation violations, while loads into different tables run
+    in parallel on up to `max_workers` (default: config.INGEST_COORDINATOR_MAX_WORKERS)
+    threads.
+
+    Loads queued up behind a running load into the same table are, when `merge_loads`
+    is set and their ingestion arguments match, run together as one COPY from a combined
+    manifest. A COPY doesn't keep track of which file each row came from, so a later
+    file's rows can't replace an earlier file's rows with the same upsert key: they'd all
+    end up in the table. Loads are only merged when asked to, for loads whose keys
+    never overlap.
+
+    Serializing happens within this process. With `lock_in_database`, each upsert also
+    takes a LOCK on its target table, for when other processes load the same tables.
+
+    With a WlmConcurrencyController as `concurrency`, each load also holds one of its
+    slots while it runs, so how many run at once follows how busy the cluster's WLM
+    queue is, up to `max_workers`, which then defaults to the controller's
+    `max_concurrency`.
+
+        with IngestCoordinator() as coordinator:
+            futures = [coordinator.submit(s3_path, destination) for s3_path in s3_paths]
+        for future in futures:
+            future.result()
+    '''
+
+    def __init__(self, max_workers=None, merge_loads=False, lock_in_database=False, concurrency=None):
+        self.merge_loads = merge_loads
+        self.lock_in_database = lock_in_database
+        self.concurrency = concurrency
+        default_workers = concurrency.max_concurrency if concurrency else config.INGEST_COORDINATOR_MAX_WORKERS
+        self._executor = ThreadPoolExecutor(max_workers or default_workers)
+        self._lock = Lock()
+        self._queued_loads = {}
+        self._busy_tables = set()
+        self._is_shut_down = False
+
+    def submit(self, s3_file_or_path, destination, **ingestion_args):
+        '''Queues an upsert of a CSV or manifest in S3 into `destination`. Returns a
+        concurrent.futures.Future that resolves once the data is committed, or raises
+        what the load raised.'''
+        if self.lock_in_database:
+            ingestion_args.setdefault('lock_target', True)
+        s3_path = getattr(s3_file_or_path, 's3_path', s3_file_or_path)
+        load = _QueuedLoad(s3_path, destination, ingestion_args, Future())
+        table = self._table_key(destination)
+        with self._lock:
+            if self._is_shut_down:
+                raise RuntimeError('cannot submit loads after the coordinator has shut down')
+            self._queued_loads.setdefault(table, []).append(load)
+            if table in self._busy_tables:
+                return load.future
+            self._busy_tables.add(table)
+        self._executor.submit(self._load_table, table)
+        return load.future
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._is_shut_down = True
+        self._executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        self.shutdown()
+
+    def _load_table(self, table):
+        '''Works through a table's queue until it's empty. Only one of these runs per table.'''
+        while True:
+            with self._lock:
+                loads = self._queued_loads.pop(table, [])
+                if not loads:
+                    self._busy_tables.discard(table)
+                    return
+            for batch in self._batches(loads):
+                self._run_batch(batch)
+
+    def _batches(self, loads):
+        '''Groups consecutive loads that can share a manifest, keeping submission order.'''
+        batches = []
+        for load in loads:
+            if not load.future.set_running_or_notify_cancel():
+                continue
+            if batches and self._can_merge(batches[-1][-1], load):
+                batches[-1].append(load)
+            else:
+                batches.append([load])
+        return batches
+
+    def _can_merge(self, earlier_load, load):
+        ingestion_class = load.destination.database.ingestion_class
+        return (
+            self.merge_loads and
+            getattr(ingestion_class, 'supports_manifests', True) and
+            not load.ingestion_args.get('with_manifest') and
+            load.ingestion_args == earlier_load.ingestion_args and
+            load.destination.upsert_uniqueness_key == earlier_load.destination.upsert_uniqueness_key
+        )
+
+    def _run_batch(self, batch):
+        try:
+            if self.concurrency is None:
+                self._load_batch(batch)
+            else:
+                with self.concurrency.slot():
+                    self._load_batch(batch)
+        except Exception as error:
+            for load in batch:
+                load.future.set_exception(error)
+        else:
+            for load in batch:
+                load.future.set_result(None)
+
+    @staticmethod
+    def _load_batch(batch):
+        first_load = batch[0]
+        if len(batch) == 1:
+            from_s3_path(first_load.s3_path, first_load.destination, **first_load.ingestion_args)
+        else:
+            manifest = {'entries': [{'url': load.s3_path, 'mandatory': True} for load in batch]}
+            from_manifest(manifest, first_load.destination, **first_load.ingestion_args)
+
+    @staticmethod
+    def _table_key(destination):
+        credentials = getattr(destination.database, 'credentials', None) or {}
+        return (
+            credentials.get('host'),
+            credentials.get('port'),
+            credentials.get('database_name'),
+            destination.target_table
+        )
@@ -0,0 +1,84 @@
+from collections import namedtuple
+
+from aws_etl_tools import config
+
+
+CopyOption = namedtuple('CopyOption', ['option', 'reason'])
+
+
+class CopyPolicy:
+    '''How forgiving COPYs into a RedshiftTable are about bad data. With
+    `accept_invalid_chars`, characters that aren't valid UTF-8 are replaced rather
+    than failing the load: by Redshift's default, '?', if it's True, or else by the
+    one character it's set to. With `truncate_columns`, strings too long for their
+    column are cut down to fit.'''
+
+    def __init__(self, accept_invalid_chars=None, truncate_columns=False):
+        is_flag = accept_invalid_chars is None or isinstance(accept_invalid_chars, bool)
+        if not is_flag and not (isinstance(accept_invalid_chars, str) and len(accept_invalid_chars) == 1):
+            raise ValueError('accept_invalid_chars must be True or one replacement character, not {!r}'.format(
+                accept_invalid_chars))
+        self.accept_invalid_chars = accept_invalid_chars
+        self.truncate_columns = truncate_columns
+
+
+def plan_copy_options(ingestor):
+    '''Picks the options for an ingestor's COPY into its staging table, as a list of
+    CopyOptions that each say why they were chosen.'''
+    staging_reason = 'the staging table is dropped after the upsert, so {} would be thrown away'
+    plan = [
+        CopyOption('EMPTYASNULL', 'empty fields load as NULL'),
+        CopyOption('BLANKSASNULL', 'fields of only whitespace load as NULL'),
+        CopyOption("TIMEFORMAT AS 'auto'", 'timestamps arrive in more than one format'),
+        CopyOption('COMPUPDATE OFF', staging_reason.format('automatic compression analysis')),
+        CopyOption('STATUPDATE OFF', staging_reason.format('its statistics'))
+    ]
+    if ingestor.with_manifest:
+        plan.append(CopyOption('MANIFEST', 'the load is a manifest of files'))
+    if ingestor.gzip:
+        plan.append(CopyOption('GZIP', 'the files are gzipped'))
+    plan.extend(_max_errors_options(ingestor))
+    plan.extend(_table_policy_options(ingestor.destination))
+    if ingestor.jsonpaths:
+        plan.append(CopyOption("JSON '{}'".format(ingestor.jsonpaths), 'the files are JSON mapped by jsonpaths'))
+    else:
+        plan.append(CopyOption('CSV', 'the files are CSV'))
+        plan.append(CopyOption('IGNOREBLANKLINES', 'blank lines in CSV files are not rows'))
+    return plan
+
+
+def _max_errors_options(ingestor):
+    if ingestor.max_errors is not None:
+        return [CopyOption('MAXERROR %s' % ingestor.max_errors, 'max_errors was given for this load')]
+    if ingestor.load_class is None:
+        return []
+    try:
+        max_errors = config.COPY_MAX_ERRORS_BY_LOAD_CLASS[ingestor.load_class]
+    except KeyError:
+        raise ValueError('{load_class!r} is not one of the load classes in config.COPY_MAX_ERRORS_BY_LOAD_CLASS: '
+                         '{load_classes}'.format(load_class=ingestor.load_class,
+                                                 load_classes=', '.join(sorted(config.COPY_MAX_ERRORS_BY_LOAD_CLASS))))
+    return [CopyOption('MAXERROR %s' % max_errors, 'the {load_class} load class allows {max_errors} errors'.format(
+        load_class=ingestor.load_class, max_errors=max_errors))]
+
+
+def _table_policy_options(destination):
+    policy = getattr(destination, 'copy_policy', None)
+    if policy is None:
+        return []
+    options = []
+    if policy.accept_invalid_chars:
+        options.append(CopyOption(_accept_invalid_chars_option(policy.accept_invalid_chars),
+                                  "{}'s copy policy replaces invalid UTF-8 characters".format(destination.target_table)))
+    if policy.truncate_columns:
+        options.append(CopyOption('TRUNCATECOLUMNS',
+                                  "{}'s copy policy truncates strings too long for their column".format(
+                                      destination.target_table)))
+    return options
+
+
+def _accept_invalid_chars_option(replacement_char):
+    if replacement_char is True:
+        return 'ACCEPTINVCHARS'
+    from psycopg2.extensions import adapt
+    return 'ACCEPTINVCHARS AS {}'.format(adapt(replacement_char).getquoted().decode('utf-8'))
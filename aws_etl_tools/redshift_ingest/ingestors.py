@@ -4,29 +4,68 @@ import json
 import os
 from uuid import uuid4 as uuid
 
-from psycopg2 import DatabaseError
-
 from aws_etl_tools.aws import AWS
+from aws_etl_tools.csv_encoding import format_row
+from aws_etl_tools.redshift_ingest.copy_options import plan_copy_options
+from aws_etl_tools.redshift_ingest.load_profile import LoadProfile
 from aws_etl_tools.s3_file import S3File
 from aws_etl_tools import config
 
 
+# whether psycopg2 can pass values of a type as query parameters, by type
+_ADAPTABLE_TYPES = {}
+
+
+def _is_adaptable(value):
+    from psycopg2 import ProgrammingError
+    from psycopg2.extensions import adapt
+    value_type = type(value)
+    if value_type not in _ADAPTABLE_TYPES:
+        try:
+            adapt(value)
+        except ProgrammingError:
+            _ADAPTABLE_TYPES[value_type] = False
+        else:
+            _ADAPTABLE_TYPES[value_type] = True
+    return _ADAPTABLE_TYPES[value_type]
+
+
 class BasicUpsert:
-    def __init__(self, file_path, destination, with_manifest=False, jsonpaths=None, gzip=None, max_errors=None):
+    # whether `file_path` may be a manifest listing several files
+    supports_manifests = True
+
+    def __init__(self, file_path, destination, with_manifest=False, jsonpaths=None, gzip=None, max_errors=None,
+                 columns=None, rows=None, lock_target=False, load_class=None, skip_unchanged=False,
+                 compare_columns=None, range_columns=None):
         self.file_path = file_path
+        self.destination = destination
         self.database = destination.database
+        self.columns = columns
+        self.rows = rows
+        self.lock_target = lock_target
         self.with_manifest = with_manifest
         self.jsonpaths = jsonpaths
         self.gzip = gzip
         self.max_errors = max_errors
+        self.load_class = load_class
+        self.skip_unchanged = skip_unchanged or bool(compare_columns)
+        self.compare_columns = compare_columns
+        self._range_columns = range_columns
         self.target_table = destination.target_table
         self.schema_name, self.table_name = self.target_table.split('.')
         self.staging_table = destination.unique_identifier
         self.upsert_keys = destination.upsert_uniqueness_key
 
     def __call__(self):
+        from psycopg2 import DatabaseError
         self.before_ingest()
-        self.ingest()
+        try:
+            self.ingest()
+        except DatabaseError:
+            # a failed load is the first sign that the target table's DDL may have
+            # changed, so don't let the next attempt trust the cached schema.
+            self.destination.invalidate_schema()
+            raise
         self.after_ingest()
         self.final_cleanup()
 
@@ -43,58 +82,228 @@ class BasicUpsert:
     def connection_string(self):
         return AWS().connection_string()
 
+    @property
+    def column_names(self):
+        '''The columns in the file being loaded, in file order. Unless the source says
+        otherwise, that's every column of the target table in ordinal order. Empty if the
+        target table could not be introspected, in which case loads fall back to matching
+        columns by position.'''
+        if self.columns:
+            return list(self.columns)
+        return self.destination.column_names
+
+    @property
+    def range_columns(self):
+        '''The columns whose range among the staged rows bounds the DELETE, so Redshift's
+        zone maps can skip the blocks of the target outside it. A row must have the same
+        value in them in the target as in the staging table, or it won't be replaced: a
+        time-partitioned table's event time, say, but not an `updated_at`. True takes the
+        target's sort keys that are part of the upsert key, which always qualify.'''
+        if self._range_columns is True:
+            return [sort_key for sort_key in self.destination.schema.sort_keys if sort_key in self.upsert_keys]
+        if isinstance(self._range_columns, str):
+            return [self._range_columns]
+        return list(self._range_columns or ())
+
+    def _column_list(self):
+        return ', '.join('"%s"' % column_name for column_name in self.column_names)
+
     def ingest(self):
-        self.database.execute(self._ingest_query())
+        if self.rows is not None:
+            self._ingest_rows()
+        elif self.range_columns:
+            self._ingest_in_steps()
+        else:
+            self.database.execute(self._ingest_query())
 
     def _ingest_query(self):
         return """
             BEGIN TRANSACTION;
 
-            CREATE TEMP TABLE {staging_table} (LIKE {target_table});
+            {create_staging_statement}
             {copy_statement};
-            DELETE FROM {target_table} USING {staging_table} WHERE ({upsert_match_statement});
-            {insert_statement};
-            DROP TABLE {staging_table};
+            {merge_statement}
 
             END TRANSACTION;
         """.format(
-                target_table=self.target_table,
-                staging_table=self.staging_table,
+                create_staging_statement=self._create_staging_statement(),
                 copy_statement=self._copy_statement(),
+                merge_statement=self._merge_statement()
+            )
+
+    def _ingest_in_steps(self, final_statement=''):
+        '''The same transaction as `_ingest_query`, but with a round trip between the
+        COPY and the merge to read the range of the staged rows, which only helps the
+        merge as literals. Returns what `final_statement`, run after it, fetches.'''
+        cursor = self.database.make_new_cursor()
+        try:
+            self._stage_file(cursor)
+            cursor.execute(self._merge_statement(self._staged_range_statement(cursor)) +
+                           '\nEND TRANSACTION;\n' + final_statement)
+            return cursor.fetchall() if final_statement else None
+        finally:
+            # closing before END TRANSACTION rolls everything back
+            cursor.connection.close()
+
+    def _stage_file(self, cursor):
+        cursor.execute('BEGIN TRANSACTION;\n{create_staging_statement}\n{copy_statement};'.format(
+            create_staging_statement=self._create_staging_statement(),
+            copy_statement=self._copy_statement()
+        ))
+
+    def _staged_range_statement(self, cursor):
+        '''Literal bounds on the target's `range_columns`, from the staged rows. Target
+        rows with NULLs in them are kept in range if any staged rows have NULLs too.'''
+        range_columns = self.range_columns
+        if not range_columns:
+            return ''
+        cursor.execute('SELECT {aggregates} FROM {staging_table}'.format(
+            aggregates=', '.join('MIN("{0}"), MAX("{0}"), COUNT(*) - COUNT("{0}")'.format(column)
+                                 for column in range_columns),
+            staging_table=self.staging_table
+        ))
+        bounds = cursor.fetchone()
+        predicates = []
+        for position, column in enumerate(range_columns):
+            low, high, null_count = bounds[3 * position:3 * position + 3]
+            if low is None:
+                # nothing staged, or only NULLs
+                continue
+            predicate = cursor.mogrify('{target_table}."{column}" BETWEEN %s AND %s'.format(
+                target_table=self.target_table, column=column), (low, high)).decode('utf-8')
+            if null_count:
+                predicate = '({predicate} OR {target_table}."{column}" IS NULL)'.format(
+                    predicate=predicate, target_table=self.target_table, column=column)
+            predicates.append(predicate)
+        return ' AND '.join(predicates)
+
+    def _ingest_rows(self):
+        '''Small loads skip S3 and COPY, which have a high fixed cost, and go into the
+        staging table as multi-row INSERTs within the same upsert transaction.'''
+        from psycopg2.extras import execute_values
+        cursor = self.database.make_new_cursor()
+        try:
+            cursor.execute('BEGIN TRANSACTION;\n' + self._create_staging_statement())
+            execute_values(
+                cursor,
+                self._staging_insert_statement(),
+                (self._staging_row(row) for row in self.rows),
+                page_size=config.SMALL_PAYLOAD_INSERT_BATCH_SIZE
+            )
+            cursor.execute(self._merge_statement(self._staged_range_statement(cursor)) + '\nEND TRANSACTION;')
+        finally:
+            # closing before END TRANSACTION rolls everything back
+            cursor.connection.close()
+
+    def _create_staging_statement(self):
+        statement = "CREATE TEMP TABLE {staging_table} (LIKE {target_table});".format(
+            staging_table=self.staging_table,
+            target_table=self.target_table
+        )
+        if self.lock_target:
+            # concurrent upserts into the same table then wait for each other, rather
+            # than one of them being aborted with a serializable isolation violation.
+            statement = "LOCK {target_table};\n".format(target_table=self.target_table) + statement
+        return statement
+
+    def _merge_statement(self, range_statement=''):
+        return """
+            {prune_unchanged_statement}
+            {delete_statement}
+            {insert_statement};
+            DROP TABLE {staging_table};
+        """.format(
+                staging_table=self.staging_table,
                 insert_statement=self._insert_statement(),
-                upsert_match_statement=self._upsert_match_statement()
+                delete_statement=self._delete_statement(range_statement),
+                prune_unchanged_statement=self._prune_unchanged_statement(range_statement)
             )
 
-    @property
-    def copy_parameters(self):
-        copy_parameters = ["EMPTYASNULL", "BLANKSASNULL", "TIMEFORMAT AS 'auto'", "STATUPDATE ON"]
-        copy_parameters.append('MANIFEST') if self.with_manifest else None
-        copy_parameters.append('GZIP') if self.gzip else None
-        copy_parameters.append('MAXERROR %s' % self.max_errors) if self.max_errors else None
+    def _delete_statement(self, range_statement=''):
+        return "DELETE FROM {target_table} USING {staging_table} WHERE ({upsert_match_statement}){range};".format(
+            target_table=self.target_table,
+            staging_table=self.staging_table,
+            upsert_match_statement=self._upsert_match_statement(),
+            range=' AND ' + range_statement if range_statement else ''
+        )
 
-        if self.jsonpaths:
-            copy_parameters.append("JSON '{}'".format(self.jsonpaths))
-        else:
-            copy_parameters.extend(['CSV', 'IGNOREBLANKLINES'])
+    def _prune_unchanged_statement(self, range_statement=''):
+        '''With `skip_unchanged`, staged rows identical to the target rows they'd replace
+        are dropped before the merge, so re-delivered data doesn't delete and reinsert
+        rows for nothing, leaving dead rows to vacuum and unsorted regions behind.
+        Identical means equal, or both NULL, in every `compare_columns`, which can be a
+        version or hash column the source keeps, and otherwise every loaded column. That
+        can't be told if the target table could not be introspected, so nothing is.'''
+        compare_columns = self.compare_columns or self.column_names
+        if not self.skip_unchanged or not compare_columns:
+            return ''
+        if isinstance(compare_columns, str):
+            compare_columns = [compare_columns]
+        return """
+            DELETE FROM {staging_table} USING {target_table} WHERE ({upsert_match_statement}){range} AND {unchanged};
+        """.format(
+            staging_table=self.staging_table,
+            target_table=self.target_table,
+            upsert_match_statement=self._upsert_match_statement(),
+            range=' AND ' + range_statement if range_statement else '',
+            # IS NOT DISTINCT FROM isn't supported by Redshift
+            unchanged=' AND '.join(
+                '({target}."{column}" = {staging}."{column}" OR '
+                '({target}."{column}" IS NULL AND {staging}."{column}" IS NULL))'.format(
+                    target=self.target_table, staging=self.staging_table, column=column)
+                for column in compare_columns)
+        )
+
+    def _staging_insert_statement(self):
+        return "INSERT INTO {staging_table}{column_list} VALUES %s".format(
+            staging_table=self.staging_table,
+            column_list=' (%s)' % self._column_list() if self.column_names else ''
+        )
+
+    @staticmethod
+    def _staging_row(row):
+        '''The values of `row` as a CSV COPY would load them: formatted as they would
+        be written to the CSV, anything psycopg2 can't pass as a parameter, like a UUID,
+        as its str(), and empty or blank text as NULL, as EMPTYASNULL and BLANKSASNULL do.'''
+        staging_row = []
+        for value in format_row(row):
+            if value is not None and not _is_adaptable(value):
+                value = str(value)
+            staging_row.append(None if isinstance(value, str) and not value.strip() else value)
+        return tuple(staging_row)
 
-        return copy_parameters
+    @property
+    def copy_plan(self):
+        '''The COPY options for this load, each with the reason it was chosen.'''
+        return plan_copy_options(self)
+
+    @property
+    def copy_parameters(self):
+        return [copy_option.option for copy_option in self.copy_plan]
 
     def _copy_statement(self):
         return """
-            COPY {staging_table} FROM '{s3_path}'
+            COPY {staging_table}{column_list} FROM '{s3_path}'
             WITH CREDENTIALS AS '{connection_string}'
             {copy_commands}
         """.format(
             staging_table=self.staging_table,
+            column_list=' (%s)' % self._column_list() if self.column_names else '',
             s3_path=self.file_path,
             connection_string=self.connection_string,
             copy_commands="\n".join(self.copy_parameters)
         )
 
     def _insert_statement(self):
-        return "INSERT INTO {target_table} SELECT * FROM {staging_table}".format(
+        if not self.column_names:
+            return "INSERT INTO {target_table} SELECT * FROM {staging_table}".format(
+                target_table=self.target_table,
+                staging_table=self.staging_table
+            )
+        return "INSERT INTO {target_table} ({column_list}) SELECT {column_list} FROM {staging_table}".format(
             target_table=self.target_table,
-            staging_table=self.staging_table
+            staging_table=self.staging_table,
+            column_list=self._column_list()
         )
 
     def _upsert_match_statement(self):
@@ -111,6 +320,7 @@ class AuditedUpsert(BasicUpsert):
         super().__init__(file_path, destination, **kwargs)
         self.uuid = None
         self.load_start_time = None
+        self.load_profile = None
         self.audit_table = config.REDSHIFT_INGEST_AUDIT_TABLE
 
     def before_ingest(self):
@@ -137,24 +347,55 @@ class AuditedUpsert(BasicUpsert):
         )
 
     def final_cleanup(self):
+        from psycopg2 import DatabaseError
+        # only RedshiftDatabase can rebuild a table that's too unsorted for a VACUUM
+        maintain_table = getattr(self.database, 'maintain_table', None)
         try:
-            self.database.execute("""VACUUM {target_table};""".format(target_table=self.target_table))
+            if maintain_table is None:
+                self.database.execute("""VACUUM {target_table};""".format(target_table=self.target_table))
+            else:
+                maintain_table(self.target_table)
         except DatabaseError:
-            # this is a result of multiple vacuums running simultaneously
+            # this is usually a result of multiple vacuums running simultaneously
             # it's not a big deal to swallow this exception, because the
-            # table will be vacuumed later
+            # table will be vacuumed or rebuilt later
             pass
 
 
     def ingest(self):
-        self._upsert_query_id = self.database.fetch(self._ingest_query())[0][0]
+        if self.rows is not None:
+            # inserted rows don't go through a COPY, so there's no COPY to audit
+            self.rows = list(self.rows)
+            super().ingest()
+            self._upsert_query_id = None
+        elif self.range_columns:
+            self._upsert_query_id = self._ingest_in_steps('SELECT PG_LAST_COPY_ID();')[0][0]
+        else:
+            self._upsert_query_id = self.database.fetch(self._ingest_query())[0][0]
+        self.load_profile = self._profile_load()
         self.ingest_results = self._fetch_ingest_results()
 
     def _ingest_query(self):
         basic_upsert_command = super()._ingest_query()
         return basic_upsert_command + "\nSELECT PG_LAST_COPY_ID();"
 
+    def _profile_load(self):
+        from psycopg2 import DatabaseError
+        if self._upsert_query_id is None:
+            return None
+        try:
+            return LoadProfile.fetch(self.database, self._upsert_query_id)
+        except DatabaseError:
+            # the data is committed by now, and a missing profile isn't worth failing the load over
+            return None
+
     def _fetch_ingest_results(self):
+        if self._upsert_query_id is None:
+            return json.dumps(OrderedDict([
+                ('query_id', None),
+                ('filename', None),
+                ('lines_scanned', len(self.rows))
+            ]))
         ingest_results = self.database.fetch("""
             SELECT COALESCE(load_errors.query, load_commits.query) AS query_id
             , BTRIM(COALESCE(load_errors.filename, load_commits.filename)) AS filename
@@ -186,34 +427,60 @@ class AuditedUpsert(BasicUpsert):
             'err_reason'
         ]
         # OrderedDict is used to preserve the column order when dumped to json
-        return json.dumps(OrderedDict(zip(ingest_results_keys, ingest_results_values)))
+        ingest_results = OrderedDict(zip(ingest_results_keys, ingest_results_values))
+        ingest_results['copy_options'] = [copy_option._asdict() for copy_option in self.copy_plan]
+        ingest_results['profile'] = self.load_profile.to_dict() if self.load_profile else None
+        return json.dumps(ingest_results)
 
 
-class AuditedUpsertToPostgres(AuditedUpsert):
-    # For testing and development, it can be useful to have a local postgres
-    # that behaves very similarly to the hosted Redshift.
-    # The differences are:
-    # 1) download the file from s3 so the ingest can be local
-    # 2) remove all the remote and redshifty things from the COPY command
-    # 3) the ingest result tables are redshift-specific. so we'll just stub that out.
+class UpsertToPostgres(BasicUpsert):
+    # Postgres COPYs from the client rather than from S3, so the file is downloaded
+    # first, or read from `stream`, any file-like object, without touching disk. The
+    # COPY loses all the remote and redshifty options.
+    supports_manifests = False
 
-    def __init__(self, file_path, destination, **kwargs):
-        local_file_path = S3File(file_path).download_to_temp()
+    def __init__(self, file_path, destination, stream=None, **kwargs):
+        local_file_path = S3File(file_path).download_to_temp() if file_path else None
         super().__init__(local_file_path, destination, **kwargs)
+        self.stream = stream
         if self.with_manifest:
             raise ValueError("Postgres cannot handle manifests like redshift. Sorry.")
 
     def ingest(self):
+        if self.rows is not None:
+            return super().ingest()
+        if self.range_columns:
+            return self._ingest_in_steps()
+        self._copy_expert(self.database.make_new_cursor(), self._ingest_query())
+
+    def _stage_file(self, cursor):
+        self._copy_expert(cursor, 'BEGIN TRANSACTION;\n{create_staging_statement}\n{copy_statement}'.format(
+            create_staging_statement=self._create_staging_statement(),
+            copy_statement=self._copy_statement()
+        ))
+
+    def _copy_expert(self, cursor, statement):
+        if self.stream is not None:
+            return cursor.copy_expert(statement, self.stream)
         with open(self.file_path) as local_file:
-            cursor = self.database.make_new_cursor()
-            cursor.copy_expert(self._ingest_query(), local_file)
+            cursor.copy_expert(statement, local_file)
 
     def _copy_statement(self):
         return """
-            COPY {staging_table} FROM STDIN CSV;
+            COPY {staging_table}{column_list} FROM STDIN CSV;
         """.format(
-            staging_table=self.staging_table
+            staging_table=self.staging_table,
+            column_list=' (%s)' % self._column_list() if self.column_names else ''
         )
 
+
+class AuditedUpsertToPostgres(UpsertToPostgres, AuditedUpsert):
+    # For testing and development, it can be useful to have a local postgres
+    # that behaves very similarly to the hosted Redshift.
+    # The differences are:
+    # 1) download the file from s3 so the ingest can be local
+    # 2) remove all the remote and redshifty things from the COPY command
+    # 3) the ingest result tables are redshift-specific. so we'll just stub that out.
+
     def _fetch_ingest_results(self):
         return '{}'
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+
+
+MICROSECONDS_PER_SECOND = 1000000.0
+# the statements of an upsert transaction, by the first word of their query text,
+# which often comes after newlines and indentation
+UPSERT_STEPS = ('copy', 'delete', 'insert')
+
+
+class LoadProfile:
+    '''Where the time went in one COPY upsert, from Redshift's system tables:
+
+        `files`: a dict per file loaded, with its bytes, lines and load seconds
+        `slices`: a dict per slice that read files, with its bytes and load seconds
+        `queue_seconds` and `execution_seconds`: the COPY's time waiting in and running
+            in its WLM queue
+        `step_seconds`: the run time of the COPY, DELETE and INSERT of the transaction
+
+    `slice_skew` compares the slowest slice with the average one. Far above 1, a few
+    large files are holding up the load, and splitting them up would speed it up.'''
+
+    def __init__(self, query_id, files, slices, queue_seconds, execution_seconds, step_seconds):
+        self.query_id = query_id
+        self.files = files
+        self.slices = slices
+        self.queue_seconds = queue_seconds
+        self.execution_seconds = execution_seconds
+        self.step_seconds = step_seconds
+
+    @property
+    def slice_skew(self):
+        load_seconds = [loaded_slice['load_seconds'] for loaded_slice in self.slices]
+        if not load_seconds or not sum(load_seconds):
+            return None
+        return max(load_seconds) / (sum(load_seconds) / len(load_seconds))
+
+    def to_dict(self):
+        return OrderedDict([
+            ('query_id', self.query_id),
+            ('queue_seconds', self.queue_seconds),
+            ('execution_seconds', self.execution_seconds),
+            ('step_seconds', self.step_seconds),
+            ('slice_skew', self.slice_skew),
+            ('slices', self.slices),
+            ('files', self.files)
+        ])
+
+    @classmethod
+    def fetch(cls, database, query_id):
+        '''Profiles the COPY with the given query id, along with the rest of its transaction.'''
+        files = _file_profiles(database, query_id)
+        slices = _slice_profiles(database, query_id)
+        queue_seconds, execution_seconds = _wlm_seconds(database, query_id)
+        return cls(query_id, files, slices, queue_seconds, execution_seconds, _step_seconds(database, query_id))
+
+
+def _file_profiles(database, query_id):
+    rows = database.fetch("""
+        SELECT BTRIM(name) AS filename
+        , SUM(bytes) AS bytes
+        , SUM(lines) AS lines
+        , SUM(loadtime) AS load_microseconds
+        FROM STL_FILE_SCAN
+        WHERE query = %(query_id)s
+        GROUP BY 1
+        ORDER BY 1
+        """, {'query_id': query_id})
+    return [OrderedDict([
+        ('filename', filename),
+        ('bytes', int(file_bytes)),
+        ('lines', int(lines)),
+        ('load_seconds', float(load_microseconds) / MICROSECONDS_PER_SECOND)
+    ]) for filename, file_bytes, lines, load_microseconds in rows]
+
+
+def _slice_profiles(database, query_id):
+    rows = database.fetch("""
+        SELECT slice
+        , COUNT(DISTINCT name) AS files
+        , SUM(bytes) AS bytes
+        , SUM(loadtime) AS load_microseconds
+        FROM STL_FILE_SCAN
+        WHERE query = %(query_id)s
+        GROUP BY 1
+        ORDER BY 1
+        """, {'query_id': query_id})
+    return [OrderedDict([
+        ('slice', slice_number),
+        ('files', int(files)),
+        ('bytes', int(slice_bytes)),
+        ('load_seconds', float(load_microseconds) / MICROSECONDS_PER_SECOND)
+    ]) for slice_number, files, slice_bytes, load_microseconds in rows]
+
+
+def _wlm_seconds(database, query_id):
+    rows = database.fetch("""
+        SELECT total_queue_time
+        , total_exec_time
+        FROM STL_WLM_QUERY
+        WHERE query = %(query_id)s
+        """, {'query_id': query_id})
+    if not rows:
+        return None, None
+    queue_microseconds, execution_microseconds = rows[0]
+    return (float(queue_microseconds) / MICROSECONDS_PER_SECOND,
+            float(execution_microseconds) / MICROSECONDS_PER_SECOND)
+
+
+def _step_seconds(database, query_id):
+    rows = database.fetch("""
+        SELECT LOWER(REGEXP_SUBSTR(transaction_query.querytxt, '[A-Za-z]+')) AS step
+        , transaction_query.starttime
+        , transaction_query.endtime
+        FROM STL_QUERY copy_query
+        JOIN STL_QUERY transaction_query
+        ON transaction_query.xid = copy_query.xid
+        WHERE copy_query.query = %(query_id)s
+        ORDER BY transaction_query.starttime
+        """, {'query_id': query_id})
+    step_seconds = OrderedDict()
+    for step, started_at, ended_at in rows:
+        if step in UPSERT_STEPS:
+            step_seconds[step] = step_seconds.get(step, 0) + (ended_at - started_at).total_seconds()
+    return step_seconds
@@ -1,13 +1,64 @@
+from collections import namedtuple
 from datetime import datetime
+from threading import Lock
+import time
+
+from aws_etl_tools import config
+
+
+Column = namedtuple('Column', [
+    'name',
+    'data_type',
+    'is_nullable',
+    'character_maximum_length',
+    'numeric_precision',
+    'numeric_scale'
+])
+
+
+class TableSchema:
+    '''What the database says a table looks like: its columns in ordinal order, plus
+    the distribution key and sort keys when the database is Redshift.'''
+
+    def __init__(self, columns, dist_key=None, sort_keys=()):
+        self.columns = list(columns)
+        self.dist_key = dist_key
+        self.sort_keys = tuple(sort_keys)
+
+    @property
+    def column_names(self):
+        return [column.name for column in self.columns]
+
+    def column(self, name):
+        for column in self.columns:
+            if column.name == name:
+                return column
+        raise KeyError(name)
+
+    def __bool__(self):
+        return len(self.columns) > 0
+
+
+# introspection results are shared by every RedshiftTable pointing at the same
+# table on the same database, so repeated loads only pay for it once.
+_SCHEMA_CACHE = {}
+_SCHEMA_CACHE_LOCK = Lock()
+
+
+def clear_schema_cache():
+    with _SCHEMA_CACHE_LOCK:
+        _SCHEMA_CACHE.clear()
 
 
 class RedshiftTable:
 
-    def __init__(self, database, target_table, upsert_uniqueness_key):
+    def __init__(self, database, target_table, upsert_uniqueness_key, copy_policy=None):
+        '''`copy_policy` is an optional CopyPolicy for how forgiving loads into this table are.'''
         self.database = database
         self.target_table = target_table
         self.table_schema, self.table_name = self.target_table.split('.')
         self.upsert_uniqueness_key = upsert_uniqueness_key
+        self.copy_policy = copy_policy
         self.instantiation_timestamp = datetime.utcnow()
 
     @property
@@ -16,3 +67,81 @@ class RedshiftTable:
             'table_name': self.table_name,
             'timestamp': self.instantiation_timestamp.strftime('%Y_%m_%d_%H_%M_%S')
         }
+
+    @property
+    def schema(self):
+        '''The introspected TableSchema of the target table. It is cached for
+        config.TABLE_SCHEMA_CACHE_SECONDS; call `invalidate_schema` after changing
+        the table's DDL. A table that does not exist yet is never cached.'''
+        cache_key = self._schema_cache_key()
+        with _SCHEMA_CACHE_LOCK:
+            cached = _SCHEMA_CACHE.get(cache_key)
+        if cached is not None:
+            schema, fetched_at = cached
+            if time.time() - fetched_at < config.TABLE_SCHEMA_CACHE_SECONDS:
+                return schema
+
+        schema = self._introspect_schema()
+        if schema:
+            with _SCHEMA_CACHE_LOCK:
+                _SCHEMA_CACHE[cache_key] = (schema, time.time())
+        return schema
+
+    @property
+    def column_names(self):
+        return self.schema.column_names
+
+    def invalidate_schema(self):
+        with _SCHEMA_CACHE_LOCK:
+            _SCHEMA_CACHE.pop(self._schema_cache_key(), None)
+
+    def _schema_cache_key(self):
+        credentials = getattr(self.database, 'credentials', None) or {}
+        return (
+            credentials.get('host'),
+            credentials.get('port'),
+            credentials.get('database_name'),
+            self.target_table
+        )
+
+    def _introspect_schema(self):
+        columns = [Column(*row) for row in self.database.fetch("""
+            SELECT column_name
+            , data_type
+            , is_nullable = 'YES'
+            , character_maximum_length
+            , numeric_precision
+            , numeric_scale
+            FROM information_schema.columns
+            WHERE table_schema = %(table_schema)s
+            AND table_name = %(table_name)s
+            ORDER BY ordinal_position
+            """, {'table_schema': self.table_schema, 'table_name': self.table_name})]
+        dist_key, sort_keys = self._introspect_keys() if columns else (None, ())
+        return TableSchema(columns, dist_key, sort_keys)
+
+    def _introspect_keys(self):
+        from psycopg2 import DatabaseError
+        try:
+            key_columns = self.database.fetch("""
+                SELECT attribute.attname
+                , attribute.attisdistkey
+                , attribute.attsortkeyord
+                FROM pg_attribute attribute
+                JOIN pg_class class ON class.oid = attribute.attrelid
+                JOIN pg_namespace namespace ON namespace.oid = class.relnamespace
+                WHERE namespace.nspname = %(table_schema)s
+                AND class.relname = %(table_name)s
+                AND attribute.attnum > 0
+                AND NOT attribute.attisdropped
+                AND (attribute.attisdistkey OR attribute.attsortkeyord <> 0)
+                """, {'table_schema': self.table_schema, 'table_name': self.table_name})
+        except DatabaseError:
+            # distribution and sort keys only exist on redshift, so a postgres
+            # database standing in for one simply doesn't have any.
+            return None, ()
+        dist_key = next((name for name, is_dist_key, _ in key_columns if is_dist_key), None)
+        sort_keys = [name for name, _, sort_key_order in
+                     sorted(key_columns, key=lambda key_column: abs(key_column[2]))
+                     if sort_key_order]
+        return dist_key, tuple(sort_keys)
@@ -1,10 +1,15 @@
 import os
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import chain, islice
 import subprocess
-import csv
 
+from aws_etl_tools.csv_encoding import write_csv, write_csv_parts
+from aws_etl_tools.exceptions import DataValidationError, NoDataFoundError, SchemaMismatchError
 from aws_etl_tools.guard import requires_s3_base_path
-from aws_etl_tools.s3_file import S3File
+from aws_etl_tools.redshift_ingest.transient_paths import transient_local_path, transient_s3_path
+from aws_etl_tools.s3_file import S3File, upload_local_file_to_s3_path_resumably
 from aws_etl_tools import config
 
 
@@ -15,50 +20,148 @@ def s3_to_redshift(s3_file, destination, **ingestion_args):
     ingestor()
 
 
+def rows_to_redshift(rows, destination, **ingestion_args):
+    '''Upserts `rows` without going through S3: they're INSERTed into the staging table
+       rather than COPYed, which is only worth it for small loads.'''
+    ingestion_class = destination.database.ingestion_class
+    ingestor = ingestion_class(None, destination, rows=rows, **ingestion_args)
+    ingestor()
+
+
 @requires_s3_base_path
 def from_manifest(manifest, destination, **ingestion_args):
     '''From a dict that can be jsonified and uploaded to S3. For more info on manifests,
        see http://docs.aws.amazon.com/redshift/latest/dg/loading-data-files-using-manifest.html'''
-    s3_path = _transient_s3_path(destination) + '.manifest'
+    s3_path = transient_s3_path(destination) + '.manifest'
     s3_manifest = S3File.from_json_serializable(manifest, s3_path)
 
     s3_to_redshift(s3_manifest, destination, with_manifest=True, **ingestion_args)
 
 
-def from_s3_file(s3_file, destination):
-    s3_to_redshift(s3_file, destination)
+def from_s3_file(s3_file, destination, **ingestion_args):
+    s3_to_redshift(s3_file, destination, **ingestion_args)
 
 
-def from_s3_path(s3_path, destination):
+def from_s3_path(s3_path, destination, **ingestion_args):
     '''Assumes a CSV'''
     s3_file = S3File(s3_path)
-    from_s3_file(s3_file, destination)
+    from_s3_file(s3_file, destination, **ingestion_args)
 
 
 @requires_s3_base_path
-def from_local_file(file_path, destination):
-    '''Assumes a CSV'''
-    s3_path = _transient_s3_path(destination) + '.csv'
+def from_local_file(file_path, destination, resumable=False, **ingestion_args):
+    '''Assumes a CSV. With `resumable`, the file is uploaded in multipart parts, and
+       if the load fails, loading the same, unchanged file into `destination` again
+       picks up where it left off: parts S3 already has aren't uploaded again, nor is
+       anything COPYed again once the COPY has been committed.'''
+    if resumable:
+        from aws_etl_tools.redshift_ingest.checkpoint import IngestCheckpoint
+        file_stat = os.stat(file_path)
+        load_id = '{path}:{size}:{modified}'.format(
+            path=os.path.abspath(file_path), size=file_stat.st_size, modified=file_stat.st_mtime)
+        _load_resumably(IngestCheckpoint(destination, load_id), destination, lambda: [file_path],
+                        remove_parts=False, **ingestion_args)
+        return
+    s3_path = transient_s3_path(destination) + '.csv'
     s3_file = S3File.from_local_file(file_path, s3_path)
 
-    from_s3_file(s3_file, destination)
+    from_s3_file(s3_file, destination, **ingestion_args)
 
 
 @requires_s3_base_path
-def from_in_memory(data, destination):
-    '''Assumes an iterable of iterables, e.g. a list of tuples'''
-    file_path = _transient_local_path(destination) + '.csv'
-    with open(file_path, 'w') as f:
-        writer = csv.writer(f, delimiter=',')
-        for row in data:
-            writer.writerow(row)
+def from_in_memory(data, destination, validate=False, quarantine_path=None, load_id=None):
+    '''Assumes an iterable of iterables, e.g. a list of tuples, or an iterable of
+       dicts keyed by column name, which are lined up with the target table's columns.
+       With `validate`, rows are checked against the target table's column types before
+       anything is uploaded. Bad rows raise DataValidationError unless a `quarantine_path`
+       is given, in which case they're written there and the rest are loaded.
+       Up to config.SMALL_PAYLOAD_ROW_THRESHOLD rows are inserted directly, skipping S3.
+       With a `load_id`, a string that names these rows, bigger loads are resumable: if
+       one fails, calling this again with the same `load_id` and `destination` picks up
+       where it left off, skipping writing the rows to CSV if that was done, uploading
+       only the parts S3 doesn't have yet, and not COPYing again once that's committed.
+       It's up to the caller that the rows are the same every time.'''
+    data, columns = _align_rows_with_destination(data, destination)
+    if validate or quarantine_path:
+        from aws_etl_tools.redshift_ingest.validation import RowValidator
+        data = RowValidator(destination.schema, columns, quarantine_path).valid_rows(data)
+    _load_rows(data, destination, columns, load_id)
+
+
+@requires_s3_base_path
+def from_snapshot(data, destination, index_path=None, report_deletions=False):
+    '''Like `from_in_memory`, for sources that can only give a full snapshot of a
+       table: only the rows that are new or have changed since the last snapshot loaded
+       into `destination` are uploaded, going by a ChangeDetector's local index of row
+       hashes by upsert key. Returns the ChangeDetector, which counts the rows that
+       were inserted, changed and unchanged, and with `report_deletions`, lists the
+       keys that have gone from the snapshot in `deleted_keys`.'''
+    from aws_etl_tools.redshift_ingest.change_detection import ChangeDetector
+    data, columns = _align_rows_with_destination(data, destination)
+    with ChangeDetector(destination, columns, index_path, report_deletions) as detector:
+        changed_rows = list(detector.changed_rows(data))
+        if changed_rows:
+            _load_rows(changed_rows, destination, columns)
+        detector.commit()
+    return detector
 
-    from_local_file(file_path, destination)
+
+def _load_rows(data, destination, columns, load_id=None):
+    '''Loads rows already lined up with `columns`, or every column of the target,
+       resumably if there's a `load_id`.'''
+    ingestion_args = {'columns': columns} if columns else {}
+    if isinstance(data, Sequence):
+        if len(data) <= config.SMALL_PAYLOAD_ROW_THRESHOLD:
+            rows_to_redshift(_some_rows(list(data)), destination, **ingestion_args)
+            return
+    else:
+        data = iter(data)
+        first_rows = list(islice(data, config.SMALL_PAYLOAD_ROW_THRESHOLD + 1))
+        if len(first_rows) <= config.SMALL_PAYLOAD_ROW_THRESHOLD:
+            rows_to_redshift(_some_rows(first_rows), destination, **ingestion_args)
+            return
+        data = chain(first_rows, data)
+
+    if load_id is not None:
+        from aws_etl_tools.redshift_ingest.checkpoint import IngestCheckpoint
+        checkpoint = IngestCheckpoint(destination, load_id)
+        # ingestion classes without manifests load a single part
+        processes = None if getattr(destination.database.ingestion_class, 'supports_manifests', True) else 1
+        _load_resumably(checkpoint, destination,
+                        lambda: write_csv_parts(data, checkpoint.part_path_prefix, processes), **ingestion_args)
+        return
+
+    if not getattr(destination.database.ingestion_class, 'supports_manifests', True):
+        file_path = transient_local_path(destination) + '.csv'
+        write_csv(data, file_path)
+        from_local_file(file_path, destination, **ingestion_args)
+        return
+
+    part_paths = write_csv_parts(data, transient_local_path(destination))
+    if len(part_paths) == 1:
+        from_local_file(part_paths[0], destination, **ingestion_args)
+        return
+    _from_local_parts(part_paths, destination, **ingestion_args)
 
 
 @requires_s3_base_path
-def from_dataframe(dataframe, destination, **df_kwargs):
-    file_path = _transient_local_path(destination) + '.csv'
+def from_dataframe(dataframe, destination, validate=False, quarantine_path=None, **df_kwargs):
+    '''If the dataframe's column names are all columns of the target table, they are
+       matched up by name. Otherwise, they are matched up by position. `validate` and
+       `quarantine_path` behave as they do for `from_in_memory`, as does the direct insert
+       of small dataframes, unless `df_kwargs` ask for particular CSV formatting.'''
+    columns = None
+    if 'columns' not in df_kwargs and not df_kwargs.get('index'):
+        dataframe, columns = _align_dataframe_with_destination(dataframe, destination)
+    if validate or quarantine_path:
+        dataframe = _valid_dataframe(dataframe, destination, columns, quarantine_path)
+    ingestion_args = {'columns': columns} if columns else {}
+
+    if not df_kwargs and len(dataframe) <= config.SMALL_PAYLOAD_ROW_THRESHOLD:
+        rows_to_redshift(_some_rows(_dataframe_rows(dataframe)), destination, **ingestion_args)
+        return
+
+    file_path = transient_local_path(destination) + '.csv'
     arguments = {
         'index': False,
         'header': False
@@ -66,12 +169,12 @@ def from_dataframe(dataframe, destination, **df_kwargs):
     arguments.update(df_kwargs)
     dataframe.to_csv(file_path, **arguments)
 
-    from_local_file(file_path, destination)
+    from_local_file(file_path, destination, **ingestion_args)
 
 
 @requires_s3_base_path
-def from_postgres_query(database, query, destination):
-    file_path = _transient_local_path(destination) + '.csv'
+def from_postgres_query(database, query, destination, **ingestion_args):
+    file_path = transient_local_path(destination) + '.csv'
     with open(file_path, 'w') as f:
         subprocess.call([
                 'psql',
@@ -86,28 +189,135 @@ def from_postgres_query(database, query, destination):
             stdout=f
         )
 
-    from_local_file(file_path, destination)
+    from_local_file(file_path, destination, **ingestion_args)
 
 
-def _transient_local_path(destination):
-    file_name = _destination_file_name(destination)
-    return os.path.join(config.LOCAL_TEMP_DIRECTORY, file_name)
+@requires_s3_base_path
+def _from_local_parts(part_paths, destination, **ingestion_args):
+    '''Uploads CSV parts side by side and loads them all with one manifest COPY.'''
+    def upload(part_path):
+        s3_path = transient_s3_path(destination) + '_' + os.path.basename(part_path)
+        return S3File.from_local_file(part_path, s3_path).s3_path
+
+    with ThreadPoolExecutor(config.AWS_MAX_POOL_CONNECTIONS) as executor:
+        s3_paths = list(executor.map(upload, part_paths))
+    manifest = {'entries': [{'url': s3_path, 'mandatory': True} for s3_path in s3_paths]}
+    from_manifest(manifest, destination, **ingestion_args)
 
 
 @requires_s3_base_path
-def _transient_s3_path(destination):
-    base_s3_path = config.S3_BASE_PATH
-    s3_subpath = _s3_ingest_subpath(destination)
-    return os.path.join(base_s3_path, s3_subpath)
-
-
-def _s3_ingest_subpath(destination):
-    database_name = destination.database.__class__.__name__.lower()
-    return os.path.join(
-        database_name,
-        destination.table_schema,
-        _destination_file_name(destination)
-    )
-
-def _destination_file_name(destination):
-    return destination.unique_identifier
+def _load_resumably(checkpoint, destination, write_parts, remove_parts=True, **ingestion_args):
+    '''Writes the parts of a load with `write_parts`, uploads each in multipart parts,
+       and COPYs them all, skipping whatever `checkpoint` shows an earlier attempt did.
+       Once it's all done, the checkpoint is removed, as are the parts if `remove_parts`.'''
+    if not checkpoint.committed:
+        part_paths = checkpoint.parts
+        if part_paths is None:
+            part_paths = write_parts()
+            checkpoint.record_parts(part_paths)
+        s3_paths = []
+        # one file at a time, as each file's parts are uploaded side by side
+        for part_path in part_paths:
+            upload_state = checkpoint.upload_state(
+                part_path, transient_s3_path(destination) + '_' + os.path.basename(part_path))
+            upload_local_file_to_s3_path_resumably(part_path, upload_state['s3_path'], upload_state, checkpoint.save)
+            s3_paths.append(upload_state['s3_path'])
+        if len(s3_paths) == 1:
+            s3_to_redshift(S3File(s3_paths[0]), destination, **ingestion_args)
+        else:
+            manifest = {'entries': [{'url': s3_path, 'mandatory': True} for s3_path in s3_paths]}
+            from_manifest(manifest, destination, **ingestion_args)
+        checkpoint.record_committed()
+    if remove_parts:
+        for part in checkpoint.state['parts']:
+            if os.path.exists(part['path']):
+                os.remove(part['path'])
+    checkpoint.remove()
+
+
+def _align_dataframe_with_destination(dataframe, destination):
+    target_columns = destination.column_names
+    if not target_columns:
+        return dataframe, None
+    dataframe_columns = [str(column) for column in dataframe.columns]
+    target_columns = _introspected_again_unless(set(dataframe_columns) <= set(target_columns), destination)
+    if set(dataframe_columns) <= set(target_columns):
+        columns = [column for column in target_columns if column in dataframe_columns]
+        return dataframe[columns], columns
+    _raise_on_width_mismatch(len(dataframe_columns), destination)
+    return dataframe, None
+
+
+def _some_rows(rows):
+    '''Empty loads fail just as they do when their empty CSV would be uploaded to S3.'''
+    if not rows:
+        raise NoDataFoundError('There are no rows to load')
+    return rows
+
+
+def _dataframe_rows(dataframe):
+    '''Plain python values, which unlike numpy's can be passed as query parameters,
+    with NaN and NaT as None.'''
+    values = dataframe.astype(object)
+    return values.where(dataframe.notnull(), None).values.tolist()
+
+
+def _valid_dataframe(dataframe, destination, columns, quarantine_path):
+    from aws_etl_tools.redshift_ingest.validation import validate_dataframe, split_dataframe
+    report = validate_dataframe(dataframe, destination.schema, columns)
+    if report.is_valid:
+        return dataframe
+    if not quarantine_path:
+        raise DataValidationError(str(report), report)
+    return split_dataframe(dataframe, report, quarantine_path)
+
+
+def _align_rows_with_destination(data, destination):
+    '''Peeks at the first row to catch a shape mismatch before anything is written or
+    uploaded. Rows that are dicts are turned into tuples in target column order; they
+    must all have the same keys as the first, which is checked as they're written.'''
+    rows = iter(data)
+    first_row = next(rows, None)
+    if first_row is None:
+        return [], None
+    # sequences are passed on as they are, so they can still be sharded when written
+    rows = data if isinstance(data, Sequence) else chain([first_row], rows)
+    target_columns = destination.column_names
+    if not target_columns:
+        return rows, None
+    if isinstance(first_row, Mapping):
+        target_columns = _introspected_again_unless(set(first_row) <= set(target_columns), destination)
+        unknown_columns = set(first_row) - set(target_columns)
+        if unknown_columns:
+            raise SchemaMismatchError('{table} has no columns named {columns}'.format(
+                table=destination.target_table, columns=', '.join(sorted(map(str, unknown_columns)))))
+        columns = [column for column in target_columns if column in first_row]
+        return _record_tuples(rows, columns, destination), columns
+    _raise_on_width_mismatch(len(first_row), destination)
+    return rows, None
+
+
+def _record_tuples(records, columns, destination):
+    column_set = set(columns)
+    for record in records:
+        if record.keys() != column_set:
+            raise SchemaMismatchError('every record for {table} needs the same keys as the first, {columns}; '
+                                      'one has {keys}'.format(table=destination.target_table,
+                                                              columns=', '.join(columns),
+                                                              keys=', '.join(sorted(map(str, record)))))
+        yield tuple(record[column] for column in columns)
+
+
+def _raise_on_width_mismatch(width, destination):
+    expected_width = len(_introspected_again_unless(width == len(destination.column_names), destination))
+    if width != expected_width:
+        raise SchemaMismatchError('The data has {width} columns but {table} has {expected_width}'.format(
+            width=width, table=destination.target_table, expected_width=expected_width))
+
+
+def _introspected_again_unless(data_fits, destination):
+    '''The target's column names, skipping the schema cache if the data doesn't fit
+       the cached ones: the table may have been altered since they were cached.'''
+    if not data_fits:
+        destination.invalidate_schema()
+    return destination.column_names
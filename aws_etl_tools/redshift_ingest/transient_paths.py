@@ -0,0 +1,30 @@
+'''Where loads into a RedshiftTable keep the files they write on their way into it:
+locally under config.LOCAL_TEMP_DIRECTORY, and on S3 under config.S3_BASE_PATH.'''
+import os
+
+from aws_etl_tools import config
+from aws_etl_tools.guard import requires_s3_base_path
+
+
+def transient_local_path(destination):
+    file_name = destination_file_name(destination)
+    return os.path.join(config.LOCAL_TEMP_DIRECTORY, file_name)
+
+
+@requires_s3_base_path
+def transient_s3_path(destination):
+    base_s3_path = config.S3_BASE_PATH
+    s3_subpath = s3_ingest_subpath(destination)
+    return os.path.join(base_s3_path, s3_subpath)
+
+
+def s3_ingest_subpath(destination):
+    database_name = destination.database.__class__.__name__.lower()
+    return os.path.join(
+        database_name,
+        destination.table_schema,
+        destination_file_name(destination)
+    )
+
+def destination_file_name(destination):
+    return destination.unique_identifier
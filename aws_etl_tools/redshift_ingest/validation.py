@@ -0,0 +1,211 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from aws_etl_tools import config
+from aws_etl_tools.exceptions import DataValidationError
+
+
+INTEGER_RANGES = {
+    'smallint': (-2 ** 15, 2 ** 15 - 1),
+    'integer': (-2 ** 31, 2 ** 31 - 1),
+    'bigint': (-2 ** 63, 2 ** 63 - 1)
+}
+FLOAT_TYPES = {'real', 'double precision'}
+DECIMAL_TYPES = {'numeric', 'decimal'}
+CHARACTER_TYPES = {'character varying', 'character'}
+DATETIME_TYPES = {'date', 'timestamp without time zone', 'timestamp with time zone'}
+BOOLEAN_STRINGS = {'true', 'false', 't', 'f', 'yes', 'no', 'y', 'n', '1', '0'}
+
+PROBLEM_COLUMNS = ['row', 'column', 'reason', 'value']
+QUARANTINE_REASON_COLUMN = 'validation_errors'
+
+# pandas 2 infers a single datetime format from the first value unless told otherwise
+_PANDAS_INFERS_ONE_DATETIME_FORMAT = int(pd.__version__.split('.')[0]) >= 2
+
+
+class ValidationReport:
+    '''The outcome of validating some rows against a target table. `problems` is a
+    DataFrame with one line per offending value: the row's position in the load, the
+    column, the reason, and the value itself.'''
+
+    MAX_EXAMPLES_IN_MESSAGE = 10
+
+    def __init__(self, problems=None, row_count=0):
+        self.problems = problems if problems is not None else pd.DataFrame(columns=PROBLEM_COLUMNS)
+        self.row_count = row_count
+
+    @property
+    def is_valid(self):
+        return self.problems.empty
+
+    @property
+    def invalid_rows(self):
+        return sorted(set(self.problems['row'].tolist()))
+
+    def summary(self):
+        '''Count of offending values by column and reason.'''
+        return self.problems.groupby(['column', 'reason']).size()
+
+    def extend(self, other):
+        self.problems = pd.concat([self.problems, other.problems], ignore_index=True)
+        self.row_count += other.row_count
+
+    def __str__(self):
+        if self.is_valid:
+            return '{} rows validated without problems'.format(self.row_count)
+        lines = ['{invalid} of {total} rows failed validation'.format(
+            invalid=len(self.invalid_rows), total=self.row_count)]
+        for (column, reason), count in self.summary().items():
+            lines.append('  {column}: {reason} ({count})'.format(column=column, reason=reason, count=count))
+        examples = self.problems.head(self.MAX_EXAMPLES_IN_MESSAGE)
+        for problem in examples.itertuples(index=False):
+            lines.append('  row {row}, {column}: {value!r}'.format(
+                row=problem.row, column=problem.column, value=problem.value))
+        return '\n'.join(lines)
+
+
+def validate_dataframe(dataframe, schema, columns=None, row_offset=0):
+    '''Checks every value of `dataframe` against the column types of `schema`, a
+    column at a time. `columns` names the target column of each dataframe column;
+    by default they're matched by name if possible and by position otherwise.'''
+    columns = _target_columns(dataframe, schema, columns)
+    problems = []
+    for position, column_name in enumerate(columns):
+        column = schema.column(column_name)
+        values = dataframe.iloc[:, position].reset_index(drop=True)
+        for reason, mask in _column_problems(column, values):
+            if mask.any():
+                problems.append(pd.DataFrame({
+                    'row': np.flatnonzero(mask) + row_offset,
+                    'column': column.name,
+                    'reason': reason,
+                    'value': values[mask].astype(str).values
+                }, columns=PROBLEM_COLUMNS))
+    if problems:
+        return ValidationReport(pd.concat(problems, ignore_index=True), len(dataframe))
+    return ValidationReport(row_count=len(dataframe))
+
+
+def split_dataframe(dataframe, report, quarantine_path=None):
+    '''Returns `dataframe` without the rows named in `report`. If a `quarantine_path`
+    is given, the offending rows are written there along with their problems.'''
+    invalid_positions = report.invalid_rows
+    is_invalid = np.zeros(len(dataframe), dtype=bool)
+    is_invalid[invalid_positions] = True
+    if quarantine_path and invalid_positions:
+        _write_quarantine(dataframe[is_invalid], report, quarantine_path, append=False)
+    return dataframe[~is_invalid]
+
+
+class RowValidator:
+    '''Validates an iterable of rows against a TableSchema, a chunk at a time, so that
+    the rows never need to fit in memory all at once. Iterating `valid_rows` yields
+    the rows that passed. Without a `quarantine_path`, the first bad chunk raises
+    DataValidationError. With one, bad rows are written there and the rest go on.
+    Either way, `report` covers everything validated so far.'''
+
+    def __init__(self, schema, columns=None, quarantine_path=None, chunk_size=None):
+        self.schema = schema
+        self.columns = columns
+        self.quarantine_path = quarantine_path
+        self.chunk_size = chunk_size or config.VALIDATION_CHUNK_SIZE
+        self.report = ValidationReport()
+        # whatever an earlier run left in the quarantine file is replaced on first write
+        self._has_quarantined = False
+
+    def valid_rows(self, rows):
+        rows_validated = 0
+        for chunk in _chunks(rows, self.chunk_size):
+            dataframe = pd.DataFrame.from_records(chunk)
+            dataframe.columns = _target_columns(dataframe, self.schema, self.columns)
+            chunk_report = validate_dataframe(dataframe, self.schema, self.columns, row_offset=rows_validated)
+            self.report.extend(chunk_report)
+            if not chunk_report.is_valid:
+                if not self.quarantine_path:
+                    raise DataValidationError(str(chunk_report), chunk_report)
+                _write_quarantine(dataframe.iloc[[row - rows_validated for row in chunk_report.invalid_rows]],
+                                  chunk_report, self.quarantine_path, append=self._has_quarantined)
+                self._has_quarantined = True
+                invalid_rows = set(chunk_report.invalid_rows)
+                chunk = [row for position, row in enumerate(chunk, rows_validated) if position not in invalid_rows]
+            rows_validated += len(dataframe)
+            for row in chunk:
+                yield row
+
+
+def _target_columns(dataframe, schema, columns):
+    if columns:
+        return list(columns)
+    dataframe_columns = [str(column) for column in dataframe.columns]
+    if set(dataframe_columns) <= set(schema.column_names):
+        return dataframe_columns
+    return schema.column_names[:len(dataframe_columns)]
+
+
+def _column_problems(column, values):
+    '''Yields (reason, boolean mask) pairs for a single column of values.'''
+    missing = values.isna().values
+    if values.dtype == object or pd.api.types.is_string_dtype(values.dtype):
+        # EMPTYASNULL and BLANKSASNULL turn these into nulls during the COPY
+        missing = missing | values.astype(str).str.strip().eq('').values
+    present = ~missing
+    if not column.is_nullable:
+        yield 'null in NOT NULL column', missing
+    if not present.any():
+        return
+
+    data_type = column.data_type
+    if data_type in INTEGER_RANGES or data_type in DECIMAL_TYPES or data_type in FLOAT_TYPES:
+        numbers = pd.to_numeric(values.where(present), errors='coerce')
+        not_a_number = present & numbers.isna().values
+        yield 'not a number', not_a_number
+        parsed = present & ~not_a_number
+        if data_type in INTEGER_RANGES:
+            lowest, highest = INTEGER_RANGES[data_type]
+            yield 'not an integer', parsed & (numbers % 1 != 0).values
+            yield 'out of range for {}'.format(data_type), parsed & ((numbers < lowest) | (numbers > highest)).values
+        elif data_type in DECIMAL_TYPES and column.numeric_precision is not None:
+            scale = column.numeric_scale or 0
+            limit = 10 ** (column.numeric_precision - scale)
+            yield 'out of range for numeric({},{})'.format(column.numeric_precision, scale), \
+                parsed & (numbers.abs() >= limit).values
+    elif data_type in CHARACTER_TYPES and column.character_maximum_length:
+        # redshift measures character lengths in bytes, not characters
+        byte_lengths = values.where(present, '').astype(str).str.encode('utf-8').str.len()
+        yield 'longer than {} bytes'.format(column.character_maximum_length), \
+            present & (byte_lengths > column.character_maximum_length).values
+    elif data_type in DATETIME_TYPES:
+        yield 'not a parseable {}'.format(data_type), present & _parse_datetimes(values.where(present)).isna().values
+    elif data_type == 'boolean':
+        is_boolean = values.map(lambda value: isinstance(value, (bool, np.bool_)) or
+                                str(value).strip().lower() in BOOLEAN_STRINGS)
+        yield 'not a boolean', present & ~is_boolean.values.astype(bool)
+
+
+def _parse_datetimes(values):
+    if _PANDAS_INFERS_ONE_DATETIME_FORMAT:
+        return pd.to_datetime(values, errors='coerce', utc=True, format='mixed')
+    return pd.to_datetime(values, errors='coerce', utc=True)
+
+
+def _write_quarantine(invalid_rows, report, quarantine_path, append):
+    reasons = report.problems.assign(
+        description=report.problems['column'] + ': ' + report.problems['reason']
+    ).groupby('row')['description'].agg('; '.join)
+    quarantined = invalid_rows.copy()
+    quarantined[QUARANTINE_REASON_COLUMN] = reasons.loc[report.invalid_rows].values
+    write_header = not (append and os.path.exists(quarantine_path))
+    quarantined.to_csv(quarantine_path, mode='a' if append else 'w', index=False, header=write_header)
+
+
+def _chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -1,16 +1,19 @@
-import csv
+import codecs
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
-
-import boto3
-from botocore.exceptions import ClientError
+from threading import Lock
 
 from aws_etl_tools.aws import AWS
 from aws_etl_tools import config
+from aws_etl_tools.csv_encoding import write_csv
 from aws_etl_tools.exceptions import NoDataFoundError
 from aws_etl_tools.guard import requires_s3_base_path
 
 
+# the smallest part S3 takes in a multipart upload, bar the last
+MIN_MULTIPART_PART_BYTES = 5 * 1024 * 1024
+
 def parse_s3_path(s3_path):
     s3_path_elements = [string for string in s3_path.split('/') if len(string) > 0]
     bucket_name = s3_path_elements[1]
@@ -18,34 +21,104 @@ def parse_s3_path(s3_path):
     file_name = s3_path_elements[-1]
     return bucket_name, key_name, file_name
 
+def lines(chunks):
+    '''Splits a stream of UTF-8 byte chunks, like the reads of an S3 object's body, into
+    lines, wherever the chunks happen to end.'''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    remainder = ''
+    for chunk in chunks:
+        complete_lines = (remainder + decoder.decode(chunk)).split('\n')
+        remainder = complete_lines.pop()
+        for line in complete_lines:
+            yield line + '\n'
+    remainder += decoder.decode(b'', final=True)
+    if remainder:
+        yield remainder
+
 def upload_local_file_to_s3_path(local_path, s3_path):
     bucket_name, key_name, _ = parse_s3_path(s3_path)
     s3 = AWS().s3_connection()
     s3_file = s3.Object(bucket_name, key_name)
-    s3_file.upload_file(local_path)
+    s3_file.upload_file(local_path, Config=_transfer_config())
     if s3_file.content_length == 0:
         raise NoDataFoundError('The file you\'ve uploaded to S3 has a size of 0 KB')
 
+def upload_local_file_to_s3_path_resumably(local_path, s3_path, state, save_state):
+    '''Uploads a local file as a multipart upload of config.RESUMABLE_UPLOAD_PART_BYTES
+    parts, noting the upload and every part S3 has taken in the dict `state`, and calling
+    `save_state` each time it changes. Given the same `state` again after a failure, only
+    the parts that weren't taken yet are uploaded. Files of one part are simply uploaded.'''
+    from botocore.exceptions import ClientError
+    if state.get('completed'):
+        return
+    part_bytes = max(config.RESUMABLE_UPLOAD_PART_BYTES, MIN_MULTIPART_PART_BYTES)
+    if os.path.getsize(local_path) <= part_bytes:
+        upload_local_file_to_s3_path(local_path, s3_path)
+    else:
+        try:
+            _upload_missing_parts(local_path, s3_path, part_bytes, state, save_state)
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+            # the upload was aborted, or expired by a lifecycle rule, so start it over
+            state.pop('upload_id')
+            _upload_missing_parts(local_path, s3_path, part_bytes, state, save_state)
+    state['completed'] = True
+    save_state()
+
 def upload_data_to_s3_path(data, s3_path):
     ''' takes some data, writes it locally to a CSV, and then uploads that to s3.
     `data`: a simple iterable of iterables: e.g. a list of tuples
     `s3_path`: a full s3_path: e.g. s3://ye-olde-bucket/namespace/data.csv'''
     _, _, file_name = parse_s3_path(s3_path)
     local_path = os.path.join(config.LOCAL_TEMP_DIRECTORY, file_name)
-    _write_data_to_local_csv(data, local_path)
+    write_csv(data, local_path)
     return upload_local_file_to_s3_path(local_path, s3_path)
 
 def download_from_s3_to_local_file(s3_path, local_path):
     bucket_name, key_name, _ = parse_s3_path(s3_path)
     s3 = AWS().s3_connection()
     s3_file = s3.Object(bucket_name, key_name)
-    s3_file.download_file(local_path)
+    s3_file.download_file(local_path, Config=_transfer_config())
 
-def _write_data_to_local_csv(data, local_path):
-    with open(local_path, 'w') as f:
-        writer = csv.writer(f, delimiter=',')
-        for row in data:
-            writer.writerow(row)
+def _upload_missing_parts(local_path, s3_path, part_bytes, state, save_state):
+    bucket_name, key_name, _ = parse_s3_path(s3_path)
+    client = AWS().s3_connection().meta.client
+    if 'upload_id' not in state:
+        state['upload_id'] = client.create_multipart_upload(Bucket=bucket_name, Key=key_name)['UploadId']
+        state['parts'] = {}
+        save_state()
+    part_count = -(-os.path.getsize(local_path) // part_bytes)
+    state_lock = Lock()
+
+    def upload(part_number):
+        with open(local_path, 'rb') as local_file:
+            local_file.seek((part_number - 1) * part_bytes)
+            body = local_file.read(part_bytes)
+        etag = _upload_part(client, bucket_name, key_name, state['upload_id'], part_number, body)
+        with state_lock:
+            # json keys are strings, so they're kept as strings from the start
+            state['parts'][str(part_number)] = etag
+            save_state()
+
+    missing_parts = [number for number in range(1, part_count + 1) if str(number) not in state['parts']]
+    # parts that are taken are noted even if another part fails
+    with ThreadPoolExecutor(config.AWS_MAX_POOL_CONNECTIONS) as executor:
+        list(executor.map(upload, missing_parts))
+    client.complete_multipart_upload(
+        Bucket=bucket_name, Key=key_name, UploadId=state['upload_id'],
+        MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': state['parts'][str(number)]}
+                                   for number in range(1, part_count + 1)]})
+
+def _upload_part(client, bucket_name, key_name, upload_id, part_number, body):
+    response = client.upload_part(Bucket=bucket_name, Key=key_name, UploadId=upload_id,
+                                  PartNumber=part_number, Body=body)
+    return response['ETag']
+
+def _transfer_config():
+    from boto3.s3.transfer import TransferConfig
+    # keep the transfer's threads within the pooled connection's pool size
+    return TransferConfig(max_concurrency=config.AWS_MAX_POOL_CONNECTIONS)
 
 
 class S3File:
@@ -59,6 +132,7 @@ class S3File:
 
     @property
     def file_size(self):
+        from botocore.exceptions import ClientError
         s3 = AWS().s3_connection()
         s3_object = s3.Object(self.bucket_name, self.key_name)
         try:
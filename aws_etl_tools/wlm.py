@@ -0,0 +1,150 @@
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from threading import Condition
+import time
+
+from aws_etl_tools import config
+
+
+MICROSECONDS_PER_SECOND = 1000000.0
+
+# what a WLM queue looked like when it was last sampled
+WlmSample = namedtuple('WlmSample', ['slots', 'running', 'queued', 'max_queue_seconds', 'sampled_at'])
+
+
+class WlmConcurrencyController:
+    '''Decides how many loads, or UNLOADs, run at once against a Redshift cluster, going
+    by how busy the WLM queue they run in is. Every config.WLM_SAMPLE_SECONDS, the
+    queue's slots and the queries running and waiting in it are sampled from
+    STV_WLM_SERVICE_CLASS_CONFIG and STV_WLM_QUERY_STATE over a pooled connection.
+
+    The limit starts at `min_concurrency` and, like TCP's congestion window, grows by
+    one while every slot the limit allows is in use and the queue has more than
+    config.WLM_RESERVED_SLOTS slots free, leaving those for interactive queries. It's
+    halved, down to `min_concurrency`, as soon as anything has waited in the queue
+    longer than config.WLM_MAX_QUEUE_SECONDS. It never goes over `max_concurrency`
+    (default: config.DATABASE_POOL_SIZE). If the queue can't be sampled, the limit is
+    left where it is.
+
+    Work takes a slot while it runs:
+
+        controller = WlmConcurrencyController(RedshiftDatabase(credentials), service_class=6)
+        with controller.slot():
+            s3_to_redshift(s3_file, destination)
+        controller.stats()
+    '''
+
+    def __init__(self, database, service_class=None, min_concurrency=1, max_concurrency=None):
+        self.database = database
+        self.service_class = config.WLM_SERVICE_CLASS if service_class is None else service_class
+        self.min_concurrency = max(min_concurrency, 1)
+        self.max_concurrency = max(max_concurrency or config.DATABASE_POOL_SIZE, self.min_concurrency)
+        self.limit = self.min_concurrency
+        self.in_flight = 0
+        self.last_sample = None
+        self.sample_error = None
+        self.increases = 0
+        self.decreases = 0
+        self.slots_taken = 0
+        self.slot_wait_seconds = 0.0
+        self._condition = Condition()
+        self._is_sampling = False
+        self._sampled_at = None
+
+    @contextmanager
+    def slot(self):
+        '''Waits until there's room under the limit, then holds a slot while the block runs.'''
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self):
+        start = time.time()
+        while True:
+            self._sample_if_due()
+            with self._condition:
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    self.slots_taken += 1
+                    self.slot_wait_seconds += time.time() - start
+                    return
+                # wake up in time to sample again, as the limit may have grown meanwhile
+                self._condition.wait(config.WLM_SAMPLE_SECONDS)
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def stats(self):
+        '''The current limit, what's in flight, how long work has waited for a slot here,
+        and the last sample of the WLM queue.'''
+        with self._condition:
+            return OrderedDict([
+                ('service_class', self.service_class),
+                ('limit', self.limit),
+                ('in_flight', self.in_flight),
+                ('increases', self.increases),
+                ('decreases', self.decreases),
+                ('slots_taken', self.slots_taken),
+                ('slot_wait_seconds', self.slot_wait_seconds),
+                ('last_sample', self.last_sample._asdict() if self.last_sample else None),
+                ('sample_error', str(self.sample_error) if self.sample_error else None)
+            ])
+
+    def sample(self):
+        '''Samples the WLM queue, adjusts the limit to it, and returns the WlmSample.'''
+        try:
+            with self.database.pooled_cursor() as cursor:
+                cursor.execute("""
+                    SELECT config.num_query_tasks
+                    , COUNT(CASE WHEN BTRIM(state.state) = 'Running' THEN 1 END)
+                    , COUNT(CASE WHEN BTRIM(state.state) LIKE 'Queued%%' THEN 1 END)
+                    , COALESCE(MAX(CASE WHEN BTRIM(state.state) LIKE 'Queued%%' THEN state.queue_time END), 0)
+                    FROM STV_WLM_SERVICE_CLASS_CONFIG config
+                    LEFT JOIN STV_WLM_QUERY_STATE state ON state.service_class = config.service_class
+                    WHERE config.service_class = %(service_class)s
+                    GROUP BY config.num_query_tasks
+                    """, {'service_class': self.service_class})
+                rows = cursor.fetchall()
+            if not rows:
+                raise ValueError('there is no WLM queue with service class {}'.format(self.service_class))
+        except Exception as error:
+            with self._condition:
+                self.sample_error = error
+            return None
+        slots, running, queued, max_queue_microseconds = rows[0]
+        sample = WlmSample(int(slots), int(running), int(queued),
+                           max_queue_microseconds / MICROSECONDS_PER_SECOND, time.time())
+        with self._condition:
+            self.last_sample, self.sample_error = sample, None
+            self._adjust_limit(sample)
+            self._condition.notify_all()
+        return sample
+
+    def _adjust_limit(self, sample):
+        if sample.queued and sample.max_queue_seconds > config.WLM_MAX_QUEUE_SECONDS:
+            if self.limit > self.min_concurrency:
+                self.limit = max(self.limit // 2, self.min_concurrency)
+                self.decreases += 1
+        elif (self.in_flight >= self.limit and self.limit < self.max_concurrency and
+              sample.running < sample.slots - config.WLM_RESERVED_SLOTS):
+            self.limit += 1
+            self.increases += 1
+
+    def _sample_if_due(self):
+        '''Samples if the last attempt is stale and no other thread is already at it.'''
+        with self._condition:
+            if self._is_sampling or (self._sampled_at is not None and
+                                     time.time() - self._sampled_at < config.WLM_SAMPLE_SECONDS):
+                return
+            self._is_sampling = True
+            # failed samples count too, so a queue that can't be sampled isn't hammered
+            self._sampled_at = time.time()
+        try:
+            self.sample()
+        finally:
+            with self._condition:
+                self._is_sampling = False
@@ -28,5 +28,8 @@ setup(
     ],
     packages=find_packages(),
     include_package_data=True,
+    entry_points={
+        'console_scripts': ['aws-etl-tools = aws_etl_tools.cli:main']
+    },
     test_suite='nose.collector'
 )
@@ -0,0 +1,142 @@
+import unittest
+from decimal import Decimal
+from unittest.mock import Mock, call, patch
+
+import boto3
+
+from aws_etl_tools.mock_s3_connection import MockS3Connection
+from aws_etl_tools import config
+from aws_etl_tools.athena_database import AthenaDatabase, clear_result_cache, normalize_query
+from aws_etl_tools.exceptions import AthenaQueryError
+from tests import test_helper
+
+
+S3_BUCKET_NAME = test_helper.S3_TEST_BUCKET_NAME
+OUTPUT_LOCATION = 's3://{}/athena-results/'.format(S3_BUCKET_NAME)
+RESULT_PATH = 'athena-results/query-1.csv'
+RESULT_CSV = (
+    '"id","name","price","in_stock","note"\n'
+    '"1","crème brûlée","3.50","true","sweet"\n'
+    '"2","gum","","false",""\n'
+    '"3","taffy","0.25","true","sticks\nto teeth"\n'
+)
+COLUMNS = [
+    {'Name': 'id', 'Type': 'integer'},
+    {'Name': 'name', 'Type': 'varchar'},
+    {'Name': 'price', 'Type': 'decimal(10,2)'},
+    {'Name': 'in_stock', 'Type': 'boolean'},
+    {'Name': 'note', 'Type': 'varchar'}
+]
+EXPECTED_ROWS = [
+    (1, 'crème brûlée', Decimal('3.50'), True, 'sweet'),
+    (2, 'gum', None, False, ''),
+    (3, 'taffy', Decimal('0.25'), True, 'sticks\nto teeth')
+]
+
+
+def _execution(state, reason=None):
+    return {'QueryExecution': {
+        'Status': {'State': state, 'StateChangeReason': reason},
+        'ResultConfiguration': {'OutputLocation': 's3://{}/{}'.format(S3_BUCKET_NAME, RESULT_PATH)},
+        'Statistics': {'DataScannedInBytes': 1024, 'EngineExecutionTimeInMillis': 1500}
+    }}
+
+
+class TestAthenaDatabase(unittest.TestCase):
+
+    def setUp(self):
+        test_helper.set_default_s3_base_path()
+        clear_result_cache()
+        self.addCleanup(clear_result_cache)
+        self.athena = Mock()
+        self.athena.start_query_execution.return_value = {'QueryExecutionId': 'query-1'}
+        self.athena.get_query_execution.return_value = _execution('SUCCEEDED')
+        self.athena.get_query_results.return_value = {'ResultSet': {'ResultSetMetadata': {'ColumnInfo': COLUMNS}}}
+        self.database = AthenaDatabase('candy_lake', OUTPUT_LOCATION)
+        self.database.athena_connection = Mock(return_value=self.athena)
+
+    def _put(self, key_name, contents):
+        boto3.resource('s3').Object(S3_BUCKET_NAME, key_name).put(Body=contents)
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_rows_are_read_from_the_output_csv_in_ranges(self):
+        self._put(RESULT_PATH, RESULT_CSV.encode('utf-8'))
+
+        # ranges small enough to split rows, quoted newlines and multibyte characters
+        with patch.object(config, 'ATHENA_RESULT_RANGE_BYTES', 5):
+            rows = self.database.fetch('select * from candy')
+
+        self.assertEqual(rows, EXPECTED_ROWS)
+        self.athena.start_query_execution.assert_called_once_with(
+            QueryString='select * from candy',
+            QueryExecutionContext={'Database': 'candy_lake'},
+            ResultConfiguration={'OutputLocation': OUTPUT_LOCATION}
+        )
+        self.athena.get_query_results.assert_called_once_with(QueryExecutionId='query-1', MaxResults=1)
+
+    @patch('aws_etl_tools.athena_database.time.sleep')
+    def test_waiting_backs_off_between_polls(self, sleep):
+        self.athena.get_query_execution.side_effect = [_execution('QUEUED'), _execution('RUNNING'),
+                                                       _execution('RUNNING'), _execution('SUCCEEDED')]
+
+        query = self.database.submit('select * from candy', use_cache=False).wait()
+
+        self.assertEqual(sleep.call_args_list, [call(0.2), call(0.4), call(0.8)])
+        self.assertEqual((query.data_scanned_bytes, query.execution_seconds), (1024, 1.5))
+
+    def test_submitting_does_not_wait(self):
+        self.athena.get_query_execution.return_value = _execution('RUNNING')
+
+        query = self.database.submit('select * from candy')
+
+        self.assertFalse(query.is_done())
+        self.athena.get_query_execution.assert_called_once_with(QueryExecutionId='query-1')
+
+    def test_failed_queries_raise(self):
+        self.athena.get_query_execution.return_value = _execution('FAILED', 'Table candy does not exist')
+
+        with self.assertRaises(AthenaQueryError):
+            self.database.execute('drop table candy')
+
+    @patch('aws_etl_tools.athena_database.time.sleep')
+    def test_queries_still_running_after_the_timeout_raise(self, sleep):
+        self.athena.get_query_execution.return_value = _execution('RUNNING')
+
+        with self.assertRaises(AthenaQueryError):
+            self.database.submit('select * from candy').wait(timeout_seconds=1)
+
+    def test_reformatted_queries_share_a_cached_result(self):
+        first_query = self.database.submit('select *\n  from candy\nwhere name = \'gum  drop\';')
+        second_query = self.database.submit('select * from candy where name = \'gum  drop\'')
+
+        self.assertIs(first_query, second_query)
+        self.assertEqual(self.athena.start_query_execution.call_count, 1)
+
+    def test_failed_and_expired_results_are_not_reused(self):
+        self.database.submit('select * from candy')
+        self.athena.get_query_execution.return_value = _execution('FAILED', 'out of candy')
+        self.database.submit('select * from candy').is_done()
+        self.database.submit('select * from candy')
+
+        uncached_database = AthenaDatabase('candy_lake', OUTPUT_LOCATION, cache_seconds=0)
+        uncached_database.athena_connection = self.database.athena_connection
+        uncached_database.submit('select * from candy')
+
+        self.assertEqual(self.athena.start_query_execution.call_count, 3)
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_new_source_data_invalidates_the_cached_result(self):
+        source_paths = ['s3://{}/lake/candy/'.format(S3_BUCKET_NAME)]
+        self._put('lake/candy/part-0.csv', b'1,gum')
+
+        self.database.submit('select * from candy', source_paths=source_paths)
+        self.database.submit('select * from candy', source_paths=source_paths)
+        self.assertEqual(self.athena.start_query_execution.call_count, 1)
+
+        self._put('lake/candy/part-1.csv', b'2,taffy')
+        self.database.submit('select * from candy', source_paths=source_paths)
+        self.assertEqual(self.athena.start_query_execution.call_count, 2)
+
+    def test_normalize_query_leaves_string_literals_alone(self):
+        self.assertEqual(normalize_query('  SELECT  a,\n\tb FROM t WHERE c = \'x  y\' ;'),
+                         'SELECT a, b FROM t WHERE c = \'x  y\'')
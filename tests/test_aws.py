@@ -1,10 +1,12 @@
 import unittest
-from unittest.mock import Mock, PropertyMock, patch, call
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, PropertyMock, patch, call, ANY
 
 import boto3
 import botocore
 
-from aws_etl_tools.aws import AWS
+from aws_etl_tools import aws
+from aws_etl_tools.aws import AWS, clear_connection_pool
 from aws_etl_tools import config
 from tests import test_helper
 
@@ -14,6 +16,12 @@ class TestAWSConnectionString(unittest.TestCase):
     LOCAL_CONNECTION_STRING = 'aws_access_key_id=aws_mock_key;aws_secret_access_key=aws_mock_secret;token=aws_mock_token'
     EC2_CONNECTION_STRING = 'aws_access_key_id=aws_mock_key;aws_secret_access_key=aws_mock_secret;token=aws_mock_token'
 
+    def setUp(self):
+        clear_connection_pool()
+
+    def tearDown(self):
+        clear_connection_pool()
+
     @patch.object(boto3, 'resource')
     @patch.object(boto3, 'Session')
     def test_from_local_authentication(self, mock_boto_session, mock_boto_connection_request):
@@ -57,9 +65,11 @@ class TestAWSConnectionString(unittest.TestCase):
 class TestInitWithoutS3BasePath(unittest.TestCase):
     def setUp(self):
         self.initial_s3_base_path = config.S3_BASE_PATH
+        clear_connection_pool()
 
     def tearDown(self):
         config.S3_BASE_PATH = self.initial_s3_base_path
+        clear_connection_pool()
 
     @patch.object(boto3, 'resource')
     @patch.object(boto3, 'Session')
@@ -73,6 +83,12 @@ class TestInitWithoutS3BasePath(unittest.TestCase):
 
 class TestAWSConnection(unittest.TestCase):
 
+    def setUp(self):
+        clear_connection_pool()
+
+    def tearDown(self):
+        clear_connection_pool()
+
     @patch.object(boto3, 'resource')
     @patch.object(boto3, 'Session')
     def test_initializes_and_returns_s3_connection(self, mock_boto_session, mock_boto_resource):
@@ -89,8 +105,7 @@ class TestAWSConnection(unittest.TestCase):
         mock_boto_resource.return_value = mock_s3_connection
 
         expected_calls = [
-            call('s3', aws_secret_access_key='aws_mock_secret', aws_access_key_id='aws_mock_key', aws_session_token='aws_mock_token'),
-            call('s3', aws_secret_access_key='aws_mock_secret', aws_access_key_id='aws_mock_key', aws_session_token='aws_mock_token')
+            call('s3', aws_secret_access_key='aws_mock_secret', aws_access_key_id='aws_mock_key', aws_session_token='aws_mock_token', config=ANY)
         ]
 
         s3_connection = AWS().s3_connection()
@@ -120,7 +135,7 @@ class TestAWSConnection(unittest.TestCase):
         mock_boto_client.return_value = mock_comprehend_connection
 
         expected_call = [
-            call('comprehend', aws_secret_access_key='aws_mock_secret', aws_access_key_id='aws_mock_key', aws_session_token='aws_mock_token', region_name='aws_mock_region_name')
+            call('comprehend', aws_secret_access_key='aws_mock_secret', aws_access_key_id='aws_mock_key', aws_session_token='aws_mock_token', region_name='aws_mock_region_name', config=ANY)
         ]
 
         comprehend_connection = AWS().comprehend_connection()
@@ -152,10 +167,95 @@ class TestAWSConnection(unittest.TestCase):
         mock_boto_client.return_value = mock_athena_connection
 
         expected_call = [
-            call('athena', aws_secret_access_key='aws_mock_secret', aws_access_key_id='aws_mock_key', aws_session_token='aws_mock_token', region_name='aws_mock_region_name')
+            call('athena', aws_secret_access_key='aws_mock_secret', aws_access_key_id='aws_mock_key', aws_session_token='aws_mock_token', region_name='aws_mock_region_name', config=ANY)
         ]
 
         athena_connection = AWS().athena_connection()
 
         self.assertEqual(athena_connection, mock_athena_connection)
         mock_boto_client.assert_has_calls(expected_call, any_order=True)
+
+
+class TestAWSConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        clear_connection_pool()
+        session_patcher = patch.object(boto3, 'Session')
+        self.addCleanup(session_patcher.stop)
+        self.mock_boto_session = session_patcher.start()
+        self.set_credentials('aws_mock_key')
+
+    def tearDown(self):
+        clear_connection_pool()
+
+    def set_credentials(self, key):
+        mock_aws_credentials = Mock(access_key=key, secret_key='aws_mock_secret', token='aws_mock_token')
+        self.mock_boto_session.return_value.get_credentials.return_value = mock_aws_credentials
+        self.mock_boto_session.return_value.region_name = 'aws_mock_region_name'
+
+    @patch.object(boto3, 'resource')
+    def test_s3_connection_is_reused_within_a_thread(self, mock_boto_resource):
+        mock_boto_resource.side_effect = lambda *args, **kwargs: Mock()
+
+        first_connection = AWS().s3_connection()
+        second_connection = AWS().s3_connection()
+
+        self.assertIs(first_connection, second_connection)
+        self.assertEqual(mock_boto_resource.call_count, 1)
+
+    @patch.object(boto3, 'resource')
+    def test_s3_connections_are_not_shared_across_threads(self, mock_boto_resource):
+        mock_boto_resource.side_effect = lambda *args, **kwargs: Mock()
+        main_thread_connection = AWS().s3_connection()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            other_thread_connection = executor.submit(lambda: AWS().s3_connection()).result()
+
+        self.assertIsNot(main_thread_connection, other_thread_connection)
+
+    @patch.object(boto3, 'resource')
+    @patch.object(boto3, 'client')
+    def test_clients_are_shared_across_threads(self, mock_boto_client, _):
+        mock_boto_client.side_effect = lambda *args, **kwargs: Mock()
+        main_thread_client = AWS().athena_connection()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            other_thread_clients = list(executor.map(lambda _: AWS().athena_connection(), range(4)))
+
+        for client in other_thread_clients:
+            self.assertIs(client, main_thread_client)
+        self.assertEqual(mock_boto_client.call_count, 1)
+
+    @patch.object(boto3, 'resource')
+    @patch.object(boto3, 'client')
+    def test_new_credentials_get_a_new_client(self, mock_boto_client, _):
+        mock_boto_client.side_effect = lambda *args, **kwargs: Mock()
+        first_client = AWS().comprehend_connection()
+
+        self.set_credentials('rotated_aws_mock_key')
+        with patch.object(config, 'AWS_CREDENTIALS_CACHE_SECONDS', 0):
+            second_client = AWS().comprehend_connection()
+
+        self.assertIsNot(first_client, second_client)
+        # the client built for the rotated credentials is let go
+        self.assertEqual([pool_key[1] for pool_key in aws._SHARED_CLIENTS], ['rotated_aws_mock_key'])
+
+    @patch.object(boto3, 'resource')
+    def test_credentials_are_resolved_once(self, mock_boto_resource):
+        for _ in range(3):
+            connection_string = AWS().connection_string()
+
+        self.assertIn('aws_access_key_id=aws_mock_key', connection_string)
+        self.assertEqual(self.mock_boto_session.call_count, 1)
+        self.assertEqual(mock_boto_resource.return_value.meta.client.head_bucket.call_count, 1)
+
+        with patch.object(config, 'AWS_CREDENTIALS_CACHE_SECONDS', 0):
+            AWS()
+        self.assertEqual(self.mock_boto_session.call_count, 2)
+
+    @patch.object(boto3, 'resource')
+    def test_connection_pool_is_sized_from_config(self, mock_boto_resource):
+        AWS().s3_connection()
+
+        pool_config = mock_boto_resource.call_args[1]['config']
+        self.assertEqual(pool_config.max_pool_connections, config.AWS_MAX_POOL_CONNECTIONS)
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from aws_etl_tools.mock_s3_connection import MockS3Connection
+from aws_etl_tools import config
+from aws_etl_tools.redshift_ingest import ChangeDetector, RedshiftTable, from_snapshot
+from aws_etl_tools.redshift_ingest import sources
+from tests import test_helper
+
+
+class TestChangeDetection(unittest.TestCase):
+
+    TARGET_TABLE = 'public.snapshot_channels'
+    S3_BUCKET_NAME = test_helper.S3_TEST_BUCKET_NAME
+    TARGET_DATABASE = test_helper.LocalRedshift()
+
+    def setUp(self):
+        self.TARGET_DATABASE.execute("""
+            CREATE TABLE %s (
+                id integer PRIMARY KEY,
+                value varchar(20)
+            )""" % self.TARGET_TABLE
+        )
+        test_helper.set_default_s3_base_path()
+        self.destination = RedshiftTable(self.TARGET_DATABASE, self.TARGET_TABLE, ('id',))
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.index_path = os.path.join(self.directory.name, 'snapshot_channels.sqlite')
+
+    def tearDown(self):
+        self.TARGET_DATABASE.execute("""DROP TABLE %s""" % self.TARGET_TABLE)
+        self.TARGET_DATABASE.execute("""TRUNCATE TABLE %s""" % config.REDSHIFT_INGEST_AUDIT_TABLE)
+
+    def _table(self):
+        return self.TARGET_DATABASE.fetch("""select * from %s order by id""" % self.TARGET_TABLE)
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_only_new_and_changed_rows_are_loaded(self):
+        from_snapshot([(1, 'one'), (2, 'two'), (3, 'three')], self.destination, self.index_path)
+
+        with patch.object(sources, '_load_rows', wraps=sources._load_rows) as load_rows:
+            detector = from_snapshot([(1, 'one'), (2, 'TWO'), (3, 'three'), (4, 'four')],
+                                     self.destination, self.index_path)
+
+        self.assertEqual(load_rows.call_args[0][0], [(2, 'TWO'), (4, 'four')])
+        self.assertEqual((detector.inserted, detector.changed, detector.unchanged), (1, 1, 2))
+        self.assertEqual(self._table(), [(1, 'one'), (2, 'TWO'), (3, 'three'), (4, 'four')])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_unchanged_snapshots_load_nothing(self):
+        from_snapshot([(1, 'one'), (2, 'two')], self.destination, self.index_path)
+
+        with patch.object(sources, '_load_rows') as load_rows:
+            detector = from_snapshot([(2, 'two'), (1, 'one')], self.destination, self.index_path)
+
+        load_rows.assert_not_called()
+        self.assertEqual(detector.unchanged, 2)
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_deleted_keys_are_reported(self):
+        from_snapshot([(1, 'one'), (2, 'two'), (3, 'three')], self.destination, self.index_path)
+
+        detector = from_snapshot([(2, 'two')], self.destination, self.index_path, report_deletions=True)
+
+        self.assertEqual(detector.deleted_keys, [(1,), (3,)])
+        self.assertEqual(self._table(), [(1, 'one'), (2, 'two'), (3, 'three')])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_failed_loads_are_not_remembered(self):
+        with patch.object(sources, '_load_rows', side_effect=RuntimeError('the cluster is napping')):
+            with self.assertRaises(RuntimeError):
+                from_snapshot([(1, 'one')], self.destination, self.index_path)
+
+        detector = from_snapshot([(1, 'one')], self.destination, self.index_path)
+
+        self.assertEqual(detector.inserted, 1)
+        self.assertEqual(self._table(), [(1, 'one')])
+
+    def test_forgotten_and_reset_rows_look_new_again(self):
+        with ChangeDetector(self.destination, index_path=self.index_path) as detector:
+            list(detector.changed_rows([(1, 'one'), (2, 'two')]))
+            detector.commit()
+            detector.forget([(1,)])
+            self.assertEqual(list(detector.changed_rows([(1, 'one'), (2, 'two')])), [(1, 'one')])
+            detector.reset()
+            self.assertEqual(len(list(detector.changed_rows([(1, 'one'), (2, 'two')]))), 2)
@@ -0,0 +1,129 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from aws_etl_tools.mock_s3_connection import MockS3Connection
+from aws_etl_tools import config, s3_file
+from aws_etl_tools.redshift_ingest import IngestCheckpoint, RedshiftTable, from_in_memory, from_local_file
+from aws_etl_tools.redshift_ingest import sources
+from aws_etl_tools.s3_file import S3File, upload_local_file_to_s3_path_resumably
+from tests import test_helper
+
+
+ROWS = [(number, 'row {}'.format(number)) for number in range(10)]
+
+
+class TestIngestCheckpoint(unittest.TestCase):
+
+    TARGET_TABLE = 'public.resumable_channels'
+    S3_BUCKET_NAME = test_helper.S3_TEST_BUCKET_NAME
+    TARGET_DATABASE = test_helper.LocalRedshift()
+
+    def setUp(self):
+        self.TARGET_DATABASE.execute("""
+            CREATE TABLE %s (
+                id integer PRIMARY KEY,
+                value varchar(20)
+            )""" % self.TARGET_TABLE
+        )
+        test_helper.set_default_s3_base_path()
+        self.destination = RedshiftTable(self.TARGET_DATABASE, self.TARGET_TABLE, ('id',))
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        for name, value in [('CHECKPOINT_DIRECTORY', self.directory.name), ('SMALL_PAYLOAD_ROW_THRESHOLD', 0),
+                            ('CSV_ENCODING_PROCESSES', 2), ('CSV_ENCODING_SHARD_MIN_ROWS', 4)]:
+            config_patcher = patch.object(config, name, value)
+            self.addCleanup(config_patcher.stop)
+            config_patcher.start()
+
+    def tearDown(self):
+        self.TARGET_DATABASE.execute("""DROP TABLE %s""" % self.TARGET_TABLE)
+        self.TARGET_DATABASE.execute("""TRUNCATE TABLE %s""" % config.REDSHIFT_INGEST_AUDIT_TABLE)
+
+    def _table(self):
+        return self.TARGET_DATABASE.fetch("""select * from %s order by id""" % self.TARGET_TABLE)
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_only_parts_s3_did_not_take_are_uploaded_again(self):
+        local_path = os.path.join(self.directory.name, 'big.csv')
+        with open(local_path, 'wb') as local_file:
+            local_file.write(os.urandom(11 * 1024 * 1024))
+        s3_path = 's3://{}/big.csv'.format(self.S3_BUCKET_NAME)
+        state, uploaded_parts = {}, []
+
+        def flaky_upload_part(client, bucket_name, key_name, upload_id, part_number, body):
+            uploaded_parts.append(part_number)
+            if part_number == 2 and uploaded_parts.count(2) == 1:
+                raise ConnectionError('the network had a moment')
+            return real_upload_part(client, bucket_name, key_name, upload_id, part_number, body)
+
+        real_upload_part = s3_file._upload_part
+        with patch.object(config, 'RESUMABLE_UPLOAD_PART_BYTES', 5 * 1024 * 1024), \
+                patch.object(s3_file, '_upload_part', side_effect=flaky_upload_part):
+            with self.assertRaises(ConnectionError):
+                upload_local_file_to_s3_path_resumably(local_path, s3_path, state, lambda: None)
+            self.assertEqual(sorted(state['parts']), ['1', '3'])
+            upload_local_file_to_s3_path_resumably(local_path, s3_path, state, lambda: None)
+
+        self.assertEqual(sorted(uploaded_parts), [1, 2, 2, 3])
+        self.assertTrue(state['completed'])
+        downloaded_path = S3File(s3_path).download_to_temp()
+        self.addCleanup(os.remove, downloaded_path)
+        with open(local_path, 'rb') as local_file, open(downloaded_path, 'rb') as downloaded_file:
+            self.assertEqual(local_file.read(), downloaded_file.read())
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_a_failed_copy_is_retried_without_writing_or_uploading_again(self):
+        with patch.object(sources, 'from_manifest', side_effect=RuntimeError('the cluster is napping')):
+            with self.assertRaises(RuntimeError):
+                from_in_memory(ROWS, self.destination, load_id='rows-2016-01-02')
+        checkpoint = IngestCheckpoint(self.destination, 'rows-2016-01-02')
+        self.assertEqual(len(checkpoint.parts), 2)
+        self.assertTrue(all(upload['completed'] for upload in checkpoint.state['uploads'].values()))
+
+        with patch.object(sources, 'write_csv_parts') as write_csv_parts, \
+                patch.object(sources, 'upload_local_file_to_s3_path_resumably',
+                             wraps=upload_local_file_to_s3_path_resumably) as upload, \
+                patch.object(s3_file, 'upload_local_file_to_s3_path',
+                             wraps=s3_file.upload_local_file_to_s3_path) as upload_whole_file:
+            from_in_memory(ROWS, self.destination, load_id='rows-2016-01-02')
+
+        write_csv_parts.assert_not_called()
+        self.assertEqual(upload.call_count, 2)
+        # only the manifest is uploaded
+        self.assertEqual(upload_whole_file.call_count, 1)
+        self.assertTrue(upload_whole_file.call_args[0][1].endswith('.manifest'))
+        self.assertEqual(self._table(), ROWS)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_committed_loads_are_not_loaded_again(self):
+        local_path = os.path.join(self.directory.name, 'rows.csv')
+        with open(local_path, 'w') as local_file:
+            local_file.write('1,one\n')
+        with patch.object(IngestCheckpoint, 'remove', side_effect=OSError('the disk had a moment')):
+            with self.assertRaises(OSError):
+                from_local_file(local_path, self.destination, resumable=True)
+
+        with patch.object(sources, 's3_to_redshift') as s3_to_redshift:
+            from_local_file(local_path, self.destination, resumable=True)
+
+        s3_to_redshift.assert_not_called()
+        self.assertEqual(self._table(), [(1, 'one')])
+        self.assertEqual(os.listdir(self.directory.name), ['rows.csv'])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_changed_files_are_loaded_from_the_start(self):
+        local_path = os.path.join(self.directory.name, 'rows.csv')
+        with open(local_path, 'w') as local_file:
+            local_file.write('1,one\n')
+        with patch.object(sources, 's3_to_redshift', side_effect=RuntimeError('the cluster is napping')):
+            with self.assertRaises(RuntimeError):
+                from_local_file(local_path, self.destination, resumable=True)
+        with open(local_path, 'a') as local_file:
+            local_file.write('2,two\n')
+
+        from_local_file(local_path, self.destination, resumable=True)
+
+        self.assertEqual(self._table(), [(1, 'one'), (2, 'two')])
@@ -0,0 +1,255 @@
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from unittest.mock import patch
+
+from aws_etl_tools import config
+from aws_etl_tools.cli import JobResult, JobRunner, load_spec, main, summarize
+from aws_etl_tools.exceptions import JobSpecError
+from aws_etl_tools.mock_s3_connection import MockS3Connection
+from aws_etl_tools.wlm import WlmConcurrencyController
+from tests import test_helper
+
+
+def job(name, table='public.candy', depends_on=(), limits=()):
+    return {'name': name, 'source': {'s3_path': 's3://candy-bucket/{}.csv'.format(name)},
+            'destination': {'database': 'warehouse', 'table': table, 'upsert_key': ['id']},
+            'depends_on': list(depends_on), 'limits': list(limits)}
+
+
+class TestJobRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.started = []
+        self.running = 0
+        self.most_running = 0
+        self.failing = set()
+        self.lock = threading.Lock()
+        load_patcher = patch.object(JobRunner, '_load', autospec=True, side_effect=self._load)
+        self.addCleanup(load_patcher.stop)
+        load_patcher.start()
+
+    def _load(self, _, job):
+        with self.lock:
+            self.started.append(job['name'])
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        if job['name'] in self.failing:
+            raise RuntimeError('the cluster is napping')
+
+    def _statuses(self, results):
+        return {result.name: result.status for result in results}
+
+    def test_jobs_wait_for_what_they_depend_on(self):
+        runner = JobRunner({'workers': 4, 'jobs': [job('lollipops', 'public.lollipops', depends_on=['gum']),
+                                                   job('gum', 'public.gum'),
+                                                   job('mints', 'public.mints', depends_on=['lollipops'])]})
+
+        results = runner.run()
+
+        self.assertEqual(self.started, ['gum', 'lollipops', 'mints'])
+        self.assertEqual([result.name for result in results], ['lollipops', 'gum', 'mints'])
+        self.assertTrue(all(result.succeeded and result.elapsed_seconds > 0 for result in results))
+
+    def test_limits_and_tables_bound_how_many_jobs_run_at_once(self):
+        limited = JobRunner({'workers': 4, 'limits': {'warehouse': 2},
+                             'jobs': [job(name, 'public.' + name, limits=['warehouse'])
+                                      for name in ('gum', 'mints', 'lollipops', 'taffy')]})
+        limited.run()
+        self.assertEqual(self.most_running, 2)
+
+        self.most_running = 0
+        one_table = JobRunner({'workers': 4, 'jobs': [job(name) for name in ('gum', 'mints', 'lollipops')]})
+        one_table.run()
+        self.assertEqual(self.most_running, 1)
+
+    def test_jobs_depending_on_failures_are_skipped(self):
+        self.failing.add('gum')
+        runner = JobRunner({'jobs': [job('gum', 'public.gum'), job('mints', 'public.mints', depends_on=['gum']),
+                                     job('taffy', 'public.taffy', depends_on=['mints']),
+                                     job('lollipops', 'public.lollipops')]})
+
+        results = runner.run()
+
+        self.assertEqual(self._statuses(results), {'gum': JobResult.FAILED, 'mints': JobResult.SKIPPED,
+                                                   'taffy': JobResult.SKIPPED, 'lollipops': JobResult.SUCCEEDED})
+        self.assertEqual(str(results[0].error), 'the cluster is napping')
+        self.assertNotIn('mints', self.started)
+
+    def test_wlm_controllers_pace_the_loads_into_their_database(self):
+        runner = JobRunner({'workers': 4, 'databases': {'warehouse': {'class': 'tests.test_helper.LocalRedshift',
+                                                                      'wlm': {'max_concurrency': 3}}},
+                            'jobs': [job(name, 'public.' + name) for name in ('gum', 'mints', 'lollipops')]})
+
+        with patch.object(WlmConcurrencyController, 'sample'):
+            results = runner.run()
+
+        # the queue is never sampled here, so the limit stays at its minimum
+        self.assertEqual(self.most_running, 1)
+        self.assertEqual(runner.controller('warehouse').stats()['slots_taken'], 3)
+        self.assertIn('warehouse: WLM limit 1 after 0 increases and 0 decreases',
+                      summarize(results, 1, runner.controllers))
+
+    def test_bad_specs_are_refused_up_front(self):
+        bad_specs = [
+            [job('gum'), job('gum')],
+            [job('gum', depends_on=['chocolate'])],
+            [job('gum', depends_on=['mints']), job('mints', depends_on=['taffy']), job('taffy', depends_on=['gum'])],
+            [dict(job('gum'), source={})],
+            [dict(job('gum'), destination={'database': 'warehouse'})]
+        ]
+        for jobs in bad_specs:
+            with self.assertRaises(JobSpecError):
+                JobRunner({'jobs': jobs})
+        with self.assertRaises(JobSpecError):
+            JobRunner({'limits': {'warehouse': 0}, 'jobs': [job('gum', limits=['warehouse'])]})
+
+    def test_jobs_that_can_never_start_fail_rather_than_wait_forever(self):
+        runner = JobRunner({'limits': {'warehouse': 1}, 'jobs': [
+            job('gum', 'public.gum', limits=['warehouse']), job('mints', 'public.mints', depends_on=['gum']),
+            job('taffy', 'public.taffy')]})
+        runner.limits['warehouse'] = 0
+
+        results = runner.run()
+
+        self.assertEqual(self._statuses(results), {'gum': JobResult.FAILED, 'mints': JobResult.SKIPPED,
+                                                   'taffy': JobResult.SUCCEEDED})
+        self.assertIsInstance(results[0].error, JobSpecError)
+
+
+class TestJobRunnerCommand(unittest.TestCase):
+
+    TARGET_DATABASE = test_helper.LocalRedshift()
+    TARGET_TABLE = 'public.job_channels'
+    S3_BUCKET_NAME = test_helper.S3_TEST_BUCKET_NAME
+
+    def setUp(self):
+        self.TARGET_DATABASE.execute("""CREATE TABLE %s (id integer PRIMARY KEY, value varchar(20))"""
+                                     % self.TARGET_TABLE)
+        test_helper.set_default_s3_base_path()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def tearDown(self):
+        self.TARGET_DATABASE.execute("""DROP TABLE %s""" % self.TARGET_TABLE)
+        self.TARGET_DATABASE.execute("""TRUNCATE TABLE %s""" % config.REDSHIFT_INGEST_AUDIT_TABLE)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as spec_file:
+            spec_file.write(contents)
+        return path
+
+    def _spec(self, jobs):
+        return {'databases': {'warehouse': {'class': 'tests.test_helper.LocalRedshift'}}, 'jobs': jobs}
+
+    def _job(self, name, csv_name, depends_on=()):
+        return {'name': name, 'source': {'local_file': os.path.join(self.directory.name, csv_name)},
+                'destination': {'database': 'warehouse', 'table': self.TARGET_TABLE, 'upsert_key': ['id']},
+                'depends_on': list(depends_on)}
+
+    def _main(self, spec_path):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            exit_code = main(['run', spec_path])
+        return exit_code, stdout.getvalue(), stderr.getvalue()
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_spec_jobs_are_loaded_and_summarized(self):
+        self._write('first.csv', '1,one\n2,two\n')
+        self._write('second.csv', '2,TWO\n3,three\n')
+        spec_path = self._write('jobs.json', json.dumps(self._spec([
+            self._job('second', 'second.csv', depends_on=['first']), self._job('first', 'first.csv')])))
+
+        exit_code, stdout, _ = self._main(spec_path)
+
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(self.TARGET_DATABASE.fetch("""SELECT * FROM %s ORDER BY id""" % self.TARGET_TABLE),
+                         [(1, 'one'), (2, 'TWO'), (3, 'three')])
+        lines = stdout.splitlines()
+        self.assertEqual(lines[0].split(), ['job', 'status', 'seconds'])
+        self.assertEqual([line.split()[:2] for line in lines[1:3]], [['second', 'succeeded'], ['first', 'succeeded']])
+        self.assertTrue(lines[3].startswith('2 succeeded, 0 failed, 0 skipped in '))
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_failed_jobs_fail_the_command(self):
+        spec_path = self._write('jobs.yaml', 'databases:\n  warehouse:\n    class: tests.test_helper.LocalRedshift\n'
+                                             'jobs:\n' + ''.join(
+                                                 '  - {}\n'.format(json.dumps(spec_job)) for spec_job in [
+                                                     self._job('missing', 'missing.csv'),
+                                                     self._job('after', 'missing.csv', depends_on=['missing'])]))
+
+        exit_code, stdout, stderr = self._main(spec_path)
+
+        self.assertEqual(exit_code, 1)
+        self.assertIn('job missing failed:', stderr)
+        self.assertTrue(stdout.splitlines()[-1].startswith('0 succeeded, 1 failed, 1 skipped in '))
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_options_are_passed_on_for_postgres_queries(self):
+        spec = self._spec([{'name': 'query', 'source': {'postgres_query': "SELECT 'one', 1", 'database': 'app'},
+                            'destination': {'database': 'warehouse', 'table': self.TARGET_TABLE, 'upsert_key': ['id']},
+                            'options': {'columns': ['value', 'id']}}])
+        spec['databases']['app'] = {'class': 'tests.test_helper.BasicPostgres'}
+
+        exit_code, _, stderr = self._main(self._write('jobs.json', json.dumps(spec)))
+
+        self.assertEqual(exit_code, 0, stderr)
+        self.assertEqual(self.TARGET_DATABASE.fetch("""SELECT * FROM %s""" % self.TARGET_TABLE), [(1, 'one')])
+
+    def test_copies_both_ways_between_paced_databases_do_not_wait_on_each_other(self):
+        spec = self._spec([
+            {'name': 'out', 'source': {'copy': 'public.channels', 'database': 'warehouse'},
+             'destination': {'database': 'mart', 'table': self.TARGET_TABLE, 'upsert_key': ['id']}},
+            {'name': 'back', 'source': {'copy': 'public.channels', 'database': 'mart'},
+             'destination': {'database': 'warehouse', 'table': self.TARGET_TABLE, 'upsert_key': ['id']}}])
+        spec['workers'] = 2
+        spec['databases']['mart'] = {'class': 'tests.test_helper.LocalRedshift'}
+        for database_spec in spec['databases'].values():
+            database_spec['wlm'] = {'max_concurrency': 1}
+        runner = JobRunner(spec)
+        both_copying = threading.Barrier(2, timeout=1)
+
+        def copy_to(_, source, destination, concurrency=None, load_concurrency=None, **kwargs):
+            both_copying.wait()
+            # as unload_many does, the UNLOAD, and then the load, take their slots on threads of their own
+            for controller in (concurrency, load_concurrency):
+                done = threading.Event()
+                threading.Thread(target=lambda controller=controller: (
+                    controller.acquire(), done.set(), controller.release()), daemon=True).start()
+                if not done.wait(1):
+                    raise RuntimeError('a slot never came free')
+            return []
+
+        with patch.object(WlmConcurrencyController, 'sample'), \
+                patch('aws_etl_tools.redshift_database.RedshiftDatabase.copy_to', autospec=True, side_effect=copy_to):
+            results = runner.run()
+
+        self.assertTrue(all(result.succeeded for result in results), [result.error for result in results])
+        self.assertEqual([runner.controller(name).stats()['slots_taken'] for name in ('warehouse', 'mart')], [2, 2])
+
+    def test_specs_are_read_from_json_or_yaml(self):
+        spec = self._spec([self._job('first', 'first.csv')])
+        json_path = self._write('jobs.json', json.dumps(spec))
+        yaml_path = self._write('jobs.yml', 'databases:\n  warehouse:\n    class: tests.test_helper.LocalRedshift\n'
+                                            'jobs:\n  - {}\n'.format(json.dumps(spec['jobs'][0])))
+
+        self.assertEqual(load_spec(json_path), spec)
+        self.assertEqual(load_spec(yaml_path), spec)
+
+    def test_bad_specs_exit_before_running_anything(self):
+        spec_path = self._write('jobs.json', json.dumps(self._spec([self._job('first', 'first.csv', ['nope'])])))
+
+        exit_code, stdout, stderr = self._main(spec_path)
+
+        self.assertEqual(exit_code, 2)
+        self.assertEqual(stdout, '')
+        self.assertIn('depends on jobs that aren\'t in the spec: nope', stderr)
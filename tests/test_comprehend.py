@@ -0,0 +1,129 @@
+import json
+import unittest
+from unittest.mock import Mock, patch
+
+from botocore.exceptions import ClientError
+import pandas as pd
+
+from aws_etl_tools import config
+from aws_etl_tools.comprehend import ComprehendEnricher, RateLimiter, truncate_document
+
+
+def _sentiment_response(TextList, LanguageCode):
+    return {
+        'ResultList': [{
+            'Index': index,
+            'Sentiment': 'POSITIVE' if 'love' in text else 'NEGATIVE',
+            'SentimentScore': {'Positive': 0.9, 'Negative': 0.1, 'Neutral': 0.0, 'Mixed': 0.0}
+        } for index, text in enumerate(TextList) if text != 'unreadable'],
+        'ErrorList': [{'Index': index, 'ErrorCode': 'INTERNAL_SERVER_ERROR'}
+                      for index, text in enumerate(TextList) if text == 'unreadable']
+    }
+
+
+def _entities_response(TextList, LanguageCode):
+    return {'ResultList': [{
+        'Index': index,
+        'Entities': [{'Text': text.split()[-1], 'Type': 'OTHER', 'Score': 0.5}]
+    } for index, text in enumerate(TextList)], 'ErrorList': []}
+
+
+def _throttled():
+    return ClientError(
+        error_response={'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+        operation_name='BatchDetectSentiment')
+
+
+class TestComprehendEnricher(unittest.TestCase):
+
+    def setUp(self):
+        self.comprehend = Mock()
+        self.comprehend.batch_detect_sentiment.side_effect = _sentiment_response
+        self.comprehend.batch_detect_entities.side_effect = _entities_response
+        patcher = patch.object(ComprehendEnricher, '_comprehend_connection', return_value=self.comprehend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _enricher(self, **kwargs):
+        kwargs.setdefault('calls_per_second', 1000)
+        return ComprehendEnricher(**kwargs)
+
+    def test_documents_are_sent_in_batches_and_come_back_in_order(self):
+        documents = ['i love gum number %s' % number if number % 2 else 'i hate taffy %s' % number
+                     for number in range(60)]
+
+        sentiments = [columns[0] for columns in self._enricher(max_concurrency=2).enrich(documents)]
+
+        self.assertEqual(sentiments, ['POSITIVE' if number % 2 else 'NEGATIVE' for number in range(60)])
+        self.assertEqual([len(call[1]['TextList']) for call in self.comprehend.batch_detect_sentiment.call_args_list],
+                         [25, 25, 10])
+
+    def test_repeated_documents_are_sent_once(self):
+        enricher = self._enricher()
+
+        list(enricher.enrich(['i love gum', 'i love gum', 'i hate taffy']))
+        list(enricher.enrich(['i hate taffy']))
+
+        self.assertEqual(self.comprehend.batch_detect_sentiment.call_count, 1)
+        self.assertEqual(self.comprehend.batch_detect_sentiment.call_args[1]['TextList'], ['i love gum', 'i hate taffy'])
+
+    def test_rows_come_back_with_every_detection_appended(self):
+        enricher = self._enricher(detections=('sentiment', 'entities'))
+        rows = [(1, 'i love gum'), (2, ''), (3, 'unreadable')]
+
+        enriched_rows = list(enricher.enrich_rows(rows, text_column=1))
+
+        self.assertEqual(enricher.column_names, ('sentiment', 'sentiment_positive', 'sentiment_negative',
+                                                 'sentiment_neutral', 'sentiment_mixed', 'entities'))
+        self.assertEqual(enriched_rows[0][:3], (1, 'i love gum', 'POSITIVE'))
+        self.assertEqual(json.loads(enriched_rows[0][-1]), [{'text': 'gum', 'type': 'OTHER', 'score': 0.5}])
+        self.assertEqual(enriched_rows[1], (2, '') + (None,) * 6)
+        self.assertEqual(enriched_rows[2], (3, 'unreadable') + (None,) * 6)
+        self.assertEqual(enricher.failed_documents, 1)
+
+    def test_dict_rows_and_dataframes_get_new_columns(self):
+        enricher = self._enricher()
+
+        enriched_record = next(enricher.enrich_rows([{'id': 1, 'review': 'i love gum'}], text_column='review'))
+        enriched_dataframe = enricher.enrich_dataframe(pd.DataFrame({'review': ['i hate taffy', None]}), 'review')
+
+        self.assertEqual(enriched_record['sentiment'], 'POSITIVE')
+        self.assertEqual(enriched_dataframe['sentiment'].tolist(), ['NEGATIVE', None])
+
+    @patch('aws_etl_tools.comprehend.time.sleep')
+    def test_throttled_calls_are_retried(self, _):
+        self.comprehend.batch_detect_sentiment.side_effect = iter(
+            [_throttled(), _throttled(), _sentiment_response(['i love gum'], 'en')])
+
+        enriched = list(self._enricher().enrich(['i love gum']))
+
+        self.assertEqual(enriched[0][0], 'POSITIVE')
+        self.assertEqual(self.comprehend.batch_detect_sentiment.call_count, 3)
+
+    @patch('aws_etl_tools.comprehend.time.sleep')
+    def test_calls_throttled_too_often_raise(self, _):
+        self.comprehend.batch_detect_sentiment.side_effect = _throttled()
+
+        with patch.object(config, 'COMPREHEND_MAX_RETRIES', 2):
+            with self.assertRaises(ClientError):
+                list(self._enricher().enrich(['i love gum']))
+
+        self.assertEqual(self.comprehend.batch_detect_sentiment.call_count, 3)
+
+    def test_documents_are_truncated_between_characters(self):
+        self.assertEqual(truncate_document('crème brûlée', max_bytes=3), 'cr')
+        self.assertEqual(len(truncate_document('a' * 6000).encode('utf-8')), 5000)
+
+    def test_unknown_detections_are_rejected(self):
+        with self.assertRaises(ValueError):
+            ComprehendEnricher(detections=('sarcasm',))
+
+    @patch('aws_etl_tools.comprehend.time.sleep')
+    @patch('aws_etl_tools.comprehend.time.time', return_value=100.0)
+    def test_rate_limiter_spaces_out_calls(self, _, sleep):
+        rate_limiter = RateLimiter(calls_per_second=4)
+
+        for _ in range(3):
+            rate_limiter.wait()
+
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [0.25, 0.5])
@@ -0,0 +1,75 @@
+import unittest
+
+from aws_etl_tools.redshift_ingest import CopyPolicy, RedshiftTable
+from aws_etl_tools.redshift_ingest.ingestors import BasicUpsert
+from tests import test_helper
+
+
+class TestCopyOptionPlanner(unittest.TestCase):
+
+    TARGET_DATABASE = test_helper.BasicRedshift()
+    TARGET_TABLE = 'public.candy'
+    S3_PATH = 's3://ye-bucket/candy.csv'
+
+    def _copy_parameters(self, copy_policy=None, **ingestion_args):
+        destination = RedshiftTable(self.TARGET_DATABASE, self.TARGET_TABLE, ('id',), copy_policy=copy_policy)
+        return BasicUpsert(self.S3_PATH, destination, **ingestion_args).copy_parameters
+
+    def test_staging_copies_skip_compression_analysis_and_statistics(self):
+        self.assertEqual(self._copy_parameters(), [
+            'EMPTYASNULL', 'BLANKSASNULL', "TIMEFORMAT AS 'auto'", 'COMPUPDATE OFF', 'STATUPDATE OFF',
+            'CSV', 'IGNOREBLANKLINES'
+        ])
+
+    def test_every_option_is_planned_with_a_reason(self):
+        destination = RedshiftTable(self.TARGET_DATABASE, self.TARGET_TABLE, ('id',))
+        copy_plan = BasicUpsert(self.S3_PATH, destination, with_manifest=True, gzip=True, load_class='strict').copy_plan
+
+        self.assertIn('MANIFEST', [copy_option.option for copy_option in copy_plan])
+        for copy_option in copy_plan:
+            self.assertTrue(copy_option.reason)
+
+    def test_table_policy_adds_forgiving_options(self):
+        copy_parameters = self._copy_parameters(CopyPolicy(accept_invalid_chars='?', truncate_columns=True))
+
+        self.assertIn("ACCEPTINVCHARS AS '?'", copy_parameters)
+        self.assertIn('TRUNCATECOLUMNS', copy_parameters)
+
+    def test_accepting_invalid_chars_can_use_the_default_replacement(self):
+        copy_parameters = self._copy_parameters(CopyPolicy(accept_invalid_chars=True))
+
+        self.assertIn('ACCEPTINVCHARS', copy_parameters)
+        self.assertNotIn("ACCEPTINVCHARS AS 'True'", copy_parameters)
+
+    def test_invalid_char_replacements_are_quoted(self):
+        self.assertIn("ACCEPTINVCHARS AS ''''", self._copy_parameters(CopyPolicy(accept_invalid_chars="'")))
+
+    def test_invalid_char_replacements_must_be_one_character(self):
+        for accept_invalid_chars in ('??', '', 1):
+            with self.assertRaises(ValueError):
+                CopyPolicy(accept_invalid_chars=accept_invalid_chars)
+
+    def test_load_class_sets_max_errors(self):
+        self.assertIn('MAXERROR 100', self._copy_parameters(load_class='tolerant'))
+
+    def test_explicit_max_errors_beat_the_load_class(self):
+        copy_parameters = self._copy_parameters(load_class='tolerant', max_errors=5)
+
+        self.assertIn('MAXERROR 5', copy_parameters)
+        self.assertNotIn('MAXERROR 100', copy_parameters)
+
+    def test_zero_max_errors_beats_the_load_class(self):
+        copy_parameters = self._copy_parameters(load_class='tolerant', max_errors=0)
+
+        self.assertIn('MAXERROR 0', copy_parameters)
+        self.assertNotIn('MAXERROR 100', copy_parameters)
+
+    def test_unknown_load_class_raises(self):
+        with self.assertRaises(ValueError):
+            self._copy_parameters(load_class='whenever')
+
+    def test_json_loads_use_their_jsonpaths(self):
+        copy_parameters = self._copy_parameters(jsonpaths='s3://ye-bucket/candy.jsonpaths')
+
+        self.assertIn("JSON 's3://ye-bucket/candy.jsonpaths'", copy_parameters)
+        self.assertNotIn('CSV', copy_parameters)
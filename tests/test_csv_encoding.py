@@ -0,0 +1,78 @@
+import csv
+import io
+import os
+import tempfile
+import unittest
+from datetime import date, datetime
+from decimal import Decimal
+from unittest.mock import patch
+
+from aws_etl_tools import config
+from aws_etl_tools.csv_encoding import write_csv, write_csv_parts, write_rows
+
+
+ROWS = [(number, 'row, {}'.format(number), None) for number in range(10)]
+
+
+class TestCsvEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def _read(self, path):
+        with open(path, newline='') as csv_file:
+            return csv_file.read()
+
+    def _expected(self, rows):
+        text = io.StringIO()
+        csv.writer(text).writerows(rows)
+        return text.getvalue()
+
+    def test_rows_are_written_in_batches_like_the_csv_module_would(self):
+        text = io.StringIO()
+
+        with patch.object(config, 'CSV_ENCODING_BATCH_ROWS', 3):
+            row_count = write_rows(text, iter(ROWS))
+
+        self.assertEqual(row_count, 10)
+        self.assertEqual(text.getvalue(), self._expected(ROWS))
+
+    def test_values_are_written_as_copy_expects(self):
+        text = io.StringIO()
+
+        write_rows(text, [
+            (datetime(2016, 1, 2, 3, 4, 5, 600000), date(2016, 1, 2), Decimal('1.50'), None, 2.5),
+            (True, False, {'flavor': 'mint'}, ['gum'], '')
+        ])
+
+        self.assertEqual(text.getvalue(), '2016-01-02 03:04:05.600000,2016-01-02,1.50,,2.5\r\n'
+                                          'true,false,"{""flavor"": ""mint""}","[""gum""]",\r\n')
+
+    def test_big_sequences_are_split_into_parts_across_processes(self):
+        prefix = os.path.join(self.directory.name, 'candy')
+
+        with patch.object(config, 'CSV_ENCODING_SHARD_MIN_ROWS', 4):
+            part_paths = write_csv_parts(ROWS, prefix, processes=3)
+
+        self.assertEqual(part_paths, [prefix + '_0.csv', prefix + '_1.csv', prefix + '_2.csv'])
+        self.assertEqual([self._read(part_path) for part_path in part_paths],
+                         [self._expected(ROWS[:4]), self._expected(ROWS[4:8]), self._expected(ROWS[8:])])
+
+    def test_small_sequences_and_iterators_are_written_to_one_part(self):
+        prefix = os.path.join(self.directory.name, 'candy')
+
+        with patch.object(config, 'CSV_ENCODING_SHARD_MIN_ROWS', 4):
+            part_paths = write_csv_parts(iter(ROWS), prefix, processes=3)
+
+        self.assertEqual(part_paths, [prefix + '_0.csv'])
+        self.assertEqual(self._read(part_paths[0]), self._expected(ROWS))
+
+    def test_sharded_parts_are_joined_into_one_file(self):
+        path = os.path.join(self.directory.name, 'candy.csv')
+
+        with patch.object(config, 'CSV_ENCODING_SHARD_MIN_ROWS', 4):
+            write_csv(ROWS, path, processes=2)
+
+        self.assertEqual(self._read(path), self._expected(ROWS))
+        self.assertEqual(os.listdir(self.directory.name), ['candy.csv'])
@@ -6,6 +6,7 @@ from moto import mock_s3
 from unittest.mock import Mock
 
 from aws_etl_tools import config
+from aws_etl_tools.local_redshift_database import LocalRedshiftDatabase
 from aws_etl_tools.postgres_database import PostgresDatabase
 from aws_etl_tools.redshift_database import RedshiftDatabase
 from aws_etl_tools.redshift_ingest.ingestors import AuditedUpsertToPostgres
@@ -43,6 +44,11 @@ class BasicRedshiftButActuallyPostgres(RedshiftDatabase):
         self.credentials = settings.REDSHIFT_TEST_CREDENTIALS
 
 
+class LocalRedshift(LocalRedshiftDatabase):
+    def __init__(self):
+        self.credentials = settings.REDSHIFT_TEST_CREDENTIALS
+
+
 class UnloadableRedshift(BasicRedshiftButActuallyPostgres):
     '''This database class is useful for unit testing and in specific situations
        where a local Postgres instance cannot be made to mock Redshift because the behaviors
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+import unittest
+
+
+PUBLIC_MODULES = [
+    'aws_etl_tools',
+    'aws_etl_tools.athena_database',
+    'aws_etl_tools.cli',
+    'aws_etl_tools.aws',
+    'aws_etl_tools.comprehend',
+    'aws_etl_tools.config',
+    'aws_etl_tools.csv_encoding',
+    'aws_etl_tools.exceptions',
+    'aws_etl_tools.guard',
+    'aws_etl_tools.local_redshift_database',
+    'aws_etl_tools.pipeline',
+    'aws_etl_tools.postgres_database',
+    'aws_etl_tools.redshift_database',
+    'aws_etl_tools.redshift_ingest',
+    'aws_etl_tools.s3_file',
+    'aws_etl_tools.wlm'
+]
+# these are imported when they're first needed, never just by importing the package
+HEAVY_DEPENDENCIES = ['boto3', 'botocore', 'numpy', 'pandas', 'psycopg2', 'sqlalchemy', 'urllib.request']
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run_python(*arguments):
+    environment = dict(os.environ, AWS_ETL_TOOLS_FAST_START='1')
+    completed = subprocess.run([sys.executable] + list(arguments), cwd=PACKAGE_ROOT, env=environment,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                               check=True)
+    return completed.stdout, completed.stderr
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_public_modules_do_not_import_heavy_dependencies(self):
+        for module in PUBLIC_MODULES:
+            stdout, _ = _run_python('-c', 'import sys, {module}; print(" ".join(sorted(sys.modules)))'.format(
+                module=module))
+            imported_modules = set(stdout.split())
+
+            for dependency in HEAVY_DEPENDENCIES:
+                self.assertNotIn(dependency, imported_modules,
+                                 '{} imports {} at import time'.format(module, dependency))
@@ -0,0 +1,153 @@
+import glob
+import gzip
+import os
+import time
+import unittest
+from unittest.mock import patch
+
+import boto3
+
+from aws_etl_tools.mock_s3_connection import MockS3Connection
+from aws_etl_tools import config
+from aws_etl_tools.exceptions import SchemaMismatchError
+from aws_etl_tools.redshift_ingest import IngestBuffer, RedshiftTable
+from aws_etl_tools.s3_file import parse_s3_path
+from tests import test_helper
+
+
+class TestIngestBuffer(unittest.TestCase):
+
+    TARGET_TABLE = 'public.buffered_channels'
+    S3_BUCKET_NAME = test_helper.S3_TEST_BUCKET_NAME
+    TARGET_DATABASE = test_helper.UnloadableRedshift()
+
+    def setUp(self):
+        self.TARGET_DATABASE.execute("""
+            CREATE TABLE %s (
+                id integer PRIMARY KEY,
+                value varchar(20)
+            )""" % self.TARGET_TABLE
+        )
+        test_helper.set_default_s3_base_path()
+        self.destination = RedshiftTable(self.TARGET_DATABASE, self.TARGET_TABLE, ('id',))
+        patcher = patch('aws_etl_tools.redshift_ingest.buffer.from_manifest')
+        self.manifest_load = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.TARGET_DATABASE.execute("""DROP TABLE %s""" % self.TARGET_TABLE)
+        for part_path in glob.glob(os.path.join(config.LOCAL_TEMP_DIRECTORY, '*.csv.gz')):
+            os.remove(part_path)
+
+    def _loaded_contents(self, load_number=0):
+        manifest = self.manifest_load.call_args_list[load_number][0][0]
+        contents = b''
+        for entry in manifest['entries']:
+            bucket, key, _ = parse_s3_path(entry['url'])
+            contents += gzip.decompress(boto3.resource('s3').Object(bucket, key).get()['Body'].read())
+        return contents.decode('utf-8')
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_rows_are_loaded_as_one_gzipped_manifest_on_close(self):
+        with IngestBuffer(self.destination, max_pending_flushes=1) as buffer:
+            buffer.add([(5, 'funzies')])
+            buffer.add([(7, 'sadzies')])
+            self.manifest_load.assert_not_called()
+
+        self.manifest_load.assert_called_once_with(self.manifest_load.call_args[0][0], self.destination, gzip=True)
+        self.assertEqual(self._loaded_contents(), '5,funzies\r\n7,sadzies\r\n')
+        self.assertEqual((buffer.rows_loaded, buffer.flushes_loaded), (2, 1))
+        self.assertEqual(glob.glob(os.path.join(config.LOCAL_TEMP_DIRECTORY, '*.csv.gz')), [])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_reaching_max_rows_flushes(self):
+        with IngestBuffer(self.destination, max_rows=2) as buffer:
+            buffer.add([(1, 'a'), (2, 'b')])
+            buffer.add([(3, 'c')])
+
+        self.assertEqual(self.manifest_load.call_count, 2)
+        self.assertEqual(self._loaded_contents(0), '1,a\r\n2,b\r\n')
+        self.assertEqual(self._loaded_contents(1), '3,c\r\n')
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_old_rows_are_flushed_in_the_background(self):
+        with IngestBuffer(self.destination, max_age_seconds=0.1) as buffer:
+            buffer.add([(5, 'funzies')])
+            for _ in range(50):
+                if self.manifest_load.called:
+                    break
+                time.sleep(0.05)
+
+            self.assertEqual(self.manifest_load.call_count, 1)
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_large_flushes_are_split_into_parts(self):
+        with patch.object(config, 'INGEST_BUFFER_PART_BYTES', 1):
+            with IngestBuffer(self.destination) as buffer:
+                buffer.add([(1, 'a')])
+                buffer.add([(2, 'b')])
+
+        self.assertEqual(len(self.manifest_load.call_args[0][0]['entries']), 2)
+        self.assertEqual(self._loaded_contents(), '1,a\r\n2,b\r\n')
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_records_are_lined_up_with_the_target_columns(self):
+        with IngestBuffer(self.destination) as buffer:
+            buffer.add([{'value': 'funzies', 'id': 5}, {'value': None, 'id': 7}])
+
+            with self.assertRaises(SchemaMismatchError):
+                buffer.add([{'id': 8, 'color': 'blue'}])
+
+        self.assertEqual(self._loaded_contents(), '5,funzies\r\n7,\r\n')
+        self.assertEqual(self.manifest_load.call_args[1]['columns'], ['id', 'value'])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_records_missing_columns_the_first_one_has_are_not_padded(self):
+        with IngestBuffer(self.destination) as buffer:
+            buffer.add([{'id': 5}])
+
+            for record in ({'id': 7, 'value': 'sadzies'}, {}):
+                with self.assertRaises(SchemaMismatchError):
+                    buffer.add([{'id': 6}, record])
+
+        self.assertEqual(self._loaded_contents(), '5\r\n')
+        self.assertEqual(self.manifest_load.call_args[1]['columns'], ['id'])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_values_are_written_as_copy_expects_them(self):
+        with IngestBuffer(self.destination) as buffer:
+            buffer.add([(1, True), (2, {'fun': [1]}), (3, None)])
+
+        self.assertEqual(self._loaded_contents(), '1,true\r\n2,"{""fun"": [1]}"\r\n3,\r\n')
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_the_last_row_added_for_a_key_wins(self):
+        with patch.object(config, 'INGEST_BUFFER_PART_BYTES', 1):
+            with IngestBuffer(self.destination) as buffer:
+                buffer.add([(1, 'a'), (2, 'b'), (1, 'c'), (4, 'd\ne')])
+                buffer.add([{'id': 2, 'value': 'f'}, {'id': 3, 'value': 'g'}])
+
+        self.assertEqual(self._loaded_contents(), '1,c\r\n4,"d\ne"\r\n2,f\r\n3,g\r\n')
+        self.assertEqual(buffer.rows_loaded, 4)
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_buffers_into_the_same_table_keep_their_parts_apart(self):
+        destinations = [self.destination, RedshiftTable(self.TARGET_DATABASE, self.TARGET_TABLE, ('id',))]
+        destinations[1].instantiation_timestamp = destinations[0].instantiation_timestamp
+        buffers = [IngestBuffer(destination) for destination in destinations]
+        for number, buffer in enumerate(buffers):
+            buffer.add([(number, 'buffer {}'.format(number))])
+        for buffer in buffers:
+            buffer.close()
+
+        self.assertEqual(sorted(self._loaded_contents(number) for number in range(2)),
+                         ['0,buffer 0\r\n', '1,buffer 1\r\n'])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_failed_loads_are_raised_on_close(self):
+        self.manifest_load.side_effect = ValueError('the copy failed')
+        buffer = IngestBuffer(self.destination)
+        buffer.add([(5, 'funzies')])
+
+        with self.assertRaises(ValueError):
+            buffer.close()
@@ -0,0 +1,198 @@
+import time
+import unittest
+from contextlib import contextmanager
+from threading import Event, Lock
+from unittest.mock import Mock, patch
+
+import boto3
+
+from aws_etl_tools.mock_s3_connection import MockS3Connection
+from aws_etl_tools import config
+from aws_etl_tools.redshift_ingest import IngestCoordinator, RedshiftTable, from_s3_path
+from tests import test_helper
+
+
+class TestIngestCoordinatorIntegration(unittest.TestCase):
+
+    TARGET_TABLES = ['public.coordinated_channels', 'public.coordinated_shows']
+    S3_BUCKET_NAME = test_helper.S3_TEST_BUCKET_NAME
+    TARGET_DATABASE = test_helper.BasicRedshiftButActuallyPostgres()
+
+    def setUp(self):
+        for target_table in self.TARGET_TABLES:
+            self.TARGET_DATABASE.execute("""
+                CREATE TABLE %s (
+                    id integer PRIMARY KEY,
+                    value varchar(20)
+                )""" % target_table
+            )
+        test_helper.set_default_s3_base_path()
+
+    def tearDown(self):
+        for target_table in self.TARGET_TABLES:
+            self.TARGET_DATABASE.execute("""DROP TABLE %s""" % target_table)
+        self.TARGET_DATABASE.execute("""TRUNCATE TABLE %s""" % config.REDSHIFT_INGEST_AUDIT_TABLE)
+        test_helper.clear_temp_directory()
+
+    def _put_csv(self, key_name, file_contents):
+        boto3.resource('s3').Object(self.S3_BUCKET_NAME, key_name).put(Body=file_contents)
+        return 's3://{bucket}/{key}'.format(bucket=self.S3_BUCKET_NAME, key=key_name)
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_loads_into_several_tables_all_land(self):
+        futures = []
+        with IngestCoordinator(lock_in_database=True) as coordinator:
+            for target_table in self.TARGET_TABLES:
+                destination = RedshiftTable(self.TARGET_DATABASE, target_table, ('id',))
+                for load_number in range(3):
+                    s3_path = self._put_csv('{}/{}.csv'.format(target_table, load_number),
+                                            '{0},value {0}\n'.format(load_number))
+                    futures.append(coordinator.submit(s3_path, destination))
+
+        for future in futures:
+            self.assertIsNone(future.result())
+        for target_table in self.TARGET_TABLES:
+            self.assertEqual(self.TARGET_DATABASE.fetch("""select id from %s order by id""" % target_table),
+                             [(0,), (1,), (2,)])
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_the_last_queued_load_of_a_key_wins(self):
+        destination = RedshiftTable(test_helper.LocalRedshift(), self.TARGET_TABLES[0], ('id',))
+        s3_paths = [self._put_csv('{}.csv'.format(name), '1,{}\n'.format(name)) for name in ('first', 'second', 'third')]
+        first_load_started, release_first_load = Event(), Event()
+
+        def blocking_load(s3_path, destination, **ingestion_args):
+            if s3_path == s3_paths[0]:
+                first_load_started.set()
+                release_first_load.wait(5)
+            from_s3_path(s3_path, destination, **ingestion_args)
+
+        with patch('aws_etl_tools.redshift_ingest.coordinator.from_s3_path', side_effect=blocking_load):
+            with IngestCoordinator() as coordinator:
+                futures = [coordinator.submit(s3_paths[0], destination)]
+                first_load_started.wait(5)
+                futures.extend(coordinator.submit(s3_path, destination) for s3_path in s3_paths[1:])
+                release_first_load.set()
+            for future in futures:
+                future.result()
+
+        self.assertEqual(self.TARGET_DATABASE.fetch("""select * from %s""" % self.TARGET_TABLES[0]), [(1, 'third')])
+
+
+class TestIngestCoordinator(unittest.TestCase):
+
+    TARGET_DATABASE = test_helper.UnloadableRedshift()
+
+    def _destination(self, target_table='public.coordinated_channels', database=None):
+        return RedshiftTable(database or self.TARGET_DATABASE, target_table, ('id',))
+
+    def test_loads_into_a_table_are_serialized_but_tables_run_in_parallel(self):
+        running_by_table = {}
+        most_running_by_table = {}
+        most_running_overall = [0]
+        lock = Lock()
+
+        def slow_load(s3_path, destination, **ingestion_args):
+            with lock:
+                running_by_table[destination.target_table] = running_by_table.get(destination.target_table, 0) + 1
+                most_running_by_table[destination.target_table] = max(
+                    most_running_by_table.get(destination.target_table, 0), running_by_table[destination.target_table])
+                most_running_overall[0] = max(most_running_overall[0], sum(running_by_table.values()))
+            time.sleep(0.05)
+            with lock:
+                running_by_table[destination.target_table] -= 1
+
+        with patch('aws_etl_tools.redshift_ingest.coordinator.from_s3_path', side_effect=slow_load):
+            with IngestCoordinator(max_workers=2, merge_loads=False) as coordinator:
+                futures = [coordinator.submit('s3://bucket/%s.csv' % load_number, self._destination(target_table))
+                           for load_number in range(3)
+                           for target_table in ('public.channels', 'public.shows')]
+            for future in futures:
+                future.result()
+
+        self.assertEqual(most_running_by_table, {'public.channels': 1, 'public.shows': 1})
+        self.assertEqual(most_running_overall[0], 2)
+
+    def test_loads_hold_a_slot_of_the_wlm_controller(self):
+        controller = Mock(max_concurrency=3)
+        slots_held = []
+
+        @contextmanager
+        def slot():
+            slots_held.append(True)
+            yield
+
+        controller.slot.side_effect = slot
+        with patch('aws_etl_tools.redshift_ingest.coordinator.from_s3_path') as s3_load:
+            with IngestCoordinator(merge_loads=False, concurrency=controller) as coordinator:
+                self.assertEqual(coordinator._executor._max_workers, 3)
+                futures = [coordinator.submit('s3://bucket/%s.csv' % load_number, self._destination(target_table))
+                           for load_number, target_table in enumerate(('public.channels', 'public.shows'))]
+            for future in futures:
+                future.result()
+
+        self.assertEqual(len(slots_held), 2)
+        self.assertEqual(s3_load.call_count, 2)
+
+    def _load_while_the_first_load_blocks(self, destination, **coordinator_args):
+        first_load_started, release_first_load = Event(), Event()
+
+        def blocking_load(s3_path, destination, **ingestion_args):
+            if s3_path.endswith('first.csv'):
+                first_load_started.set()
+                release_first_load.wait(5)
+
+        with patch('aws_etl_tools.redshift_ingest.coordinator.from_s3_path', side_effect=blocking_load) as s3_load, \
+                patch('aws_etl_tools.redshift_ingest.coordinator.from_manifest') as manifest_load:
+            with IngestCoordinator(**coordinator_args) as coordinator:
+                futures = [coordinator.submit('s3://bucket/first.csv', destination)]
+                first_load_started.wait(5)
+                futures.extend(coordinator.submit('s3://bucket/%s.csv' % load_number, destination, gzip=True)
+                               for load_number in range(3))
+                release_first_load.set()
+            for future in futures:
+                future.result()
+        return s3_load, manifest_load
+
+    def test_queued_loads_are_merged_into_one_manifest(self):
+        destination = self._destination()
+
+        s3_load, manifest_load = self._load_while_the_first_load_blocks(destination, merge_loads=True)
+
+        self.assertEqual(s3_load.call_count, 1)
+        manifest_load.assert_called_once_with({'entries': [
+            {'url': 's3://bucket/0.csv', 'mandatory': True},
+            {'url': 's3://bucket/1.csv', 'mandatory': True},
+            {'url': 's3://bucket/2.csv', 'mandatory': True}
+        ]}, destination, gzip=True)
+
+    def test_queued_loads_are_not_merged_unless_asked_to(self):
+        s3_load, manifest_load = self._load_while_the_first_load_blocks(self._destination())
+
+        self.assertEqual([s3_load_call[0][0] for s3_load_call in s3_load.call_args_list],
+                         ['s3://bucket/first.csv', 's3://bucket/0.csv', 's3://bucket/1.csv', 's3://bucket/2.csv'])
+        manifest_load.assert_not_called()
+
+    def test_queued_loads_are_not_merged_for_ingestors_without_manifests(self):
+        destination = self._destination(database=test_helper.BasicRedshiftButActuallyPostgres())
+
+        s3_load, manifest_load = self._load_while_the_first_load_blocks(destination, merge_loads=True)
+
+        self.assertEqual(s3_load.call_count, 4)
+        manifest_load.assert_not_called()
+
+    def test_failed_loads_raise_from_their_futures(self):
+        with patch('aws_etl_tools.redshift_ingest.coordinator.from_s3_path', side_effect=ValueError('bad file')):
+            with IngestCoordinator() as coordinator:
+                future = coordinator.submit('s3://bucket/bad.csv', self._destination())
+
+            with self.assertRaises(ValueError):
+                future.result()
+
+    def test_submitting_after_shutdown_raises(self):
+        coordinator = IngestCoordinator()
+        coordinator.shutdown()
+
+        with self.assertRaises(RuntimeError):
+            coordinator.submit('s3://bucket/late.csv', self._destination())
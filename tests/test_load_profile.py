@@ -0,0 +1,113 @@
+from datetime import datetime
+import json
+import unittest
+from unittest.mock import Mock, PropertyMock, patch
+
+from psycopg2 import ProgrammingError
+
+from aws_etl_tools.redshift_ingest import RedshiftTable
+from aws_etl_tools.redshift_ingest.ingestors import AuditedUpsert
+from aws_etl_tools.local_redshift_database import AuditedUpsertToLocalRedshift
+from aws_etl_tools.redshift_ingest.load_profile import LoadProfile, _step_seconds
+from tests import test_helper
+
+
+class TestLoadProfile(unittest.TestCase):
+
+    QUERY_ID = 1234
+    FILE_SCANS = [('s3://ye-bucket/candy_0.csv.gz', 1000, 10, 2000000), ('s3://ye-bucket/candy_1.csv.gz', 3000, 30, 6000000)]
+    SLICE_SCANS = [(0, 1, 1000, 2000000), (1, 1, 3000, 6000000)]
+    WLM_TIMES = [(500000, 7000000)]
+    TRANSACTION_STEPS = [
+        ('create', datetime(2015, 11, 30, 22, 36, 43, 0), datetime(2015, 11, 30, 22, 36, 43, 1000)),
+        ('copy', datetime(2015, 11, 30, 22, 36, 43, 1000), datetime(2015, 11, 30, 22, 36, 49, 501000)),
+        ('delete', datetime(2015, 11, 30, 22, 36, 49, 501000), datetime(2015, 11, 30, 22, 36, 49, 751000)),
+        ('insert', datetime(2015, 11, 30, 22, 36, 49, 751000), datetime(2015, 11, 30, 22, 36, 50, 151000))
+    ]
+    INGEST_RESULTS = [(QUERY_ID, 's3://ye-bucket/candy.manifest', 40, None, None, None, None, None, None, None)]
+
+    def _database(self, *fetch_results):
+        return Mock(fetch=Mock(side_effect=list(fetch_results)))
+
+    def test_profile_is_built_from_the_system_tables(self):
+        database = self._database(self.FILE_SCANS, self.SLICE_SCANS, self.WLM_TIMES, self.TRANSACTION_STEPS)
+
+        profile = LoadProfile.fetch(database, self.QUERY_ID)
+
+        self.assertEqual([(loaded_file['filename'], loaded_file['bytes'], loaded_file['lines'])
+                          for loaded_file in profile.files],
+                         [('s3://ye-bucket/candy_0.csv.gz', 1000, 10), ('s3://ye-bucket/candy_1.csv.gz', 3000, 30)])
+        self.assertEqual([loaded_slice['load_seconds'] for loaded_slice in profile.slices], [2.0, 6.0])
+        self.assertEqual(profile.slice_skew, 1.5)
+        self.assertEqual((profile.queue_seconds, profile.execution_seconds), (0.5, 7.0))
+        self.assertEqual(dict(profile.step_seconds), {'copy': 6.5, 'delete': 0.25, 'insert': 0.4})
+        for _, params in (call[0] for call in database.fetch.call_args_list):
+            self.assertEqual(params, {'query_id': self.QUERY_ID})
+
+    def test_profile_without_wlm_or_slices(self):
+        profile = LoadProfile.fetch(self._database([], [], [], []), self.QUERY_ID)
+
+        self.assertIsNone(profile.slice_skew)
+        self.assertIsNone(profile.queue_seconds)
+        self.assertEqual(json.loads(json.dumps(profile.to_dict()))['files'], [])
+
+    def _ingestor(self, database):
+        destination = RedshiftTable(database, 'public.candy', ('id',))
+        return AuditedUpsert('s3://ye-bucket/candy.manifest', destination, with_manifest=True, columns=['id', 'name'])
+
+    @patch.object(AuditedUpsert, 'connection_string', new_callable=PropertyMock, return_value='creds')
+    def test_audited_upserts_keep_and_record_their_profile(self, _):
+        ingestor = self._ingestor(self._database([(self.QUERY_ID,)], self.FILE_SCANS, self.SLICE_SCANS,
+                                                 self.WLM_TIMES, self.TRANSACTION_STEPS, self.INGEST_RESULTS))
+
+        ingestor.ingest()
+
+        self.assertEqual(ingestor.load_profile.query_id, self.QUERY_ID)
+        audit_detail = json.loads(ingestor.ingest_results)
+        self.assertEqual(audit_detail['lines_scanned'], 40)
+        self.assertEqual(audit_detail['profile']['step_seconds']['delete'], 0.25)
+
+    @patch.object(AuditedUpsert, 'connection_string', new_callable=PropertyMock, return_value='creds')
+    def test_unreadable_system_tables_do_not_fail_the_load(self, _):
+        ingestor = self._ingestor(self._database([(self.QUERY_ID,)], ProgrammingError('permission denied'),
+                                                 self.INGEST_RESULTS))
+
+        ingestor.ingest()
+
+        self.assertIsNone(ingestor.load_profile)
+        self.assertIsNone(json.loads(ingestor.ingest_results)['profile'])
+
+
+class TestLoadProfileSteps(unittest.TestCase):
+
+    DATABASE = test_helper.LocalRedshift()
+    TRANSACTION_ID = -1234
+    # query ids, query text, and start and end seconds of a transaction as STL_QUERY keeps it
+    QUERIES = [
+        (-1, '\n            BEGIN TRANSACTION;', 0, 1),
+        (-2, '\n            COPY public.candy FROM \'s3://ye-bucket/candy.manifest\'', 1, 7),
+        (-3, '\tDELETE FROM public.candy USING candy_staging', 7, 8),
+        (-4, 'INSERT INTO public.candy SELECT * FROM candy_staging', 8, 10)
+    ]
+
+    def setUp(self):
+        cursor = self.DATABASE.make_new_cursor()
+        try:
+            AuditedUpsertToLocalRedshift._create_system_tables(cursor)
+        finally:
+            cursor.connection.close()
+        for query_id, query_text, start_second, end_second in self.QUERIES:
+            self.DATABASE.execute("""
+                INSERT INTO stl_query (query, xid, querytxt, starttime, endtime)
+                VALUES (%(query_id)s, %(xid)s, %(query_text)s, %(started_at)s, %(ended_at)s)
+                """, {'query_id': query_id, 'xid': self.TRANSACTION_ID, 'query_text': query_text,
+                      'started_at': datetime(2015, 11, 30, 22, 36, start_second),
+                      'ended_at': datetime(2015, 11, 30, 22, 36, end_second)})
+
+    def tearDown(self):
+        self.DATABASE.execute("""DELETE FROM stl_query WHERE xid = %(xid)s""", {'xid': self.TRANSACTION_ID})
+
+    def test_steps_are_named_by_the_first_word_after_any_whitespace(self):
+        step_seconds = _step_seconds(self.DATABASE, -2)
+
+        self.assertEqual(list(step_seconds.items()), [('copy', 6.0), ('delete', 1.0), ('insert', 2.0)])
@@ -0,0 +1,165 @@
+import gzip
+import json
+import unittest
+from unittest.mock import PropertyMock, patch
+
+import boto3
+
+from aws_etl_tools.mock_s3_connection import MockS3Connection
+from aws_etl_tools import config
+from aws_etl_tools.redshift_ingest import IngestBuffer, IngestCoordinator, RedshiftTable, from_in_memory, from_manifest, \
+    from_s3_path
+from aws_etl_tools.redshift_ingest.redshift_table import Column, TableSchema
+from tests import test_helper
+
+
+class TestLocalRedshiftDatabase(unittest.TestCase):
+
+    TARGET_TABLE = 'public.local_channels'
+    AUDIT_TABLE = config.REDSHIFT_INGEST_AUDIT_TABLE
+    S3_BUCKET_NAME = test_helper.S3_TEST_BUCKET_NAME
+    TARGET_DATABASE = test_helper.LocalRedshift()
+
+    def setUp(self):
+        self.TARGET_DATABASE.execute("""
+            CREATE TABLE %s (
+                id integer PRIMARY KEY,
+                value varchar(20)
+            )""" % self.TARGET_TABLE
+        )
+        self.TARGET_DATABASE.execute("""INSERT INTO %s VALUES (5, 'old funzies')""" % self.TARGET_TABLE)
+        test_helper.set_default_s3_base_path()
+        self.destination = RedshiftTable(self.TARGET_DATABASE, self.TARGET_TABLE, ('id',))
+
+    def tearDown(self):
+        self.TARGET_DATABASE.execute("""DROP TABLE %s""" % self.TARGET_TABLE)
+        self.TARGET_DATABASE.execute("""TRUNCATE TABLE %s""" % self.AUDIT_TABLE)
+        test_helper.clear_temp_directory()
+
+    def _put(self, key_name, contents, compress=False):
+        body = contents.encode('utf-8')
+        boto3.resource('s3').Object(self.S3_BUCKET_NAME, key_name).put(Body=gzip.compress(body) if compress else body)
+        return 's3://{bucket}/{key}'.format(bucket=self.S3_BUCKET_NAME, key=key_name)
+
+    def assert_data_in_target(self, expected_target_data=((5, 'funzies'), (7, 'sadzies'))):
+        actual_target_data = self.TARGET_DATABASE.fetch("""select * from {0} order by id""".format(self.TARGET_TABLE))
+        self.assertEqual(actual_target_data, list(expected_target_data))
+
+    def _audit_detail(self):
+        return json.loads(self.TARGET_DATABASE.fetch("""select detail from {0}""".format(self.AUDIT_TABLE))[0][0])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_gzipped_manifest_parts_are_upserted_and_audited(self):
+        manifest = {'entries': [
+            {'url': self._put('parts/0.csv.gz', '5,funzies\n', compress=True), 'mandatory': True},
+            {'url': self._put('parts/1.csv.gz', '7,sadzies\n', compress=True), 'mandatory': True},
+            {'url': 's3://{}/parts/missing.csv.gz'.format(self.S3_BUCKET_NAME), 'mandatory': False}
+        ]}
+
+        from_manifest(manifest, self.destination, gzip=True)
+
+        self.assert_data_in_target()
+        audit_detail = self._audit_detail()
+        self.assertEqual(audit_detail['lines_scanned'], 1)
+        self.assertEqual([loaded_file['lines'] for loaded_file in audit_detail['profile']['files']], [1, 1])
+        self.assertEqual(set(audit_detail['profile']['step_seconds']), {'copy', 'delete', 'insert'})
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_large_in_memory_data_is_written_in_parallel_parts_and_loaded_by_manifest(self):
+        with patch.object(config, 'SMALL_PAYLOAD_ROW_THRESHOLD', 1), \
+                patch.object(config, 'CSV_ENCODING_SHARD_MIN_ROWS', 2), \
+                patch.object(config, 'CSV_ENCODING_PROCESSES', 2):
+            from_in_memory([(5, 'funzies'), (7, 'sadzies')], self.destination)
+
+        self.assert_data_in_target()
+        self.assertEqual(len(self._audit_detail()['profile']['files']), 2)
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_copy_from_an_s3_path_loads_every_key_with_that_prefix(self):
+        self._put('split/candy.csv.000', '5,funzies\n')
+        self._put('split/candy.csv.001', '7,sadzies\n')
+        self._put('split/other.csv', '9,nopezies\n')
+
+        from_s3_path('s3://{}/split/candy.csv'.format(self.S3_BUCKET_NAME), self.destination)
+
+        self.assert_data_in_target()
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_unchanged_rows_are_skipped_rather_than_rewritten(self):
+        location_query = """select ctid::text from {0} where id = 5""".format(self.TARGET_TABLE)
+        location = self.TARGET_DATABASE.fetch(location_query)
+
+        from_s3_path(self._put('candy.csv', '5,old funzies\n7,sadzies\n'), self.destination, skip_unchanged=True)
+
+        self.assertEqual(self.TARGET_DATABASE.fetch(location_query), location)
+        self.assert_data_in_target(((5, 'old funzies'), (7, 'sadzies')))
+
+    def test_deletes_are_bounded_by_the_range_of_the_staged_rows(self):
+        ingestor = self.TARGET_DATABASE.ingestion_class(None, self.destination, rows=[], range_columns=('id', 'value'))
+        cursor = self.TARGET_DATABASE.make_new_cursor()
+        try:
+            cursor.execute(ingestor._create_staging_statement())
+            cursor.execute("""INSERT INTO {0} VALUES (9, 'b'), (3, NULL), (4, 'a')""".format(ingestor.staging_table))
+            range_statement = ingestor._staged_range_statement(cursor)
+        finally:
+            cursor.connection.close()
+
+        self.assertEqual(range_statement,
+                         """public.local_channels."id" BETWEEN 3 AND 9 AND """
+                         """(public.local_channels."value" BETWEEN 'a' AND 'b' OR public.local_channels."value" IS NULL)""")
+        self.assertEqual(ingestor._delete_statement(range_statement),
+                         'DELETE FROM public.local_channels USING {staging} WHERE (public.local_channels.id = '
+                         '{staging}.id) AND {range};'.format(staging=ingestor.staging_table, range=range_statement))
+
+    def test_only_sort_keys_in_the_upsert_key_bound_deletes_by_default(self):
+        schema = TableSchema([Column('id', 'integer', False, None, 32, 0)], sort_keys=('updated_at', 'id'))
+        with patch.object(RedshiftTable, 'schema', new_callable=PropertyMock, return_value=schema):
+            ingestor = self.TARGET_DATABASE.ingestion_class(None, self.destination, rows=[], range_columns=True)
+
+            self.assertEqual(ingestor.range_columns, ['id'])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_range_bounded_upserts_land(self):
+        self.TARGET_DATABASE.execute("""INSERT INTO %s VALUES (1, 'older funzies')""" % self.TARGET_TABLE)
+
+        from_s3_path(self._put('candy.csv', '5,funzies\n7,sadzies\n'), self.destination, range_columns='id')
+
+        self.assert_data_in_target(((1, 'older funzies'), (5, 'funzies'), (7, 'sadzies')))
+        self.assertEqual(set(self._audit_detail()['profile']['step_seconds']), {'copy', 'delete', 'insert'})
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_json_is_matched_to_columns_automatically(self):
+        s3_path = self._put('candy.json', '{"id": 5, "value": "funzies"} {"VALUE": "sadzies",\n"id": 7}')
+
+        from_s3_path(s3_path, self.destination, jsonpaths='auto')
+
+        self.assert_data_in_target()
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_json_is_mapped_by_jsonpaths(self):
+        jsonpaths = self._put('jsonpaths/candy.jsonpaths', json.dumps({'jsonpaths': ["$.candy['id']", '$.names[1]']}))
+        s3_path = self._put('candy.json', '{"candy": {"id": 5}, "names": ["x", "funzies"]}\n'
+                                          '{"candy": {"id": 7}, "names": ["y", "sadzies"]}\n')
+
+        from_s3_path(s3_path, self.destination, jsonpaths=jsonpaths)
+
+        self.assert_data_in_target()
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_buffered_rows_load_through_a_gzipped_manifest(self):
+        with IngestBuffer(self.destination) as buffer:
+            buffer.add([(5, 'funzies')])
+            buffer.add([{'id': 7, 'value': 'sadzies'}])
+
+        self.assert_data_in_target()
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_coordinated_loads_land(self):
+        with IngestCoordinator() as coordinator:
+            futures = [coordinator.submit(self._put('coordinated/%s.csv' % row_id, '%s,value %s\n' % (row_id, row_id)),
+                                          self.destination)
+                       for row_id in (5, 6, 7)]
+        for future in futures:
+            future.result()
+
+        self.assert_data_in_target([(5, 'value 5'), (6, 'value 6'), (7, 'value 7')])
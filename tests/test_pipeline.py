@@ -0,0 +1,146 @@
+import glob
+import gzip
+import os
+import time
+import unittest
+from threading import Timer
+
+import boto3
+
+from aws_etl_tools.mock_s3_connection import MockS3Connection
+from aws_etl_tools import config
+from aws_etl_tools.exceptions import PipelineCancelledError
+from aws_etl_tools.pipeline import CsvPartWriter, Pipeline, Stage, s3_csv_batches
+from aws_etl_tools.redshift_ingest import RedshiftTable
+from tests import test_helper
+
+
+def double(number):
+    yield number * 2
+
+
+def evens_only(number):
+    if number % 2 == 0:
+        yield number
+
+
+class Summer:
+    def __init__(self):
+        self.total = 0
+
+    def __call__(self, number):
+        self.total += number
+        return ()
+
+    def finish(self):
+        return [self.total]
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_items_flow_through_every_stage(self):
+        pipeline = Pipeline(range(10), evens_only, Stage(double, workers=3), Summer())
+
+        self.assertEqual(pipeline.run(), [40])
+        self.assertEqual([(stats.name, stats.items_in, stats.items_out) for stats in pipeline.stats],
+                         [('source', 0, 10), ('evens_only', 10, 5), ('double', 5, 5), ('Summer', 5, 1)])
+
+    def test_stages_can_run_in_processes(self):
+        pipeline = Pipeline(range(10), Stage(double, workers=2, processes=True))
+
+        self.assertEqual(pipeline.run(), [number * 2 for number in range(10)])
+
+    def test_a_slow_stage_holds_up_the_source(self):
+        produced = []
+
+        def source():
+            for number in range(20):
+                produced.append(number)
+                yield number
+
+        def slow_stage(number):
+            time.sleep(0.01)
+            # the source can only be a queue or two, plus the item in hand, ahead
+            yield len(produced) - number
+
+        lead = Pipeline(source(), slow_stage, queue_size=2).run()
+
+        self.assertLessEqual(max(lead), 2 + 2 + 1)
+
+    def test_errors_stop_the_pipeline_and_are_raised(self):
+        produced = []
+
+        def endless_source():
+            number = 0
+            while True:
+                produced.append(number)
+                yield number
+                number += 1
+
+        def picky_stage(number):
+            if number == 3:
+                raise ValueError('no threes')
+            yield number
+
+        with self.assertRaises(ValueError):
+            Pipeline(endless_source(), picky_stage, queue_size=2).run()
+        self.assertLess(len(produced), 20)
+
+    def test_cancelled_pipelines_raise(self):
+        def slow_source():
+            for number in range(1000):
+                time.sleep(0.01)
+                yield number
+
+        pipeline = Pipeline(slow_source(), double)
+        Timer(0.05, pipeline.cancel).start()
+
+        with self.assertRaises(PipelineCancelledError):
+            pipeline.run()
+        self.assertLess(pipeline.stats[0].items_out, 1000)
+
+
+class TestPipelineToRedshift(unittest.TestCase):
+
+    TARGET_TABLE = 'public.piped_channels'
+    S3_BUCKET_NAME = test_helper.S3_TEST_BUCKET_NAME
+    TARGET_DATABASE = test_helper.LocalRedshift()
+
+    def setUp(self):
+        self.TARGET_DATABASE.execute("""
+            CREATE TABLE %s (
+                id integer PRIMARY KEY,
+                value varchar(20)
+            )""" % self.TARGET_TABLE
+        )
+        test_helper.set_default_s3_base_path()
+        self.destination = RedshiftTable(self.TARGET_DATABASE, self.TARGET_TABLE, ('id',))
+
+    def tearDown(self):
+        self.TARGET_DATABASE.execute("""DROP TABLE %s""" % self.TARGET_TABLE)
+        self.TARGET_DATABASE.execute("""TRUNCATE TABLE %s""" % config.REDSHIFT_INGEST_AUDIT_TABLE)
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_batches_from_s3_are_transformed_and_upserted(self):
+        s3 = boto3.resource('s3')
+        s3.Object(self.S3_BUCKET_NAME, 'lake/channels/0.csv').put(Body=b'1,one\n2,two\n3,three\n')
+        s3.Object(self.S3_BUCKET_NAME, 'lake/channels/1.csv.gz').put(Body=gzip.compress(b'4,four\n5,five\n'))
+
+        def shout(rows):
+            yield [(row[0], row[1].upper()) for row in rows]
+
+        source = s3_csv_batches('s3://{}/lake/channels/'.format(self.S3_BUCKET_NAME), batch_size=2)
+        loads = Pipeline.to_redshift(source, self.destination, transforms=[shout], parts_per_load=2).run()
+
+        self.assertEqual(sum(loads), 3)
+        self.assertEqual(self.TARGET_DATABASE.fetch("""select * from %s order by id""" % self.TARGET_TABLE),
+                         [(1, 'ONE'), (2, 'TWO'), (3, 'THREE'), (4, 'FOUR'), (5, 'FIVE')])
+        self.assertEqual(glob.glob(os.path.join(config.LOCAL_TEMP_DIRECTORY, 'pipeline_part_*')), [])
+
+    def test_csv_parts_are_gzipped(self):
+        part_path = next(CsvPartWriter()([(1, 'one'), (2, None)]))
+        try:
+            with gzip.open(part_path) as part:
+                self.assertEqual(part.read(), b'1,one\r\n2,\r\n')
+        finally:
+            os.remove(part_path)
@@ -0,0 +1,139 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest.mock import patch
+
+from aws_etl_tools import config
+from tests import test_helper
+
+
+class TestPostgresDatabasePooledCursor(unittest.TestCase):
+
+    DATABASE = test_helper.BasicPostgres()
+
+    def tearDown(self):
+        self.DATABASE.close_connection_pool()
+
+    def test_pooled_cursor_runs_queries(self):
+        with self.DATABASE.pooled_cursor() as cursor:
+            cursor.execute('SELECT 1')
+            self.assertEqual(cursor.fetchall(), [(1,)])
+
+    def test_connections_are_reused(self):
+        with self.DATABASE.pooled_cursor() as cursor:
+            cursor.execute('SELECT pg_backend_pid()')
+            first_backend = cursor.fetchone()[0]
+        with self.DATABASE.pooled_cursor() as cursor:
+            cursor.execute('SELECT pg_backend_pid()')
+            second_backend = cursor.fetchone()[0]
+
+        self.assertEqual(first_backend, second_backend)
+
+    @patch.object(config, 'DATABASE_POOL_SIZE', 2)
+    def test_callers_wait_for_a_free_connection(self):
+        def sleepy_backend(_):
+            with self.DATABASE.pooled_cursor() as cursor:
+                cursor.execute('SELECT pg_sleep(0.05), pg_backend_pid()')
+                return cursor.fetchone()[1]
+
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            backends = set(executor.map(sleepy_backend, range(6)))
+
+        self.assertLessEqual(len(backends), 2)
+
+
+class TestPostgresDatabaseStreamingFetch(unittest.TestCase):
+
+    DATABASE = test_helper.BasicPostgres()
+    QUERY = 'SELECT n, n * 2 AS doubled FROM generate_series(1, 25) AS n ORDER BY n'
+
+    def _connections_to_database(self):
+        return self.DATABASE.fetch("""
+            SELECT count(*) FROM pg_stat_activity
+            WHERE datname = %(database_name)s AND pid <> pg_backend_pid()
+            """, {'database_name': self.DATABASE.credentials['database_name']})[0][0]
+
+    def test_iter_fetch_yields_every_row(self):
+        rows = list(self.DATABASE.iter_fetch(self.QUERY, itersize=4))
+
+        self.assertEqual(rows, [(n, n * 2) for n in range(1, 26)])
+
+    def test_fetch_batches_yields_fixed_size_batches(self):
+        batches = list(self.DATABASE.fetch_batches(self.QUERY, batch_size=10))
+
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual(batches[2][-1], (25, 50))
+
+    def test_fetch_batches_as_column_arrays(self):
+        first_batch = next(self.DATABASE.fetch_batches(self.QUERY, batch_size=3, as_arrays=True))
+
+        self.assertEqual(sorted(first_batch), ['doubled', 'n'])
+        self.assertEqual(first_batch['doubled'].tolist(), [2, 4, 6])
+
+    def test_params_are_passed_through(self):
+        rows = list(self.DATABASE.iter_fetch('SELECT %(value)s::integer', {'value': 7}))
+
+        self.assertEqual(rows, [(7,)])
+
+    def test_connection_is_closed_when_iterator_is_closed_early(self):
+        connections_before = self._connections_to_database()
+        rows = self.DATABASE.iter_fetch(self.QUERY, itersize=2)
+        next(rows)
+        self.assertEqual(self._connections_to_database(), connections_before + 1)
+
+        rows.close()
+
+        self.assertEqual(self._connections_to_database(), connections_before)
+
+    def test_fetch_closes_its_connection(self):
+        connections_before = self._connections_to_database()
+
+        self.DATABASE.fetch('SELECT 1')
+
+        self.assertEqual(self._connections_to_database(), connections_before)
+
+
+class TestPostgresDatabaseFetchDataframe(unittest.TestCase):
+
+    DATABASE = test_helper.BasicPostgres()
+    QUERY = """
+        SELECT 1 AS id, 'kitkat'::varchar AS name, 1.5::numeric AS price,
+               '2015-11-30 22:36:43'::timestamp AS sold_at, true AS is_candy
+        UNION ALL
+        SELECT 2, '', NULL, NULL, false
+        UNION ALL
+        SELECT 3, NULL, 2.25, '2015-12-01 00:00:00'::timestamp, NULL
+        ORDER BY 1
+    """
+
+    def test_values_and_types_survive_the_round_trip(self):
+        dataframe = self.DATABASE.fetch_dataframe(self.QUERY)
+
+        self.assertEqual(list(dataframe.columns), ['id', 'name', 'price', 'sold_at', 'is_candy'])
+        self.assertEqual(dataframe['id'].tolist(), [1, 2, 3])
+        self.assertEqual(str(dataframe['price'].dtype), 'float64')
+        self.assertEqual(dataframe['sold_at'][0], datetime(2015, 11, 30, 22, 36, 43))
+        self.assertEqual(dataframe['is_candy'][:2].tolist(), [True, False])
+
+    def test_nulls_and_empty_strings_stay_distinct(self):
+        names = self.DATABASE.fetch_dataframe(self.QUERY)['name'].tolist()
+
+        self.assertEqual(names[:2], ['kitkat', ''])
+        self.assertNotIsInstance(names[2], str)
+
+    def test_text_that_looks_like_a_null_marker_is_kept(self):
+        names = self.DATABASE.fetch_dataframe(r"""SELECT '\N'::text AS name UNION ALL SELECT NULL""")['name'].tolist()
+
+        self.assertEqual(names[0], '\\N')
+        self.assertNotIsInstance(names[1], str)
+
+    def test_params_are_passed_through(self):
+        dataframe = self.DATABASE.fetch_dataframe('SELECT %(name)s::text AS name', {'name': "o'henry"})
+
+        self.assertEqual(dataframe['name'].tolist(), ["o'henry"])
+
+    def test_chunked_output(self):
+        chunks = list(self.DATABASE.fetch_dataframe(
+            'SELECT n FROM generate_series(1, 5) AS n ORDER BY n', chunksize=2))
+
+        self.assertEqual([chunk['n'].tolist() for chunk in chunks], [[1, 2], [3, 4], [5]])
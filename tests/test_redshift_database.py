@@ -1,10 +1,20 @@
+import gzip
+import json
 import os
 import unittest
 
+from psycopg2 import ProgrammingError
+
 from tests import test_helper
+from contextlib import contextmanager
+from threading import Lock
 from unittest.mock import patch, Mock
-from aws_etl_tools.redshift_database import RedshiftDatabase
+from aws_etl_tools.redshift_database import RedshiftDatabase, UnloadJobResult
 from aws_etl_tools.aws import AWS
+from aws_etl_tools import config
+from aws_etl_tools.mock_s3_connection import MockS3Connection
+from aws_etl_tools.redshift_ingest import RedshiftTable
+from aws_etl_tools.wlm import WlmConcurrencyController
 
 
 class TestRedshiftDatabase(unittest.TestCase):
@@ -23,6 +33,7 @@ class TestRedshiftDatabase(unittest.TestCase):
     EXPECTED_SINGLE_UNLOAD_WITH_ESCAPE = "UNLOAD ('SELECT * FROM funzies') TO 's3://useful-things-bucket/klaatu/barada/nikto/test_s3_upload_file.csv' CREDENTIALS 'faux_aws_credentials' PARALLEL OFF DELIMITER '|' ESCAPE;"
     EXPECTED_SINGLE_UPLOAD_WITH_HEADER = "UNLOAD ('SELECT * FROM funzies') TO 's3://useful-things-bucket/klaatu/barada/nikto/test_s3_upload_file.csv' CREDENTIALS 'faux_aws_credentials' PARALLEL OFF DELIMITER '|' HEADER;"
     EXPECTED_SINGLE_UPLOAD_WITH_COMPRESSION_TYPE = "UNLOAD ('SELECT * FROM funzies') TO 's3://useful-things-bucket/klaatu/barada/nikto/test_s3_upload_file.csv' CREDENTIALS 'faux_aws_credentials' PARALLEL OFF DELIMITER '|' ZSTD;"
+    EXPECTED_PARALLEL_CSV_UNLOAD = "UNLOAD ('SELECT * FROM funzies') TO 's3://useful-things-bucket/klaatu/barada/nikto/test_s3_upload_file.csv' CREDENTIALS 'faux_aws_credentials' MANIFEST FORMAT AS CSV DELIMITER ',' GZIP;"
     EXPECTED_SINGLE_UPLOAD_WITH_MAX_FILE_SIZE = "UNLOAD ('SELECT * FROM funzies') TO 's3://useful-things-bucket/klaatu/barada/nikto/test_s3_upload_file.csv' CREDENTIALS 'faux_aws_credentials' PARALLEL OFF DELIMITER '|' MAXFILESIZE 100 MB;"
 
     @patch.object(RedshiftDatabase, 'execute')
@@ -97,3 +108,374 @@ class TestRedshiftDatabase(unittest.TestCase):
         self.REDSHIFT_DATABASE.unload(self.DOWNLOAD_QUERY, self.S3_PATH, max_file_size='100 MB')
 
         self.REDSHIFT_DATABASE.execute.assert_called_once_with(self.EXPECTED_SINGLE_UPLOAD_WITH_MAX_FILE_SIZE)
+
+    @patch.object(RedshiftDatabase, 'execute')
+    @patch('aws_etl_tools.redshift_database.AWS')
+    def test_unload_as_csv(self, mock_aws, _):
+        mock_aws.return_value.connection_string.return_value = self.AWS_CONNECTION_CREDENTIALS
+
+        self.REDSHIFT_DATABASE.unload(self.DOWNLOAD_QUERY, self.S3_PATH, is_parallel_unload=True, as_csv=True,
+                                      delimiter=',', compression_type='GZIP')
+
+        self.REDSHIFT_DATABASE.execute.assert_called_once_with(self.EXPECTED_PARALLEL_CSV_UNLOAD)
+
+
+class TestRedshiftDatabaseUnloadMany(unittest.TestCase):
+
+    REDSHIFT_DATABASE = test_helper.BasicRedshift()
+    AWS_CONNECTION_CREDENTIALS = 'faux_aws_credentials'
+    JOBS = [
+        ('SELECT * FROM events_01', 's3://useful-things-bucket/events/01/'),
+        ('SELECT * FROM events_02', 's3://useful-things-bucket/events/02/', {'is_parallel_unload': True}),
+        ('SELECT * FROM events_03', 's3://useful-things-bucket/events/03/')
+    ]
+
+    def setUp(self):
+        self.executed_queries = []
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.lock = Lock()
+        self.failures_left = {}
+
+        aws_patcher = patch('aws_etl_tools.redshift_database.AWS')
+        self.addCleanup(aws_patcher.stop)
+        aws_patcher.start().return_value.connection_string.return_value = self.AWS_CONNECTION_CREDENTIALS
+
+        cursor_patcher = patch.object(RedshiftDatabase, 'pooled_cursor', self._fake_pooled_cursor)
+        self.addCleanup(cursor_patcher.stop)
+        cursor_patcher.start()
+
+    @contextmanager
+    def _fake_pooled_cursor(self):
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            yield Mock(execute=self._execute)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def _execute(self, query):
+        with self.lock:
+            self.executed_queries.append(query)
+            for failing_query, failures_left in self.failures_left.items():
+                if failing_query in query and failures_left:
+                    self.failures_left[failing_query] -= 1
+                    raise RuntimeError('S3 had a moment')
+
+    def test_every_job_is_unloaded_with_its_options(self):
+        results = self.REDSHIFT_DATABASE.unload_many(self.JOBS, max_concurrency=2)
+
+        self.assertEqual([result.status for result in results], ['succeeded'] * 3)
+        self.assertEqual([result.job.s3_path for result in results], [job[1] for job in self.JOBS])
+        self.assertIn(
+            "UNLOAD ('SELECT * FROM events_02') TO 's3://useful-things-bucket/events/02/' "
+            "CREDENTIALS 'faux_aws_credentials' MANIFEST DELIMITER '|';",
+            self.executed_queries
+        )
+
+    def test_results_record_timing(self):
+        result = self.REDSHIFT_DATABASE.unload_many(self.JOBS[:1])[0]
+
+        self.assertEqual(result.attempts, 1)
+        self.assertIsNotNone(result.started_at)
+        self.assertGreaterEqual(result.elapsed_seconds, 0)
+
+    def test_concurrency_is_capped_by_wlm_slots(self):
+        with patch.object(RedshiftDatabase, 'fetch', return_value=[(1,)]) as database_fetch:
+            self.REDSHIFT_DATABASE.unload_many(self.JOBS, max_concurrency=3, wlm_service_class=6)
+
+        self.assertEqual(self.most_in_flight, 1)
+        self.assertEqual(database_fetch.call_args[0][1], {'service_class': 6})
+
+    def test_concurrency_follows_the_wlm_controller(self):
+        controller = WlmConcurrencyController(Mock(), max_concurrency=3)
+        controller.sample = Mock()
+
+        results = self.REDSHIFT_DATABASE.unload_many(self.JOBS, concurrency=controller)
+
+        self.assertTrue(all(result.succeeded for result in results))
+        self.assertEqual(self.most_in_flight, 1)
+        self.assertEqual(controller.stats()['slots_taken'], 3)
+
+    def test_failed_jobs_are_reported_without_stopping_the_others(self):
+        self.failures_left = {'events_02': 1}
+
+        results = self.REDSHIFT_DATABASE.unload_many(self.JOBS)
+
+        self.assertEqual([result.succeeded for result in results], [True, False, True])
+        self.assertIsInstance(results[1].error, RuntimeError)
+
+    @patch('aws_etl_tools.redshift_database.random.uniform', side_effect=lambda low, high: high)
+    @patch('aws_etl_tools.redshift_database.time.sleep')
+    def test_failed_jobs_are_retried_after_a_growing_wait(self, sleep, _):
+        self.failures_left = {'events_02': 2}
+
+        with patch.object(config, 'UNLOAD_RETRY_BASE_SECONDS', 0.5):
+            results = self.REDSHIFT_DATABASE.unload_many(self.JOBS, retries=2)
+
+        self.assertTrue(results[1].succeeded)
+        self.assertEqual(results[1].attempts, 3)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [1.0, 2.0])
+
+    @patch('aws_etl_tools.redshift_database.time.sleep')
+    def test_jobs_out_of_retries_are_not_waited_on(self, sleep):
+        self.failures_left = {'events_02': 2}
+
+        results = self.REDSHIFT_DATABASE.unload_many(self.JOBS, retries=1)
+
+        self.assertFalse(results[1].succeeded)
+        self.assertEqual(sleep.call_count, 1)
+
+    def test_max_concurrency_below_one_is_refused(self):
+        for max_concurrency in (0, -1):
+            with self.assertRaises(ValueError):
+                self.REDSHIFT_DATABASE.unload_many(self.JOBS, max_concurrency=max_concurrency)
+        self.assertEqual(self.executed_queries, [])
+
+    def test_failed_jobs_can_be_resubmitted(self):
+        self.failures_left = {'events_02': 1}
+        results = self.REDSHIFT_DATABASE.unload_many(self.JOBS)
+
+        retried = self.REDSHIFT_DATABASE.unload_many([result.job for result in results if not result.succeeded])
+
+        self.assertEqual([result.succeeded for result in retried], [True])
+
+
+class TestRedshiftDatabaseRebuildTable(unittest.TestCase):
+
+    TARGET_DATABASE = test_helper.BasicRedshiftButActuallyPostgres()
+    TABLE = 'public.rebuildable_events'
+
+    def setUp(self):
+        self.TARGET_DATABASE.execute("""
+            CREATE TABLE %s (
+                id integer NOT NULL,
+                name varchar(20) DEFAULT 'unnamed'
+            )""" % self.TABLE
+        )
+        self.TARGET_DATABASE.execute("""INSERT INTO %s (id, name) VALUES (2, 'two'), (1, 'one')""" % self.TABLE)
+
+    def tearDown(self):
+        self.TARGET_DATABASE.execute("""DROP TABLE IF EXISTS %s""" % self.TABLE)
+        self.TARGET_DATABASE.execute("""DROP ROLE IF EXISTS rebuild_reader""")
+        self.TARGET_DATABASE.execute("""DROP ROLE IF EXISTS rebuild_owner""")
+
+    def _tables_named_like_the_target(self):
+        return self.TARGET_DATABASE.fetch("""
+            SELECT table_name FROM information_schema.tables WHERE table_name LIKE 'rebuildable_events%'""")
+
+    def test_rebuilt_table_keeps_its_rows_and_defaults(self):
+        self.TARGET_DATABASE.rebuild_table(self.TABLE)
+
+        self.assertEqual(self.TARGET_DATABASE.fetch("""SELECT * FROM %s ORDER BY id""" % self.TABLE),
+                         [(1, 'one'), (2, 'two')])
+        self.TARGET_DATABASE.execute("""INSERT INTO %s (id) VALUES (3)""" % self.TABLE)
+        self.assertEqual(self.TARGET_DATABASE.fetch("""SELECT name FROM %s WHERE id = 3""" % self.TABLE),
+                         [('unnamed',)])
+        self.assertEqual(self._tables_named_like_the_target(), [('rebuildable_events',)])
+
+    def test_rebuilt_table_keeps_its_owner_and_grants(self):
+        self.TARGET_DATABASE.execute("""CREATE ROLE rebuild_reader""")
+        self.TARGET_DATABASE.execute("""CREATE ROLE rebuild_owner""")
+        self.TARGET_DATABASE.execute("""GRANT SELECT, UPDATE ON %s TO rebuild_reader""" % self.TABLE)
+        self.TARGET_DATABASE.execute("""GRANT INSERT ON %s TO rebuild_reader WITH GRANT OPTION""" % self.TABLE)
+        self.TARGET_DATABASE.execute("""ALTER TABLE %s OWNER TO rebuild_owner""" % self.TABLE)
+
+        self.TARGET_DATABASE.rebuild_table(self.TABLE)
+
+        self.assertEqual(self.TARGET_DATABASE.fetch("""
+            SELECT tableowner FROM pg_tables WHERE schemaname = 'public' AND tablename = 'rebuildable_events'"""),
+            [('rebuild_owner',)])
+        self.assertEqual(self.TARGET_DATABASE.fetch("""
+            SELECT privilege_type, is_grantable FROM information_schema.table_privileges
+            WHERE grantee = 'rebuild_reader' AND table_name = 'rebuildable_events' ORDER BY privilege_type"""),
+            [('INSERT', 'YES'), ('SELECT', 'NO'), ('UPDATE', 'NO')])
+
+    def test_failed_rebuilds_leave_the_table_alone(self):
+        with self.assertRaises(Exception):
+            self.TARGET_DATABASE.rebuild_table(self.TABLE, sort_keys=('no_such_column',))
+
+        self.assertEqual(self.TARGET_DATABASE.table_count(self.TABLE), 2)
+        self.assertEqual(self._tables_named_like_the_target(), [('rebuildable_events',)])
+
+
+class TestRedshiftDatabaseTableMaintenance(unittest.TestCase):
+
+    REDSHIFT_DATABASE = test_helper.BasicRedshift()
+    TABLE = 'public.events'
+
+    @patch.object(RedshiftDatabase, 'execute')
+    @patch.object(RedshiftDatabase, 'fetch', side_effect=[[], [('etl', 'etl=arwdRxt/etl|group analysts=r/etl')]])
+    def test_rebuild_can_change_the_table_layout(self, _, db_execution):
+        self.REDSHIFT_DATABASE.rebuild_table(self.TABLE, dist_key='user_id', sort_keys=('occurred_at', 'user_id'),
+                                             interleaved=True, column_encodings={'name': 'zstd'})
+
+        statements = [call[0][0] for call in db_execution.call_args_list]
+        self.assertRegex(statements[0], r'^CREATE TABLE public\.events_rebuild_\w{8} \(LIKE public\.events '
+                                        r'INCLUDING DEFAULTS\) DISTSTYLE KEY DISTKEY\("user_id"\) '
+                                        r'INTERLEAVED SORTKEY\("occurred_at", "user_id"\);$')
+        self.assertRegex(statements[1], r'^ALTER TABLE public\.events_rebuild_\w{8} ALTER COLUMN "name" ENCODE zstd;$')
+        self.assertIn('ORDER BY "occurred_at", "user_id";', statements[2])
+        self.assertRegex(statements[2], r'GRANT SELECT ON public\.events_rebuild_\w{8} TO GROUP "analysts";\s+'
+                                        r'ALTER TABLE public\.events_rebuild_\w{8} OWNER TO "etl";')
+        self.assertEqual(len(statements), 3)
+
+    @patch.object(RedshiftDatabase, 'execute')
+    @patch.object(RedshiftDatabase, 'fetch', return_value=[('event_id',)])
+    def test_tables_with_identity_columns_are_not_rebuilt(self, _, db_execution):
+        with self.assertRaises(ValueError):
+            self.REDSHIFT_DATABASE.rebuild_table(self.TABLE)
+
+        db_execution.assert_not_called()
+
+        with patch.object(config, 'TABLE_REBUILD_UNSORTED_PERCENT', 50), \
+                patch.object(RedshiftDatabase, 'table_unsorted_percent', return_value=80.0):
+            self.REDSHIFT_DATABASE.maintain_table(self.TABLE)
+
+        db_execution.assert_called_once_with('VACUUM public.events;')
+
+    @patch.object(RedshiftDatabase, 'rebuild_table')
+    @patch.object(RedshiftDatabase, 'execute')
+    @patch.object(RedshiftDatabase, 'fetch', side_effect=[[(80.0,)], []])
+    def test_heavily_unsorted_tables_are_rebuilt(self, _, db_execution, rebuild_table):
+        with patch.object(config, 'TABLE_REBUILD_UNSORTED_PERCENT', 50):
+            self.REDSHIFT_DATABASE.maintain_table(self.TABLE)
+
+        rebuild_table.assert_called_once_with(self.TABLE)
+        db_execution.assert_not_called()
+
+    @patch.object(RedshiftDatabase, 'rebuild_table')
+    @patch.object(RedshiftDatabase, 'execute')
+    @patch.object(RedshiftDatabase, 'fetch', return_value=[(10.0,)])
+    def test_slightly_unsorted_tables_are_vacuumed(self, _, db_execution, rebuild_table):
+        with patch.object(config, 'TABLE_REBUILD_UNSORTED_PERCENT', 50):
+            self.REDSHIFT_DATABASE.maintain_table(self.TABLE)
+
+        rebuild_table.assert_not_called()
+        db_execution.assert_called_once_with('VACUUM public.events;')
+
+    @patch.object(RedshiftDatabase, 'execute')
+    @patch.object(RedshiftDatabase, 'fetch', side_effect=ProgrammingError('relation "svv_table_info" does not exist'))
+    def test_tables_without_svv_table_info_are_vacuumed(self, _, db_execution):
+        with patch.object(config, 'TABLE_REBUILD_UNSORTED_PERCENT', 50):
+            self.REDSHIFT_DATABASE.maintain_table(self.TABLE)
+
+        db_execution.assert_called_once_with('VACUUM public.events;')
+
+
+class TestRedshiftDatabaseCopyTo(unittest.TestCase):
+
+    SOURCE_DATABASE = test_helper.BasicRedshift()
+    TABLE = 'public.copied_channels'
+    S3_BUCKET_NAME = test_helper.S3_TEST_BUCKET_NAME
+    S3_PATH = 's3://{}/copies/channels/'.format(test_helper.S3_TEST_BUCKET_NAME)
+    # what the UNLOAD of each key range writes
+    UNLOADED_PARTS = [[b'1,one\n', b'2,\n'], [b'3,"th,ree"\n']]
+
+    def setUp(self):
+        self.unloaded_jobs = []
+        self.failing_ranges = []
+        test_helper.set_default_s3_base_path()
+        unload_patcher = patch.object(RedshiftDatabase, 'unload_many', autospec=True, side_effect=self._unload_many)
+        self.addCleanup(unload_patcher.stop)
+        unload_patcher.start()
+
+    def _unload_many(self, _, jobs, max_concurrency=None, concurrency=None):
+        import boto3
+        s3 = boto3.resource('s3')
+        results = []
+        for number, (query, s3_path, options) in enumerate(jobs):
+            self.unloaded_jobs.append((query, s3_path, options))
+            result = UnloadJobResult(jobs[number])
+            if any(failing_range in query for failing_range in self.failing_ranges):
+                result.status, result.error = UnloadJobResult.FAILED, RuntimeError('S3 had a moment')
+            else:
+                parts = self.UNLOADED_PARTS[int(s3_path.rstrip('/').split('/')[-1]) % len(self.UNLOADED_PARTS)]
+                key_prefix = s3_path.replace('s3://{}/'.format(self.S3_BUCKET_NAME), '')
+                entries = []
+                for part_number, part in enumerate(parts):
+                    key = '{}0000_part_{:02d}.gz'.format(key_prefix, part_number)
+                    s3.Object(self.S3_BUCKET_NAME, key).put(Body=gzip.compress(part))
+                    entries.append({'url': 's3://{}/{}'.format(self.S3_BUCKET_NAME, key)})
+                s3.Object(self.S3_BUCKET_NAME, key_prefix + 'manifest').put(Body=json.dumps({'entries': entries}))
+                result.status = UnloadJobResult.SUCCEEDED
+            results.append(result)
+        return results
+
+    def _destination(self, database):
+        database.execute("""CREATE TABLE %s (id integer PRIMARY KEY, value varchar(20))""" % self.TABLE)
+        self.addCleanup(database.execute, """DROP TABLE %s""" % self.TABLE)
+        return RedshiftTable(database, self.TABLE, ('id',))
+
+    def _copied_rows(self, destination):
+        return destination.database.fetch("""SELECT * FROM %s ORDER BY id""" % self.TABLE)
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_redshift_destinations_load_the_unloaded_manifest(self):
+        destination = self._destination(test_helper.LocalRedshift())
+        self.addCleanup(destination.database.execute, """TRUNCATE TABLE %s""" % config.REDSHIFT_INGEST_AUDIT_TABLE)
+
+        results = self.SOURCE_DATABASE.copy_to('public.channels', destination, s3_path=self.S3_PATH)
+
+        self.assertEqual([result.succeeded for result in results], [True])
+        self.assertEqual(self.unloaded_jobs, [('SELECT * FROM public.channels', self.S3_PATH + '0/', {
+            'is_parallel_unload': True, 'allow_overwrite': True, 'as_csv': True, 'delimiter': ',',
+            'compression_type': 'GZIP'})])
+        self.assertEqual(self._copied_rows(destination), [(1, 'one'), (2, None)])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_postgres_destinations_stream_every_part_without_local_files(self):
+        destination = self._destination(test_helper.BasicPostgres())
+        local_files = set(os.listdir(config.LOCAL_TEMP_DIRECTORY))
+
+        results = self.SOURCE_DATABASE.copy_to("SELECT * FROM public.channels WHERE value <> 'four'", destination,
+                                               key_column='id', key_ranges=[(None, 3), (3, None)],
+                                               s3_path=self.S3_PATH)
+
+        self.assertEqual([result.succeeded for result in results], [True, True])
+        self.assertEqual([job[0] for job in self.unloaded_jobs], [
+            "SELECT * FROM (SELECT * FROM public.channels WHERE value <> \\'four\\') AS key_range WHERE \"id\" < 3",
+            "SELECT * FROM (SELECT * FROM public.channels WHERE value <> \\'four\\') AS key_range WHERE \"id\" >= 3"
+        ])
+        self.assertEqual(self._copied_rows(destination), [(1, 'one'), (2, None), (3, 'th,ree')])
+        self.assertEqual(set(os.listdir(config.LOCAL_TEMP_DIRECTORY)), local_files)
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_each_load_holds_a_slot_of_the_load_concurrency(self):
+        destination = self._destination(test_helper.BasicPostgres())
+        controller = WlmConcurrencyController(Mock(), max_concurrency=1)
+        controller.sample = Mock()
+
+        results = self.SOURCE_DATABASE.copy_to('public.channels', destination, key_column='id',
+                                               key_ranges=[(None, 3), (3, None)], s3_path=self.S3_PATH,
+                                               load_concurrency=controller)
+
+        self.assertEqual([result.succeeded for result in results], [True, True])
+        self.assertEqual(controller.stats()['slots_taken'], 3)
+        self.assertEqual(controller.stats()['in_flight'], 0)
+
+    def test_max_concurrency_below_one_is_refused(self):
+        destination = RedshiftTable(test_helper.BasicPostgres(), self.TABLE, ('id',))
+
+        with self.assertRaises(ValueError):
+            self.SOURCE_DATABASE.copy_to('public.channels', destination, s3_path=self.S3_PATH, max_concurrency=0)
+        self.assertEqual(self.unloaded_jobs, [])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_failed_key_ranges_can_be_copied_again(self):
+        destination = self._destination(test_helper.BasicPostgres())
+        self.failing_ranges = ['>= 3']
+        results = self.SOURCE_DATABASE.copy_to('public.channels', destination, key_column='id',
+                                               key_ranges=[(None, 3), (3, None)], s3_path=self.S3_PATH)
+        self.assertEqual([result.succeeded for result in results], [True, False])
+        self.assertIsInstance(results[1].error, RuntimeError)
+
+        self.failing_ranges = []
+        retried = self.SOURCE_DATABASE.copy_to('public.channels', destination, key_column='id',
+                                               key_ranges=[result.key_range for result in results
+                                                           if not result.succeeded], s3_path=self.S3_PATH)
+
+        self.assertEqual([result.succeeded for result in retried], [True])
+        self.assertEqual(self._copied_rows(destination), [(1, 'one'), (2, None)])
@@ -1,14 +1,18 @@
 import os
 import csv
 import unittest
+import uuid
 from importlib import reload
+from unittest.mock import patch
 
 import pandas as pd
 import boto3
 
 from aws_etl_tools.mock_s3_connection import MockS3Connection
 from aws_etl_tools import config
+from aws_etl_tools.exceptions import DataValidationError, NoDataFoundError, SchemaMismatchError
 from aws_etl_tools.redshift_ingest import *
+from aws_etl_tools.s3_file import S3File
 from tests import test_helper
 
 
@@ -38,6 +42,7 @@ class TestRedshiftIngestIntegration(unittest.TestCase):
     def tearDown(self):
         self.TARGET_DATABASE.execute("""DROP TABLE %s""" % self.TARGET_TABLE)
         self.TARGET_DATABASE.execute("""TRUNCATE TABLE %s""" % self.AUDIT_TABLE)
+        self.DESTINATION.invalidate_schema()
         test_helper.clear_temp_directory()
 
     def assert_data_in_target(self):
@@ -75,6 +80,181 @@ class TestRedshiftIngestIntegration(unittest.TestCase):
         self.assert_audit_row_created()
 
 
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_in_memory_records_to_redshift(self):
+        source_data = [{'value': 'funzies', 'id': 5}, {'value': 'sadzies', 'id': 7}]
+
+        from_in_memory(source_data, self.DESTINATION)
+
+        self.assert_data_in_target()
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_in_memory_records_with_different_keys_raise_before_upload(self):
+        for source_data in ([{'id': 5}, {'value': 'sadzies', 'id': 7}],
+                            [{'value': 'funzies', 'id': 5}, {'value': 'sadzies', 'id': 7, 'color': 'blue'}]):
+            with self.assertRaises(SchemaMismatchError):
+                from_in_memory(source_data, self.DESTINATION)
+
+        self.assertEqual(self.TARGET_DATABASE.fetch("""select count(*) from {0}""".format(self.AUDIT_TABLE)), [(0,)])
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_in_memory_data_with_wrong_width_raises_before_upload(self):
+        source_data = [[5, 'funzies', 'extra'], [7, 'sadzies', 'extra']]
+
+        with self.assertRaises(SchemaMismatchError):
+            from_in_memory(source_data, self.DESTINATION)
+
+        self.assertEqual(self.TARGET_DATABASE.fetch("""select count(*) from {0}""".format(self.AUDIT_TABLE)), [(0,)])
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_columns_added_since_the_schema_was_cached_can_be_loaded(self):
+        from_in_memory([[5, 'funzies']], self.DESTINATION)
+        self.TARGET_DATABASE.execute("""ALTER TABLE {0} ADD COLUMN color varchar(20)""".format(self.TARGET_TABLE))
+
+        from_in_memory([[7, 'sadzies', 'blue']], self.DESTINATION)
+        self.TARGET_DATABASE.execute("""ALTER TABLE {0} ADD COLUMN size integer""".format(self.TARGET_TABLE))
+        from_in_memory([{'id': 9, 'size': 3}], self.DESTINATION)
+
+        actual_target_data = self.TARGET_DATABASE.fetch("""select * from {0} order by id""".format(self.TARGET_TABLE))
+        self.assertEqual(actual_target_data, [(5, 'funzies', None, None), (7, 'sadzies', 'blue', None),
+                                              (9, None, None, 3)])
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_dataframe_columns_are_matched_by_name(self):
+        source_dataframe = pd.DataFrame(
+            [('funzies', 5), ('sadzies', 7)],
+            columns=['value', 'id']
+        )
+
+        from_dataframe(source_dataframe, self.DESTINATION)
+
+        self.assert_data_in_target()
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_dataframe_with_wrong_width_raises(self):
+        source_dataframe = pd.DataFrame(
+            [(5, 'funzies', 1.0), (7, 'sadzies', 2.0)],
+            columns=['one', 'two', 'three']
+        )
+
+        with self.assertRaises(SchemaMismatchError):
+            from_dataframe(source_dataframe, self.DESTINATION)
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_invalid_in_memory_data_raises_before_upload(self):
+        source_data = [[5, 'funzies'], [7, 'sadzies' * 5]]
+
+        with self.assertRaises(DataValidationError):
+            from_in_memory(source_data, self.DESTINATION, validate=True)
+
+        self.assertEqual(self.TARGET_DATABASE.fetch("""select count(*) from {0}""".format(self.AUDIT_TABLE)), [(0,)])
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_invalid_dataframe_rows_are_quarantined_and_the_rest_loaded(self):
+        quarantine_path = os.path.join(config.LOCAL_TEMP_DIRECTORY, 'quarantined.csv')
+        source_dataframe = pd.DataFrame(
+            [(5, 'funzies'), (6, 'sadzies' * 5), (7, 'sadzies')],
+            columns=['id', 'value']
+        )
+
+        from_dataframe(source_dataframe, self.DESTINATION, quarantine_path=quarantine_path)
+
+        self.assert_data_in_target()
+        self.assertEqual(pd.read_csv(quarantine_path)['id'].tolist(), [6])
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_small_in_memory_data_is_inserted_without_s3(self):
+        source_data = [[5, 'funzies'], [7, 'sadzies']]
+
+        with patch.object(S3File, 'from_local_file') as upload:
+            from_in_memory(source_data, self.DESTINATION)
+
+        upload.assert_not_called()
+        self.assert_data_in_target()
+        self.assert_audit_row_created()
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_empty_data_is_not_loaded(self):
+        for empty_data in ([], iter([])):
+            with self.assertRaises(NoDataFoundError):
+                from_in_memory(empty_data, self.DESTINATION)
+        with self.assertRaises(NoDataFoundError):
+            from_dataframe(pd.DataFrame([], columns=['id', 'value']), self.DESTINATION)
+
+        self.assertEqual(self.TARGET_DATABASE.fetch("""select * from {0}""".format(self.TARGET_TABLE)), [])
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_small_in_memory_data_is_inserted_as_copy_would_load_it(self):
+        self.TARGET_DATABASE.execute("""ALTER TABLE {0} ALTER COLUMN value TYPE varchar(40)""".format(self.TARGET_TABLE))
+        source_data = [[5, uuid.UUID('00000000-0000-0000-0000-000000000005')], [7, {'fun': True}], [9, False]]
+
+        with patch.object(S3File, 'from_local_file') as upload:
+            from_in_memory(source_data, self.DESTINATION)
+
+        upload.assert_not_called()
+        actual_target_data = self.TARGET_DATABASE.fetch("""select * from {0} order by id""".format(self.TARGET_TABLE))
+        self.assertEqual(actual_target_data, [(5, '00000000-0000-0000-0000-000000000005'),
+                                              (7, '{"fun": true}'), (9, 'false')])
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_blank_strings_are_inserted_as_nulls_like_copy_does(self):
+        source_data = [[5, ''], [7, '  ']]
+
+        from_in_memory(source_data, self.DESTINATION)
+
+        actual_target_data = self.TARGET_DATABASE.fetch("""select * from {0}""".format(self.TARGET_TABLE))
+        self.assertEqual(actual_target_data, [(5, None), (7, None)])
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_in_memory_data_over_the_threshold_goes_through_s3(self):
+        source_data = iter([[5, 'funzies'], [7, 'sadzies']])
+
+        with patch.object(config, 'SMALL_PAYLOAD_ROW_THRESHOLD', 1), \
+                patch.object(S3File, 'from_local_file', wraps=S3File.from_local_file) as upload:
+            from_in_memory(source_data, self.DESTINATION)
+
+        self.assertEqual(upload.call_count, 1)
+        self.assert_data_in_target()
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_sharded_in_memory_data_is_joined_for_ingestors_without_manifests(self):
+        source_data = [[5, 'funzies'], [7, 'sadzies']]
+
+        with patch.object(config, 'SMALL_PAYLOAD_ROW_THRESHOLD', 1), \
+                patch.object(config, 'CSV_ENCODING_SHARD_MIN_ROWS', 2), \
+                patch.object(config, 'CSV_ENCODING_PROCESSES', 2), \
+                patch.object(S3File, 'from_local_file', wraps=S3File.from_local_file) as upload:
+            from_in_memory(source_data, self.DESTINATION)
+
+        self.assertEqual(upload.call_count, 1)
+        self.assert_data_in_target()
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_small_dataframe_with_nulls_is_inserted_without_s3(self):
+        source_dataframe = pd.DataFrame([(5.0, None), (7.0, 'sadzies')], columns=['id', 'value'])
+
+        with patch.object(S3File, 'from_local_file') as upload:
+            from_dataframe(source_dataframe, self.DESTINATION)
+
+        upload.assert_not_called()
+        actual_target_data = self.TARGET_DATABASE.fetch("""select * from {0}""".format(self.TARGET_TABLE))
+        self.assertEqual(actual_target_data, [(5, None), (7, 'sadzies')])
+
+
     @MockS3Connection(bucket=S3_BUCKET_NAME)
     def test_postgres_query_to_redshift(self):
         source_db = test_helper.BasicPostgres()
@@ -117,6 +297,49 @@ class TestRedshiftIngestIntegration(unittest.TestCase):
         self.assert_audit_row_created()
 
 
+    def _row_locations(self):
+        # a row's ctid changes whenever it's rewritten
+        return dict(self.TARGET_DATABASE.fetch("""select id, ctid::text from {0}""".format(self.TARGET_TABLE)))
+
+    def test_unchanged_rows_are_skipped_rather_than_rewritten(self):
+        rows_to_redshift([(5, 'funzies'), (6, None), (7, 'sadzies')], self.DESTINATION)
+        locations = self._row_locations()
+
+        rows_to_redshift([(5, 'funzies'), (6, None), (7, 'gladzies')], self.DESTINATION, skip_unchanged=True)
+
+        new_locations = self._row_locations()
+        self.assertEqual(new_locations[5], locations[5])
+        self.assertEqual(new_locations[6], locations[6])
+        self.assertNotEqual(new_locations[7], locations[7])
+        self.assertEqual(self.TARGET_DATABASE.fetch("""select * from {0} order by id""".format(self.TARGET_TABLE)),
+                         [(5, 'funzies'), (6, None), (7, 'gladzies')])
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_unchanged_rows_can_be_told_by_a_version_column(self):
+        rows_to_redshift([(5, 'v1'), (7, 'v1')], self.DESTINATION)
+        locations = self._row_locations()
+        s3_path = 's3://{}/versioned_channels.csv'.format(self.S3_BUCKET_NAME)
+        S3File.from_in_memory_data([[5, 'v1'], [7, 'v2']], s3_path)
+
+        from_s3_path(s3_path, self.DESTINATION, compare_columns=('value',))
+
+        new_locations = self._row_locations()
+        self.assertEqual(new_locations[5], locations[5])
+        self.assertNotEqual(new_locations[7], locations[7])
+
+
+    @MockS3Connection(bucket=S3_BUCKET_NAME)
+    def test_range_bounded_upserts_land(self):
+        rows_to_redshift([(1, 'older funzies'), (5, 'old funzies')], self.DESTINATION)
+        s3_path = 's3://{}/bounded_channels.csv'.format(self.S3_BUCKET_NAME)
+        S3File.from_in_memory_data([[5, 'funzies'], [7, 'sadzies']], s3_path)
+
+        from_s3_path(s3_path, self.DESTINATION, range_columns=('id',))
+        rows_to_redshift([(7, 'sadzies')], self.DESTINATION, range_columns=('id',))
+
+        self.assertEqual(self.TARGET_DATABASE.fetch("""select * from {0} order by id""".format(self.TARGET_TABLE)),
+                         [(1, 'older funzies'), (5, 'funzies'), (7, 'sadzies')])
+
     @MockS3Connection(bucket=S3_BUCKET_NAME)
     def test_manifest_to_redshift_raises_value_error(self):
         '''This cannot be integration tested because Postgres cannot trivially
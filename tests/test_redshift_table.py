@@ -0,0 +1,80 @@
+import unittest
+from unittest.mock import patch
+
+from aws_etl_tools.redshift_database import RedshiftDatabase
+from aws_etl_tools.redshift_ingest import RedshiftTable
+from aws_etl_tools.redshift_ingest.redshift_table import Column, TableSchema, clear_schema_cache
+from tests import test_helper
+
+
+class TestRedshiftTableSchema(unittest.TestCase):
+
+    TARGET_TABLE = 'public.schema_candy'
+    DATABASE = test_helper.BasicRedshiftButActuallyPostgres()
+
+    def setUp(self):
+        clear_schema_cache()
+        self.DATABASE.execute("""
+            CREATE TABLE %s (
+                id integer NOT NULL,
+                name varchar(20),
+                price numeric(6, 2)
+            )""" % self.TARGET_TABLE
+        )
+        self.destination = RedshiftTable(self.DATABASE, self.TARGET_TABLE, ('id',))
+
+    def tearDown(self):
+        self.DATABASE.execute("""DROP TABLE IF EXISTS %s""" % self.TARGET_TABLE)
+        clear_schema_cache()
+
+    def test_columns_are_introspected_in_ordinal_order(self):
+        self.assertEqual(self.destination.column_names, ['id', 'name', 'price'])
+
+    def test_column_types_are_introspected(self):
+        schema = self.destination.schema
+
+        self.assertEqual(schema.column('id'), Column('id', 'integer', False, None, 32, 0))
+        self.assertEqual(schema.column('name').character_maximum_length, 20)
+        self.assertEqual(schema.column('price').numeric_scale, 2)
+
+    def test_postgres_has_no_dist_or_sort_keys(self):
+        schema = self.destination.schema
+
+        self.assertIsNone(schema.dist_key)
+        self.assertEqual(schema.sort_keys, ())
+
+    def test_schema_is_cached_across_destinations(self):
+        self.destination.schema
+        with patch.object(RedshiftDatabase, 'fetch') as database_fetch:
+            other_destination = RedshiftTable(self.DATABASE, self.TARGET_TABLE, ('id',))
+
+            self.assertEqual(other_destination.column_names, ['id', 'name', 'price'])
+            database_fetch.assert_not_called()
+
+    def test_invalidated_schema_picks_up_ddl_changes(self):
+        self.destination.schema
+        self.DATABASE.execute("""ALTER TABLE %s ADD COLUMN color varchar(10)""" % self.TARGET_TABLE)
+
+        self.destination.invalidate_schema()
+
+        self.assertEqual(self.destination.column_names, ['id', 'name', 'price', 'color'])
+
+    def test_missing_table_has_an_empty_schema_that_is_not_cached(self):
+        missing_destination = RedshiftTable(self.DATABASE, 'public.not_yet_created', ('id',))
+
+        self.assertFalse(missing_destination.schema)
+        self.DATABASE.execute("""CREATE TABLE public.not_yet_created (id integer)""")
+        try:
+            self.assertEqual(missing_destination.column_names, ['id'])
+        finally:
+            self.DATABASE.execute("""DROP TABLE public.not_yet_created""")
+
+
+class TestTableSchema(unittest.TestCase):
+
+    def test_empty_schema_is_falsy(self):
+        self.assertFalse(TableSchema([]))
+
+    def test_unknown_column_raises(self):
+        with self.assertRaises(KeyError):
+            TableSchema([Column('id', 'integer', False, None, 32, 0)]).column('nope')
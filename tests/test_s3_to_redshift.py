@@ -9,7 +9,9 @@ from psycopg2 import NotSupportedError
 
 from aws_etl_tools import config
 from aws_etl_tools.mock_s3_connection import MockS3Connection
+from aws_etl_tools.postgres_database import PostgresDatabase
 from aws_etl_tools.redshift_ingest import s3_to_redshift, RedshiftTable
+from aws_etl_tools.redshift_ingest.ingestors import AuditedUpsertToPostgres
 from aws_etl_tools.s3_file import S3File
 from aws_etl_tools.redshift_database import RedshiftDatabase
 from tests import test_helper
@@ -126,3 +128,22 @@ class TestS3ToRedshift(unittest.TestCase):
             s3_to_redshift(s3_file, RedshiftTable(self.DB_CONNECTION, self.TABLE, self.UPSERT_UNIQUENESS_KEY))
         except BaseException:
             self.fail('nothing should have errored here unexpectedly!')
+
+
+    @patch.object(PostgresDatabase, 'execute')
+    def test_audited_upserts_into_postgres_are_vacuumed(self, database_execute):
+        destination = RedshiftTable(test_helper.BasicPostgres(), self.TABLE, self.UPSERT_UNIQUENESS_KEY)
+
+        AuditedUpsertToPostgres(None, destination).final_cleanup()
+
+        database_execute.assert_called_once_with('VACUUM public.s3_csv_data;')
+
+    @patch.object(RedshiftDatabase, 'execute')
+    @patch.object(RedshiftDatabase, 'maintain_table')
+    def test_audited_upserts_into_redshift_maintain_the_table(self, maintain_table, database_execute):
+        destination = RedshiftTable(self.DB_CONNECTION, self.TABLE, self.UPSERT_UNIQUENESS_KEY)
+
+        AuditedUpsertToPostgres(None, destination).final_cleanup()
+
+        maintain_table.assert_called_once_with('public.s3_csv_data')
+        database_execute.assert_not_called()
@@ -0,0 +1,106 @@
+import os
+import unittest
+
+import pandas as pd
+
+from aws_etl_tools import config
+from aws_etl_tools.exceptions import DataValidationError
+from aws_etl_tools.redshift_ingest.redshift_table import Column, TableSchema
+from aws_etl_tools.redshift_ingest.validation import validate_dataframe, split_dataframe, RowValidator
+from tests import test_helper
+
+
+class TestValidation(unittest.TestCase):
+
+    SCHEMA = TableSchema([
+        Column('id', 'smallint', False, None, 16, 0),
+        Column('name', 'character varying', True, 6, None, None),
+        Column('price', 'numeric', True, None, 4, 2),
+        Column('sold_at', 'timestamp without time zone', True, None, None, None),
+        Column('is_candy', 'boolean', True, None, None, None)
+    ])
+    VALID_ROW = (1, 'kitkat', '12.50', '2015-11-30 22:36:43', 't')
+    QUARANTINE_PATH = os.path.join(config.LOCAL_TEMP_DIRECTORY, 'quarantine.csv')
+
+    def tearDown(self):
+        test_helper.clear_temp_directory()
+
+    def _dataframe(self, *rows):
+        return pd.DataFrame(list(rows), columns=self.SCHEMA.column_names)
+
+    def _reasons(self, report):
+        return sorted(zip(report.problems['row'], report.problems['column'], report.problems['reason']))
+
+    def test_valid_rows_pass(self):
+        report = validate_dataframe(self._dataframe(self.VALID_ROW, (2, None, None, None, None)), self.SCHEMA)
+
+        self.assertTrue(report.is_valid)
+        self.assertEqual(report.row_count, 2)
+
+    def test_each_kind_of_problem_is_reported(self):
+        dataframe = self._dataframe(
+            self.VALID_ROW,
+            (None, 'kitkat', '12.50', '2015-11-30', 'f'),
+            (40000, 'twix', 'lots', 'yesterday-ish', 'f'),
+            (3, 'snickers', '123.4', '2015-11-30', 'maybe'),
+            (1.5, 'mars', None, None, None)
+        )
+
+        report = validate_dataframe(dataframe, self.SCHEMA)
+
+        self.assertEqual(self._reasons(report), [
+            (1, 'id', 'null in NOT NULL column'),
+            (2, 'id', 'out of range for smallint'),
+            (2, 'price', 'not a number'),
+            (2, 'sold_at', 'not a parseable timestamp without time zone'),
+            (3, 'is_candy', 'not a boolean'),
+            (3, 'name', 'longer than 6 bytes'),
+            (3, 'price', 'out of range for numeric(4,2)'),
+            (4, 'id', 'not an integer')
+        ])
+        self.assertEqual(report.invalid_rows, [1, 2, 3, 4])
+
+    def test_varchar_length_is_measured_in_bytes(self):
+        report = validate_dataframe(self._dataframe((1, 'crème', None, None, None),
+                                                    (2, 'crèmes', None, None, None)), self.SCHEMA)
+
+        self.assertEqual(report.invalid_rows, [1])
+
+    def test_split_dataframe_quarantines_invalid_rows(self):
+        dataframe = self._dataframe(self.VALID_ROW, (None, 'twix', None, None, None))
+        report = validate_dataframe(dataframe, self.SCHEMA)
+
+        valid = split_dataframe(dataframe, report, self.QUARANTINE_PATH)
+
+        self.assertEqual(valid['id'].tolist(), [1])
+        quarantined = pd.read_csv(self.QUARANTINE_PATH)
+        self.assertEqual(quarantined['name'].tolist(), ['twix'])
+        self.assertEqual(quarantined['validation_errors'].tolist(), ['id: null in NOT NULL column'])
+
+    def test_row_validator_raises_without_quarantine(self):
+        rows = [self.VALID_ROW, (None, 'twix', None, None, None)]
+
+        with self.assertRaises(DataValidationError) as context:
+            list(RowValidator(self.SCHEMA).valid_rows(rows))
+
+        self.assertEqual(context.exception.report.invalid_rows, [1])
+
+    def test_row_validator_quarantines_across_chunks(self):
+        rows = [self.VALID_ROW, (None, 'twix', None, None, None), self.VALID_ROW, ('x', 'mars', None, None, None)]
+        validator = RowValidator(self.SCHEMA, quarantine_path=self.QUARANTINE_PATH, chunk_size=2)
+
+        valid_rows = list(validator.valid_rows(rows))
+
+        self.assertEqual(valid_rows, [self.VALID_ROW, self.VALID_ROW])
+        self.assertEqual(validator.report.invalid_rows, [1, 3])
+        self.assertEqual(pd.read_csv(self.QUARANTINE_PATH)['name'].tolist(), ['twix', 'mars'])
+
+    def test_row_validator_replaces_an_old_quarantine_file(self):
+        with open(self.QUARANTINE_PATH, 'w') as quarantine_file:
+            quarantine_file.write('id,name\n9,stale\n')
+        rows = [self.VALID_ROW, self.VALID_ROW, ('x', 'mars', None, None, None)]
+        validator = RowValidator(self.SCHEMA, quarantine_path=self.QUARANTINE_PATH, chunk_size=2)
+
+        list(validator.valid_rows(rows))
+
+        self.assertEqual(pd.read_csv(self.QUARANTINE_PATH)['name'].tolist(), ['mars'])
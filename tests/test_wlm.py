@@ -0,0 +1,104 @@
+import threading
+import unittest
+from contextlib import contextmanager
+from unittest.mock import Mock, patch
+
+from aws_etl_tools import config
+from aws_etl_tools.wlm import WlmConcurrencyController
+
+
+class FakeWlmDatabase:
+    '''Answers the WLM sample query with `queue`: (slots, running, queued, max queue microseconds).'''
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.sampled_service_classes = []
+
+    @contextmanager
+    def pooled_cursor(self):
+        def execute(query, params):
+            if isinstance(self.queue, Exception):
+                raise self.queue
+            self.sampled_service_classes.append(params['service_class'])
+        yield Mock(execute=execute, fetchall=lambda: [self.queue])
+
+
+class TestWlmConcurrencyController(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in [('WLM_SAMPLE_SECONDS', 0), ('WLM_MAX_QUEUE_SECONDS', 1), ('WLM_RESERVED_SLOTS', 1)]:
+            config_patcher = patch.object(config, name, value)
+            self.addCleanup(config_patcher.stop)
+            config_patcher.start()
+
+    def test_the_limit_grows_while_the_queue_has_slots_to_spare(self):
+        database = FakeWlmDatabase((5, 1, 0, 0))
+        controller = WlmConcurrencyController(database, service_class=7, max_concurrency=3)
+
+        for _ in range(3):
+            controller.acquire()
+
+        self.assertEqual((controller.limit, controller.in_flight, controller.increases), (3, 3, 2))
+        self.assertEqual(set(database.sampled_service_classes), {7})
+        controller.sample()
+        self.assertEqual(controller.limit, 3)
+
+    def test_the_limit_is_halved_when_queries_wait_in_the_queue(self):
+        database = FakeWlmDatabase((5, 5, 2, 3000000))
+        controller = WlmConcurrencyController(database, max_concurrency=8)
+        controller.limit = 6
+
+        limits = []
+        for _ in range(3):
+            controller.sample()
+            limits.append(controller.limit)
+
+        self.assertEqual(limits, [3, 1, 1])
+        self.assertEqual(controller.decreases, 2)
+        self.assertEqual(controller.stats()['last_sample']['max_queue_seconds'], 3.0)
+
+    def test_slots_are_left_free_for_other_queries(self):
+        controller = WlmConcurrencyController(FakeWlmDatabase((3, 2, 0, 0)))
+        controller.acquire()
+
+        controller.sample()
+
+        self.assertEqual(controller.limit, 1)
+
+    def test_work_waits_for_a_slot_when_the_limit_is_reached(self):
+        controller = WlmConcurrencyController(FakeWlmDatabase((2, 2, 0, 0)))
+        acquired = threading.Event()
+        controller.acquire()
+
+        waiter = threading.Thread(target=lambda: (controller.acquire(), acquired.set()))
+        with patch.object(config, 'WLM_SAMPLE_SECONDS', 0.02):
+            waiter.start()
+            self.assertFalse(acquired.wait(0.1))
+            controller.release()
+            waiter.join(1)
+
+        self.assertTrue(acquired.is_set())
+        stats = controller.stats()
+        self.assertEqual((stats['limit'], stats['in_flight'], stats['slots_taken']), (1, 1, 2))
+        self.assertGreater(stats['slot_wait_seconds'], 0.05)
+
+    def test_failed_samples_leave_the_limit_alone(self):
+        controller = WlmConcurrencyController(FakeWlmDatabase(RuntimeError('no such table')))
+        controller.limit = 2
+
+        with controller.slot():
+            self.assertEqual(controller.in_flight, 1)
+
+        self.assertEqual((controller.limit, controller.in_flight), (2, 0))
+        self.assertEqual(controller.stats()['sample_error'], 'no such table')
+
+    def test_samples_are_taken_at_most_every_so_often(self):
+        database = FakeWlmDatabase((5, 0, 0, 0))
+        controller = WlmConcurrencyController(database, max_concurrency=4)
+
+        with patch.object(config, 'WLM_SAMPLE_SECONDS', 60):
+            for _ in range(3):
+                controller.acquire()
+                controller.release()
+
+        self.assertEqual(len(database.sampled_service_classes), 1)